@@ -0,0 +1,272 @@
+"""Length-prefixed framing for persistent AUBus connections.
+
+A framed connection starts with the 4-byte MAGIC preamble; everything after
+it is a stream of frames, each a HEADER (payload length, flags byte)
+followed by the payload. Any number of requests can be sent on one socket
+and responses come back in the same order.
+
+Connections that do not start with MAGIC are legacy one-shot text requests.
+
+Frame payloads are colon-delimited text by default. Frames flagged with
+FLAG_BINARY carry values in the compact tagged encoding implemented by
+encode_value()/decode_value() instead: a request is [command, *args] and a
+response is [status, data]. A request flagged FLAG_ACCEPT_COMPRESSED lets
+the server zlib-compress a large reply, which it marks FLAG_COMPRESSED.
+Frames flagged FLAG_EVENT are pushed by the server to subscribed
+connections ("event:<json>") and are not replies to any request.
+
+The server and the client both import this package, through the
+protocol.py shim in their directory.
+"""
+
+import struct
+import zlib
+
+MAGIC = b"AUBF"                   # preamble that switches a connection to framed mode
+HEADER = struct.Struct(">IB")     # payload length (uint32), flags (uint8)
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # refuse frames above 16 MiB
+MAX_DEPTH = 64                    # lists/dicts nested deeper than this are refused
+RECV_SIZE = 65536
+
+FLAG_BINARY = 0x01                # payload uses the tagged binary codec
+FLAG_COMPRESSED = 0x02            # payload is zlib-compressed
+FLAG_ACCEPT_COMPRESSED = 0x04     # request: the sender can read compressed replies
+FLAG_EVENT = 0x08                 # unsolicited server push, not a reply
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that are not valid framing."""
+
+
+def encode_frame(payload: bytes, flags: int = 0) -> bytes:
+    """Prefix a payload with its frame header."""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large ({len(payload)} bytes).")
+    return HEADER.pack(len(payload), flags) + payload
+
+
+class FrameDecoder:
+    """Incremental frame parser: feed() raw bytes, then pull complete frames."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+    def next_frame(self):
+        """Return (flags, payload) for the next complete frame, or None."""
+        if len(self._buffer) < HEADER.size:
+            return None
+        length, flags = HEADER.unpack_from(self._buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame too large ({length} bytes).")
+        end = HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        payload = bytes(self._buffer[HEADER.size:end])
+        del self._buffer[:end]
+        return flags, payload
+
+    def has_partial(self) -> bool:
+        """True when some bytes of an unfinished frame are buffered."""
+        return bool(self._buffer)
+
+
+def decompress_payload(payload: bytes) -> bytes:
+    """Inflate a FLAG_COMPRESSED payload, refusing to expand past MAX_FRAME_SIZE."""
+    inflater = zlib.decompressobj()
+    try:
+        data = inflater.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Bad compressed payload: {e}")
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise ProtocolError("Compressed payload is truncated or too large.")
+    return data
+
+
+def recv_frame(sock, decoder: FrameDecoder):
+    """Block on a socket until the decoder yields a frame; None on clean EOF."""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            if decoder.has_partial():
+                raise ProtocolError("Connection closed mid-frame.")
+            return None
+        decoder.feed(chunk)
+
+
+def split_preamble(data: bytes):
+    """Classify the first bytes of a connection.
+
+    Returns (True, rest) for a framed connection, (False, data) for a legacy
+    request, or (None, data) if more bytes are needed to decide.
+    """
+    if data.startswith(MAGIC):
+        return True, data[len(MAGIC):]
+    if data and MAGIC.startswith(data):
+        return None, data
+    return False, data
+
+
+# ---- Tagged binary codec ----
+#
+# Every value starts with a one-byte tag. Strings, bytes, lists and dicts
+# use a 1-byte length when it fits and a 4-byte length otherwise. Short
+# strings (dict keys, usernames, ride ids...) are numbered in order of first
+# appearance; repeats are sent as a back-reference to that number.
+
+T_NONE, T_FALSE, T_TRUE = 0x00, 0x01, 0x02
+T_INT8, T_INT32, T_INT64, T_FLOAT = 0x03, 0x04, 0x05, 0x06
+T_STR8, T_STR32 = 0x07, 0x08
+T_BYTES8, T_BYTES32 = 0x09, 0x0A
+T_LIST8, T_LIST32 = 0x0B, 0x0C
+T_DICT8, T_DICT32 = 0x0D, 0x0E
+T_REF8, T_REF16 = 0x0F, 0x10
+
+REF_MAX_LEN = 64        # strings up to this many bytes are back-referenced
+REF_TABLE_SIZE = 65536  # back-references are at most 16 bits
+
+_I = struct.Struct(">I")
+_H = struct.Struct(">H")
+_i8 = struct.Struct(">b")
+_i32 = struct.Struct(">i")
+_i64 = struct.Struct(">q")
+_f64 = struct.Struct(">d")
+_SIMPLE = {None: bytes([T_NONE]), False: bytes([T_FALSE]), True: bytes([T_TRUE])}
+
+
+def _sized(out, tag8, tag32, size):
+    if size < 256:
+        out.append(bytes((tag8, size)))
+    else:
+        out.append(bytes((tag32,)) + _I.pack(size))
+
+
+def _encode(value, out, refs):
+    t = type(value)
+    if t is str:
+        ref = refs.get(value)
+        if ref is not None:
+            out.append(bytes((T_REF8, ref)) if ref < 256 else bytes((T_REF16,)) + _H.pack(ref))
+            return
+        data = value.encode()
+        if len(data) <= REF_MAX_LEN and len(refs) < REF_TABLE_SIZE:
+            refs[value] = len(refs)
+        _sized(out, T_STR8, T_STR32, len(data))
+        out.append(data)
+    elif value is None or t is bool:
+        out.append(_SIMPLE[value])
+    elif t is int:
+        if -128 <= value < 128:
+            out.append(bytes((T_INT8,)) + _i8.pack(value))
+        elif -2**31 <= value < 2**31:
+            out.append(bytes((T_INT32,)) + _i32.pack(value))
+        else:
+            out.append(bytes((T_INT64,)) + _i64.pack(value))
+    elif t is float:
+        out.append(bytes((T_FLOAT,)) + _f64.pack(value))
+    elif t is list or t is tuple:
+        _sized(out, T_LIST8, T_LIST32, len(value))
+        for item in value:
+            _encode(item, out, refs)
+    elif t is dict:
+        _sized(out, T_DICT8, T_DICT32, len(value))
+        for key, item in value.items():
+            _encode(key, out, refs)
+            _encode(item, out, refs)
+    elif t is bytes or t is bytearray:
+        _sized(out, T_BYTES8, T_BYTES32, len(value))
+        out.append(bytes(value))
+    else:
+        raise TypeError(f"Cannot encode {t.__name__} values.")
+
+
+def encode_value(value) -> bytes:
+    """Serialize None/bool/int/float/str/bytes/list/dict to tagged bytes."""
+    out = []
+    _encode(value, out, {})
+    return b"".join(out)
+
+
+def _decode(buf, pos, refs, depth=0):
+    tag = buf[pos]
+    pos += 1
+    if tag == T_REF8:
+        return refs[buf[pos]], pos + 1
+    if tag == T_STR8 or tag == T_STR32:
+        if tag == T_STR8:
+            size = buf[pos]
+            pos += 1
+        else:
+            size = _I.unpack_from(buf, pos)[0]
+            pos += 4
+        end = pos + size
+        if end > len(buf):
+            raise IndexError("string runs past the end of the payload")
+        value = buf[pos:end].decode()
+        if size <= REF_MAX_LEN and len(refs) < REF_TABLE_SIZE:
+            refs.append(value)
+        return value, end
+    if tag == T_LIST8 or tag == T_LIST32 or tag == T_DICT8 or tag == T_DICT32:
+        if depth >= MAX_DEPTH:  # before Python's own recursion limit is reached
+            raise ProtocolError("Binary payload nested too deeply.")
+        depth += 1
+        if tag == T_LIST8 or tag == T_DICT8:
+            count = buf[pos]
+            pos += 1
+        else:
+            count = _I.unpack_from(buf, pos)[0]
+            pos += 4
+        if tag == T_LIST8 or tag == T_LIST32:
+            items = []
+            for _ in range(count):
+                item, pos = _decode(buf, pos, refs, depth)
+                items.append(item)
+            return items, pos
+        result = {}
+        for _ in range(count):
+            key, pos = _decode(buf, pos, refs, depth)
+            result[key], pos = _decode(buf, pos, refs, depth)
+        return result, pos
+    if tag == T_INT8:
+        return _i8.unpack_from(buf, pos)[0], pos + 1
+    if tag == T_INT32:
+        return _i32.unpack_from(buf, pos)[0], pos + 4
+    if tag == T_FLOAT:
+        return _f64.unpack_from(buf, pos)[0], pos + 8
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_REF16:
+        return refs[_H.unpack_from(buf, pos)[0]], pos + 2
+    if tag == T_INT64:
+        return _i64.unpack_from(buf, pos)[0], pos + 8
+    if tag == T_BYTES8 or tag == T_BYTES32:
+        if tag == T_BYTES8:
+            size = buf[pos]
+            pos += 1
+        else:
+            size = _I.unpack_from(buf, pos)[0]
+            pos += 4
+        if pos + size > len(buf):
+            raise IndexError("bytes run past the end of the payload")
+        return bytes(buf[pos:pos + size]), pos + size
+    raise ProtocolError(f"Unknown value tag 0x{tag:02x}.")
+
+
+def decode_value(data: bytes):
+    """Inverse of encode_value(); raises ProtocolError on malformed input."""
+    try:
+        value, pos = _decode(data, 0, [])
+    except (IndexError, TypeError, struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed binary payload: {e}")
+    if pos != len(data):
+        raise ProtocolError("Trailing bytes after binary payload.")
+    return value
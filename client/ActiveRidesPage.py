@@ -1,19 +1,12 @@
 from PyQt5.QtWidgets import QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QFrame
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 import json
-from network import open_connection, send_request, close_connection
+from network import open_connection, send_request, subscribe, send_batch, close_connection
 from RatingPage import RatingPage
 from ChatWindow import ChatWindow
 
 
-def _fetch_rides(command, passenger_username):
-    conn = open_connection()
-    if not conn:
-        return [], "Unable to connect to server."
-
-    resp = send_request(conn, f"{command}:{passenger_username}")
-    close_connection(conn)
-
+def _parse_rides(resp):
     if not resp:
         return [], "Empty server response."
 
@@ -31,11 +24,22 @@ def _fetch_rides(command, passenger_username):
 
 
 def api_get_all_rides(passenger_username):
-    active, err = _fetch_rides("get_active_rides", passenger_username)
+    conn = open_connection()
+    if not conn:
+        return [], "Unable to connect to server."
+
+    # Both lists come back in a single round trip.
+    active_resp, completed_resp = send_batch(conn, [
+        f"get_active_rides:{passenger_username}",
+        f"get_completed_rides:{passenger_username}",
+    ])
+    close_connection(conn)
+
+    active, err = _parse_rides(active_resp)
     if err:
         return [], err
 
-    completed, err_completed = _fetch_rides("get_completed_rides", passenger_username)
+    completed, err_completed = _parse_rides(completed_resp)
     if err_completed:
         return active, f"Failed to load completed rides: {err_completed}"
 
@@ -52,6 +56,8 @@ def api_rate_driver_ride(passenger_username, driver_username, request_id, rating
 
 
 class ActiveRidesPage(QWidget):
+    event_received = pyqtSignal(dict)
+
     def __init__(self, passenger_username):
         super().__init__()
         self.passenger_username = passenger_username
@@ -92,8 +98,18 @@ class ActiveRidesPage(QWidget):
         main_layout.addStretch()
 
         self.setLayout(main_layout)
+
+        # Refresh when the server pushes a change to this user's rides.
+        self.event_received.connect(lambda _event: self.refresh_rows())
+        self.subscription = subscribe([f"user:{self.passenger_username}"], self.event_received.emit)
+
         self.refresh_rows()
 
+    def closeEvent(self, event):
+        if self.subscription is not None:
+            self.subscription.close()
+        super().closeEvent(event)
+
     def _header_label(self, text):
         lbl = QLabel(text)
         lbl.setStyleSheet("font-weight: bold;")
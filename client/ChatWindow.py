@@ -7,10 +7,9 @@ from PyQt5.QtWidgets import (
     QHBoxLayout,
     QLabel,
 )
-from PyQt5.QtCore import QTimer
-from network import open_connection, send_request, close_connection
+from PyQt5.QtCore import QTimer, pyqtSignal
+from network import open_connection, send_request, close_connection, call, supports_binary, subscribe
 import base64
-import json
 
 
 def api_fetch_messages(ride_id):
@@ -18,36 +17,35 @@ def api_fetch_messages(ride_id):
     if not conn:
         return [], "Unable to connect to server."
 
-    resp = send_request(conn, f"get_messages:{ride_id}")
+    status, data = call(conn, "get_messages", ride_id)
     close_connection(conn)
 
-    if not resp:
-        return [], "Empty server response."
+    if status == "success":
+        return data or [], None
 
-    if resp.startswith("success:"):
-        payload = resp.split(":", 1)[1]
-        try:
-            return json.loads(payload or "[]"), None
-        except json.JSONDecodeError:
-            return [], "Malformed message data."
+    if status == "error":
+        return [], data or "Server error."
 
-    if resp.startswith("error:"):
-        return [], resp.split(":", 1)[1] or "Server error."
-
-    return [], resp
+    return [], data or "Empty server response."
 
 
 def api_send_message(ride_id, sender, recipient, text):
     conn = open_connection()
     if not conn:
         return "Unable to connect to server."
-    encoded = base64.b64encode(text.encode()).decode()
-    resp = send_request(conn, f"send_message:{ride_id}:{sender}:{recipient}:{encoded}")
+    if supports_binary(conn):
+        # The binary codec carries the text as-is, no base64 needed.
+        _, resp = call(conn, "send_message", ride_id, sender, recipient, text)
+    else:
+        encoded = base64.b64encode(text.encode()).decode()
+        resp = send_request(conn, f"send_message:{ride_id}:{sender}:{recipient}:{encoded}")
     close_connection(conn)
     return resp or "No server response."
 
 
 class ChatWindow(QWidget):
+    event_received = pyqtSignal(dict)
+
     def __init__(self, ride_id, current_user, other_user, other_user_name=None):
         super().__init__()
         self.ride_id = ride_id
@@ -82,28 +80,41 @@ class ChatWindow(QWidget):
 
         self.setLayout(layout)
 
+        # New messages are pushed by the server; poll only if it can't push.
+        self.event_received.connect(self.on_event)
+        self.subscription = subscribe([f"ride:{ride_id}"], self.event_received.emit)
         self.timer = QTimer()
         self.timer.timeout.connect(self.load_messages)
-        self.timer.start(3000)
+        if self.subscription is None:
+            self.timer.start(3000)
 
         self.load_messages()
 
+    @staticmethod
+    def format_message(msg):
+        sender = msg.get("sender", "Unknown")
+        sender_name = msg.get("sender_name") or sender
+        text = msg.get("message", "")
+        timestamp = msg.get("timestamp", "")
+        return f"[{timestamp}] {sender_name}: {text}"
+
     def load_messages(self):
         messages, error = api_fetch_messages(self.ride_id)
         if error:
             self.log.setPlainText(f"Error loading messages: {error}")
             return
 
-        lines = []
-        for msg in messages:
-            sender = msg.get("sender", "Unknown")
-            sender_name = msg.get("sender_name") or sender
-            text = msg.get("message", "")
-            timestamp = msg.get("timestamp", "")
-            lines.append(f"[{timestamp}] {sender_name}: {text}")
+        lines = [self.format_message(msg) for msg in messages]
         self.log.setPlainText("\n".join(lines))
         self.log.moveCursor(self.log.textCursor().End)
 
+    def on_event(self, event):
+        if event.get("type") == "message":
+            self.log.append(self.format_message(event.get("message") or {}))
+            self.log.moveCursor(self.log.textCursor().End)
+        else:
+            self.load_messages()
+
     def send_message(self):
         text = self.input_field.text().strip()
         if not text:
@@ -111,11 +122,14 @@ class ChatWindow(QWidget):
         resp = api_send_message(self.ride_id, self.current_user, self.other_user, text)
         if resp.lower().startswith("message sent"):
             self.input_field.clear()
-            self.load_messages()
+            if self.subscription is None:
+                self.load_messages()
         else:
             self.log.append(f"\n[Error] {resp}")
 
     def closeEvent(self, event):
         if self.timer.isActive():
             self.timer.stop()
+        if self.subscription is not None:
+            self.subscription.close()
         super().closeEvent(event)
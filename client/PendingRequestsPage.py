@@ -1,7 +1,7 @@
 from PyQt5.QtWidgets import QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QFrame
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 import json
-from network import open_connection, send_request, close_connection
+from network import open_connection, send_request, subscribe, close_connection
 from RatingPage import RatingPage
 from ChatWindow import ChatWindow
 
@@ -66,6 +66,8 @@ def api_rate_passenger(passenger_username, rating):
 
 
 class PendingRequestsPage(QWidget):
+    event_received = pyqtSignal(dict)
+
     def __init__(self, driver_username, driver_name=None):
         super().__init__()
 
@@ -110,8 +112,17 @@ class PendingRequestsPage(QWidget):
         main_layout.addStretch(1)
         self.setLayout(main_layout)
 
+        # Refresh when the server pushes a change to this user's rides.
+        self.event_received.connect(lambda _event: self.refresh_rows())
+        self.subscription = subscribe([f"user:{self.driver_username}"], self.event_received.emit)
+
         self.refresh_rows()
 
+    def closeEvent(self, event):
+        if self.subscription is not None:
+            self.subscription.close()
+        super().closeEvent(event)
+
     def _header_label(self, text):
         lbl = QLabel(text)
         lbl.setStyleSheet("font-weight: bold;")
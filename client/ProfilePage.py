@@ -99,6 +99,9 @@ class ProfilePage(QWidget):
         self.buttons.setVisible(not self.make_editable)
 
     def save_profile(self):
+        if ":" in self.full_name_field.text():
+            QMessageBox.warning(self, "Invalid Name", "Your name cannot contain ':'.")
+            return
         self.person.full_name = self.full_name_field.text()
         self.person.email = self.email_field.text()
         self.person.area = self.area_field.text()
@@ -64,6 +64,10 @@ class RegisterWindow(QWidget):
             QMessageBox.warning(self, "Missing Info", "Please fill in all required fields.")
             return
 
+        if any(":" in field for field in (username, name, email, password)):
+            QMessageBox.warning(self, "Invalid Info", "Username, name, email and password cannot contain ':'.")
+            return
+
         message = f"register:{username}:{name}:{email}:{password}:{area}:{is_driver}"
         response = send_request(s,message)
         QMessageBox.information(self, "Server Response", response)
@@ -1,9 +1,11 @@
 from PyQt5.QtWidgets import QApplication
 import sys
 from LoginPage import LoginWindow
+from network import close_session
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(close_session)
     login_window = LoginWindow()
     login_window.show()
     sys.exit(app.exec_())
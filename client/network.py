@@ -1,25 +1,390 @@
+import json
+import select
 import socket
+import threading
+import time
+
+from protocol import (
+    FLAG_ACCEPT_COMPRESSED,
+    FLAG_BINARY,
+    FLAG_COMPRESSED,
+    FLAG_EVENT,
+    MAGIC,
+    FrameDecoder,
+    ProtocolError,
+    decode_value,
+    decompress_payload,
+    encode_frame,
+    encode_value,
+    recv_frame,
+)
 
 HOST = "5.tcp.eu.ngrok.io"
 PORT = 13482
+USE_FRAMING = True  # False falls back to the legacy one-request-per-connection protocol
+# True sends call() requests with the binary codec when the server supports
+# it: no base64 for chat text, but 2-4x slower to encode and decode than text.
+USE_BINARY = False
+MAX_BUSY_RETRIES = 2    # automatic retries when the server sheds a request
+MAX_BUSY_WAIT = 2.0     # longer "retry after" hints are returned to the caller instead
+# Commands that change nothing on the server, so a request whose reply was
+# lost can safely be sent again.
+READ_ONLY_COMMANDS = {"features", "login", "get_pending", "get_active_rides",
+                      "get_completed_rides", "get_messages", "stats", "metrics"}
+
+
+def _command_name(payload: bytes, flags: int) -> str:
+    try:
+        if flags & FLAG_BINARY:
+            return str(decode_value(payload)[0]).lower()
+        return payload.split(b":", 1)[0].decode().lower()
+    except (ProtocolError, IndexError, TypeError, UnicodeDecodeError):
+        return ""
+
+
+class Session:
+    """A persistent framed connection shared by every request of the client."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.decoder = None
+        self.features = set()
+        self.lock = threading.Lock()
+
+    @property
+    def binary(self) -> bool:
+        return "binary" in self.features
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Ask which protocol features the server speaks along with the preamble.
+        sock.sendall(MAGIC + encode_frame(b"features"))
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        frame = recv_frame(sock, self.decoder)
+        if frame is None:
+            raise ConnectionError("Server closed the connection.")
+        status, features = parse_reply(frame[1].decode())
+        self.features = set(features) if status == "success" else set()
+
+    def _roundtrip_many(self, frames) -> list:
+        extra = FLAG_ACCEPT_COMPRESSED if "compression" in self.features else 0
+        # Pipelined: write every request before reading the in-order replies.
+        self.sock.sendall(b"".join(encode_frame(p, flags | extra) for p, flags in frames))
+        replies = []
+        for _ in frames:
+            frame = recv_frame(self.sock, self.decoder)
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            flags, payload = frame
+            if flags & FLAG_COMPRESSED:
+                payload = decompress_payload(payload)
+            replies.append((flags & ~FLAG_COMPRESSED, payload))
+        return replies
+
+    def _closed_by_server(self) -> bool:
+        """Whether the server has closed the idle socket (EOF or reset waiting to be read)."""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and self.sock.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    def request_frames(self, frames) -> list:
+        """Send (payload, flags) frames and return the (flags, payload) replies.
+
+        A kept-alive socket the server closed while it sat idle (restart,
+        idle timeout) is replaced before anything is sent. Once the frames
+        are sent, a failure is retried only if every request is read-only:
+        the server may have run the others already (e.g. a graceful stop or
+        a write timeout closed the connection after the handler ran), and
+        they are not repeated behind the caller's back.
+        """
+        with self.lock:
+            if self.sock is not None and self._closed_by_server():
+                self._drop()
+            if self.sock is None:
+                self.connect()
+            try:
+                return self._roundtrip_many(frames)
+            except (OSError, ProtocolError):
+                self._drop()
+                if not all(_command_name(p, f) in READ_ONLY_COMMANDS for p, f in frames):
+                    raise
+                self.connect()
+                return self._roundtrip_many(frames)
+
+    def request_many(self, payloads) -> list:
+        return [p for _, p in self.request_frames([(p, 0) for p in payloads])]
+
+    def request(self, payload: bytes) -> bytes:
+        return self.request_many([payload])[0]
+
+    def _drop(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.decoder = None
+
+    def close(self):
+        with self.lock:
+            self._drop()
+
+
+_session = None
+_session_lock = threading.Lock()
+
 
 def open_connection():
-    """Establish a TCP connection to the server."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((HOST, PORT))
-    return s
+    """Return the client's persistent session (or a one-shot socket in legacy mode)."""
+    global _session
+    if not USE_FRAMING:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, PORT))
+        return s
+    with _session_lock:
+        if _session is None:
+            _session = Session(HOST, PORT)
+    with _session.lock:
+        if _session.sock is None:
+            _session.connect()
+    return _session
+
 
-def send_request(s: socket.socket, data: str):
-    """Send data to the server through the given socket."""
+def _busy_wait(status: str, data, attempt: int):
+    """Seconds to sleep before retrying a shed request, or None to give up."""
+    if status != "busy" or attempt >= MAX_BUSY_RETRIES:
+        return None
     try:
+        wait = float(data)
+    except (TypeError, ValueError):
+        return None
+    return wait if wait <= MAX_BUSY_WAIT else None
+
+
+def send_request(s, data: str):
+    """Send data to the server through the given connection and return the reply.
+
+    "busy:<seconds>" replies on a session are retried a couple of times
+    after the server's suggested delay.
+    """
+    try:
+        if isinstance(s, Session):
+            attempt = 0
+            while True:
+                resp = s.request(data.encode()).decode()
+                wait = _busy_wait(*parse_reply(resp), attempt) if resp.startswith("busy:") else None
+                if wait is None:
+                    return resp
+                time.sleep(wait)
+                attempt += 1
         s.sendall(data.encode())
-        response = s.recv(2048).decode()
-        return response
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode()
     except Exception as e:
         return f"Connection error: {e}"
-    
-def close_connection(s: socket.socket):
-    """Close the given socket connection."""
+
+
+def parse_reply(resp: str):
+    """Split a text reply into (status, data) like call() returns."""
+    if resp.startswith("success:"):
+        try:
+            return "success", json.loads(resp.split(":", 1)[1] or "null")
+        except json.JSONDecodeError:
+            return "error", "Malformed data from server."
+    if resp.startswith("error:"):
+        return "error", resp.split(":", 1)[1]
+    if resp.startswith("busy:"):
+        try:
+            return "busy", float(resp.split(":", 1)[1])
+        except ValueError:
+            pass
+    return "message", resp
+
+
+def supports_binary(s) -> bool:
+    """Whether call() sends requests on s with the binary codec (see USE_BINARY)."""
+    return USE_BINARY and isinstance(s, Session) and s.binary
+
+
+def call(s, command: str, *args):
+    """Run a command and return (status, data).
+
+    status is "success" (data is the decoded payload), "error" (data is the
+    error message), "message" (data is a plain reply string) or "busy" (data
+    is the server's retry-after hint, once automatic retries ran out).
+    Arguments are joined into a colon-delimited text request, or sent raw
+    with the binary codec if USE_BINARY is set and the server supports it.
+    """
+    if supports_binary(s):
+        frame = (encode_value([command, *args]), FLAG_BINARY)
+        attempt = 0
+        while True:
+            try:
+                (_, payload), = s.request_frames([frame])
+                status, data = decode_value(payload)
+            except Exception as e:
+                return "message", f"Connection error: {e}"
+            wait = _busy_wait(status, data, attempt)
+            if wait is None:
+                return status, data
+            time.sleep(wait)
+            attempt += 1
+    return parse_reply(send_request(s, ":".join([command, *map(str, args)])))
+
+
+def send_pipelined(s, commands):
+    """Send several commands back to back and return their replies in order."""
+    if not isinstance(s, Session):
+        # Legacy connections carry a single request each.
+        replies = []
+        for command in commands:
+            conn = open_connection()
+            replies.append(send_request(conn, command))
+            close_connection(conn)
+        return replies
+    try:
+        return [r.decode() for r in s.request_many([c.encode() for c in commands])]
+    except Exception as e:
+        return [f"Connection error: {e}" for _ in commands]
+
+
+def send_batch(s, commands):
+    """Run several commands in one server round trip via the batch command.
+
+    Returns one reply string per command. Servers without batch support get
+    the commands pipelined instead.
+    """
+    resp = send_request(s, "batch:" + json.dumps(list(commands)))
+    if resp.startswith("success:"):
+        try:
+            results = json.loads(resp.split(":", 1)[1])
+        except json.JSONDecodeError:
+            results = None
+        if isinstance(results, list) and len(results) == len(commands):
+            return results
+    if resp.startswith("Connection error"):
+        return [resp for _ in commands]
+    return send_pipelined(s, commands)
+
+
+class Subscription:
+    """A dedicated connection on which the server pushes events.
+
+    callback(event) is called on a background thread with each event dict.
+    If the connection drops it is re-established with backoff, and the
+    callback receives {"type": "resync"} because events may have been missed.
+    """
+
+    def __init__(self, topics, callback, host=None, port=None):
+        self.topics = list(topics)
+        self.callback = callback
+        self.host = host or HOST
+        self.port = port or PORT
+        self.sock = None
+        self._stop = threading.Event()
+        self._connect()  # fail fast so callers can fall back to polling
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = FrameDecoder()
+        frames = b"".join(encode_frame(f"subscribe:{t}".encode()) for t in self.topics)
+        sock.sendall(MAGIC + frames)
+        acks = 0
+        while acks < len(self.topics):
+            frame = recv_frame(sock, decoder)
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            flags, payload = frame
+            if flags & FLAG_EVENT:
+                self._deliver(payload)
+                continue
+            status, data = parse_reply(payload.decode())
+            if status != "success":
+                sock.close()
+                raise ConnectionError(f"Subscription refused: {data}")
+            acks += 1
+        self.sock, self.decoder = sock, decoder
+
+    def _deliver(self, payload: bytes):
+        try:
+            event = json.loads(payload.decode().split(":", 1)[1])
+        except (ValueError, IndexError):
+            return
+        self.callback(event)
+
+    def _run(self):
+        delay = 1.0
+        while not self._stop.is_set():
+            try:
+                if self.sock is None:
+                    self._connect()
+                    self.callback({"type": "resync"})
+                    delay = 1.0
+                while True:
+                    frame = recv_frame(self.sock, self.decoder)
+                    if frame is None:
+                        break
+                    if frame[0] & FLAG_EVENT:
+                        self._deliver(frame[1])
+            except (OSError, ProtocolError):
+                pass
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            if self._stop.wait(delay):
+                return
+            delay = min(delay * 2, 30.0)
+
+    def close(self):
+        self._stop.set()
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def subscribe(topics, callback):
+    """Start a Subscription, or return None if the server can't push events."""
+    if not USE_FRAMING:
+        return None
+    try:
+        session = open_connection()
+        if "subscribe" not in session.features:
+            return None
+        return Subscription(topics, callback, session.host, session.port)
+    except (OSError, ProtocolError):
+        return None
+
+
+def close_connection(s):
+    """Release a connection; the shared session stays open for the next request."""
+    if isinstance(s, Session):
+        return
     s.close()
 
+
+def close_session():
+    """Close the persistent session, e.g. when the application exits."""
+    if _session is not None:
+        _session.close()
+
+
 open_connection()
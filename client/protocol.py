@@ -0,0 +1,14 @@
+"""The AUBus wire protocol: a shim for aubus_protocol/ at the repository root.
+
+The server and the client share that one implementation; this module puts
+it on the import path so both keep importing "protocol".
+"""
+
+import os
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+from aubus_protocol import *  # noqa: E402,F401,F403
@@ -0,0 +1,126 @@
+"""Compare the text wire format with the binary codec.
+
+For a few representative payloads this prints the bytes on the wire and
+the encode/decode time of:
+  text   - "success:" + json.dumps(...) responses, base64 chat bodies
+  binary - protocol.encode_value()/decode_value()
+
+Usage: python bench_codec.py [--repeat N]
+"""
+
+import argparse
+import base64
+import json
+import timeit
+import uuid
+
+from protocol import decode_value, encode_value
+
+
+def _ride(i, status):
+    return {
+        "id": str(uuid.uuid4()),
+        "driver": f"driver{i}",
+        "driver_name": f"Driver Number {i}",
+        "area": "Hamra",
+        "day": "mon_commute",
+        "time": "08:00",
+        "status": status,
+        "passenger": "student42",
+        "passenger_name": "Student Forty Two",
+    }
+
+
+def login_payload(rides=40):
+    """A driver's login reply with full queues and ride histories."""
+    pending = [dict(_ride(i, "pending"), min_rating=3.5, accepted_by=None) for i in range(rides)]
+    return {
+        "username": "student42",
+        "name": "Student Forty Two",
+        "email": "student42@mail.aub.edu",
+        "area": "Hamra",
+        "is_driver": True,
+        "min_passenger_rating": 3.5,
+        "driver_rating": 4.73,
+        "passenger_rating": 4.9,
+        "pending_requests": pending,
+        "availability": {d: {"from": "08:00", "to": "17:30"}
+                         for d in ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")},
+        "active_rides": [_ride(i, "active") for i in range(rides // 4)],
+        "completed_rides": [_ride(i, "completed") for i in range(rides * 2)],
+    }
+
+
+def message_history(count=500):
+    return [
+        {
+            "sender": "student42" if i % 2 else "driver7",
+            "sender_name": "Student Forty Two" if i % 2 else "Driver Seven",
+            "recipient": "driver7" if i % 2 else "student42",
+            "message": f"Message {i}: I'll be at the main gate at 8:05, see you there!",
+            "timestamp": f"2026-10-17 08:{i % 60:02d}:00",
+        }
+        for i in range(count)
+    ]
+
+
+def text_response(data):
+    encode = lambda: ("success:" + json.dumps(data)).encode()
+    wire = encode()
+    decode = lambda: json.loads(wire.decode().split(":", 1)[1])
+    return encode, decode
+
+
+def binary_response(data):
+    encode = lambda: encode_value(["success", data])
+    wire = encode()
+    decode = lambda: decode_value(wire)
+    return encode, decode
+
+
+def text_send_message(body):
+    def encode():
+        encoded = base64.b64encode(body.encode()).decode()
+        return f"send_message:3f2b9c1e-ride:student42:driver7:{encoded}".encode()
+    wire = encode()
+    decode = lambda: base64.b64decode(wire.decode().split(":")[4]).decode()
+    return encode, decode
+
+
+def binary_send_message(body):
+    encode = lambda: encode_value(["send_message", "3f2b9c1e-ride", "student42", "driver7", body])
+    wire = encode()
+    decode = lambda: decode_value(wire)[4]
+    return encode, decode
+
+
+def measure(name, pair, repeat):
+    encode, decode = pair
+    size = len(encode())
+    enc_us = min(timeit.repeat(encode, number=repeat, repeat=3)) / repeat * 1e6
+    dec_us = min(timeit.repeat(decode, number=repeat, repeat=3)) / repeat * 1e6
+    print(f"  {name:<7} {size:>9,} B {enc_us:>11.1f} us {dec_us:>11.1f} us")
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    chat_body = "Running ten minutes late, traffic on Bliss street. " * 8
+    cases = [
+        ("login payload", text_response, binary_response, login_payload()),
+        ("message history (500)", text_response, binary_response, message_history()),
+        ("send_message request", text_send_message, binary_send_message, chat_body),
+    ]
+    for title, text_case, binary_case, data in cases:
+        print(f"{title}")
+        print(f"  {'format':<7} {'bytes':>11} {'encode':>14} {'decode':>14}")
+        text_size = measure("text", text_case(data), args.repeat)
+        binary_size = measure("binary", binary_case(data), args.repeat)
+        print(f"  binary/text size: {binary_size / text_size:.2f}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Driver matching from the database against the in-memory index (matching.py).
+
+Builds a throwaway database with populate.py (100k drivers by default),
+loads a MatchIndex and reports its load time and memory, then runs the
+same random searches (area, day, time, passenger rating, tolerance)
+through the indexed SQL query and through the index, checking that every
+answer is identical. Finally it changes the availability of some drivers
+through database.edit_fields, as update_availability does, and checks
+that the index caught up (verify() finds no difference).
+
+Usage: python bench_matching.py [--drivers 100000] [--users 120000] [--searches 5000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import database
+import matching
+import populate
+
+DAYS = ["mon", "tue", "wed", "thu", "fri"]
+
+
+def queries(rng, areas, count):
+    for _ in range(count):
+        hour, minute = rng.choice([7, 7, 8, 8, 16, 17, 17, 18]), rng.choice([0, 10, 15, 30, 45, 55])
+        yield (rng.choice(areas), f"{rng.choice(DAYS)}_commute", f"{hour:02d}:{minute:02d}",
+               rng.choice([0.0, 3.5, 4.5, 5.0]), rng.choice([0, 5, 15, 30]))
+
+
+def timed_searches(qs):
+    start = time.perf_counter()
+    results = [database.search_valid_drivers(*q) for q in qs]
+    return results, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=120000)
+    parser.add_argument("--searches", type=int, default=5000)
+    parser.add_argument("--updates", type=int, default=500, help="availability changes to apply")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        populate.main(["--db", db_path, "--users", str(args.users), "--drivers", str(args.drivers),
+                       "--history", "0", "--messages", "0"])
+        database.DB_FILE = db_path
+        database.init_db()
+        areas = list(populate.AREAS)
+
+        index = matching.MatchIndex()
+        index.load()
+        info = index.snapshot()
+        tracemalloc.start()  # a second, traced load just for its footprint
+        traced = matching.MatchIndex()
+        traced.load()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        traced.close()
+        del traced
+        print(f"index: {info['drivers']} drivers, {info['entries']} entries in {info['slots']} "
+              f"(area, day) slots, loaded in {info['load_seconds']:.2f}s, "
+              f"{memory / 1e6:.1f} MB")
+
+        qs = list(queries(rng, areas, args.searches))
+        print(f"{len(qs)} searches; microseconds per search, by tolerance:")
+        print(f"{'minutes':>8} {'matched':>8} {'database':>10} {'in-memory':>10} {'speedup':>8}")
+        mismatches = 0
+        for tolerance in sorted({q[4] for q in qs}):
+            group = [q for q in qs if q[4] == tolerance]
+            expected, db_seconds = timed_searches(group)
+            database.matcher = index
+            timed_searches(group)  # parse the matched drivers' commute times once
+            got, mem_seconds = timed_searches(group)
+            database.matcher = None
+            mismatches += sum(1 for a, b in zip(expected, got) if a != b)
+            matched = sum(len(r) for r in expected if isinstance(r, list)) / len(group)
+            print(f"{tolerance:>8} {matched:>8.1f} {db_seconds / len(group) * 1e6:>10.1f} "
+                  f"{mem_seconds / len(group) * 1e6:>10.1f} {db_seconds / mem_seconds:>7.1f}x")
+        print(f"differing answers: {mismatches}")
+
+        drivers = [f"driver{i}" for i in rng.sample(range(args.drivers), args.updates)]
+        for username in drivers:
+            start = f"{rng.randint(6, 9):02d}:{rng.choice(['00', '15', '30', '45'])}"
+            database.edit_fields(username, {"mon_commute": {"from": start, "to": "17:00"},
+                                            "min_passenger_rating": rng.choice([0.0, 4.0])})
+        start = time.perf_counter()
+        database.matcher = index
+        database.search_valid_drivers(areas[0], "mon_commute", "08:00")
+        catch_up = time.perf_counter() - start
+        database.matcher = None
+        stale = index.verify()
+        print(f"{len(drivers)} availability changes applied in {catch_up * 1000:.1f} ms; "
+              f"drivers differing from the database: {len(stale)}")
+        index.close()
+        database.close_connections()
+        return 1 if mismatches or stale else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
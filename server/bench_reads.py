@@ -0,0 +1,120 @@
+"""Database read throughput against the number of reader threads.
+
+Builds a throwaway database with populate.py, then for each --threads
+value runs that many threads calling the read paths the server serves
+most (login payloads, pending queues, driver search and chat history)
+for --seconds, optionally while a writer thread keeps appending chat
+messages and pending requests. Reads take no lock and, in WAL mode, do
+not wait for the writer; sqlite releases the GIL while it executes a
+statement, so throughput grows with threads up to the number of cores
+(on a single core it stays flat, which is the expected result there).
+
+Usage: python bench_reads.py [--threads 1 2 4 8] [--seconds 5] [--users 20000] [--writer]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import database
+import populate
+
+DAYS = ["mon", "tue", "wed", "thu", "fri"]
+
+
+def sample(db_path, count):
+    conn = sqlite3.connect(db_path)
+    try:
+        users = [r[0] for r in conn.execute(
+            "SELECT username FROM users WHERE is_driver=0 LIMIT ?", (count,))]
+        drivers = [r[0] for r in conn.execute(
+            "SELECT username FROM users WHERE is_driver=1 LIMIT ?", (count,))]
+        areas = [r[0] for r in conn.execute("SELECT DISTINCT area FROM users")]
+        rides = [r[0] for r in conn.execute(
+            "SELECT DISTINCT ride_id FROM ride_messages LIMIT ?", (count,))]
+    finally:
+        conn.close()
+    return users, drivers, areas, rides or ["none"]
+
+
+def reader(seed, data, stop, counts):
+    users, drivers, areas, rides = data
+    rng = random.Random(seed)
+    done = 0
+    while not stop.is_set():
+        op = rng.random()
+        if op < 0.4:
+            database.get_login_payload(rng.choice(users), "pw")
+        elif op < 0.7:
+            database.get_pending_requests(rng.choice(drivers))
+        elif op < 0.8:
+            database.search_valid_drivers(rng.choice(areas), f"{rng.choice(DAYS)}_commute", "08:00")
+        else:
+            database.get_ride_messages(rng.choice(rides))
+        done += 1
+    counts.append(done)
+
+
+def writer(data, stop, counts):
+    users, drivers, _, rides = data
+    rng = random.Random(0)
+    done = 0
+    while not stop.is_set():
+        if rng.random() < 0.5:
+            database.add_ride_message(rng.choice(rides), rng.choice(users), rng.choice(drivers), "hi")
+        else:
+            database.add_pending_request(rng.choice(drivers), {"id": f"bench-{done}",
+                                                               "passenger": rng.choice(users)})
+        done += 1
+    counts.append(done)
+
+
+def run(threads, seconds, data, with_writer):
+    stop = threading.Event()
+    reads, writes = [], []
+    workers = [threading.Thread(target=reader, args=(i, data, stop, reads)) for i in range(threads)]
+    if with_writer:
+        workers.append(threading.Thread(target=writer, args=(data, stop, writes)))
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return sum(reads) / elapsed, sum(writes) / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--users", type=int, default=20000, help="users in the throwaway database")
+    parser.add_argument("--writer", action="store_true", help="run a writer thread alongside")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        populate.main(["--db", db_path, "--users", str(args.users)])
+        database.DB_FILE = db_path
+        database.init_db()
+        data = sample(db_path, 2000)
+
+        print(f"{os.cpu_count()} CPU(s); {args.users} users"
+              f"{', with a concurrent writer' if args.writer else ''}")
+        print(f"{'threads':>8} {'reads/s':>10} {'per thread':>11} {'writes/s':>9}")
+        for threads in args.threads:
+            reads, writes = run(threads, args.seconds, data, args.writer)
+            print(f"{threads:>8} {reads:>10.0f} {reads / threads:>11.0f} {writes:>9.0f}")
+        database.close_connections()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Throughput of the server against the number of worker processes.
+
+For each --processes value this starts server.py on a throwaway database,
+seeds it with drivers, passengers, pending requests and chat history, then
+drives it from several client processes, each with several framed
+connections sending one request at a time. The mix is mostly logins (the
+largest JSON payloads), pending/ride/chat reads and some chat writes.
+
+Usage: python bench_workers.py [--processes 1 2 4] [--clients 8] [--seconds 10]
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from protocol import MAGIC, FrameDecoder, encode_frame, recv_frame
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AREAS = ["Hamra", "Achrafieh", "Verdun", "Jounieh", "Baabda"]
+
+
+def connect(port):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(MAGIC)
+    return sock, FrameDecoder()
+
+
+def request(conn, message: str) -> str:
+    sock, decoder = conn
+    sock.sendall(encode_frame(message.encode()))
+    _, payload = recv_frame(sock, decoder)
+    return payload.decode()
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on port {port}.")
+
+
+def seed(port, drivers, passengers):
+    """Register users, publish availability and queue ride requests; return ride ids."""
+    conn = connect(port)
+    for i in range(drivers):
+        area = AREAS[i % len(AREAS)]
+        request(conn, f"register:driver{i}:Driver {i}:d{i}@mail.aub.edu:pw:{area}:1")
+        request(conn, f"update_availability:driver{i}:07.00-18.00;07.00-18.00;07.00-18.00;;;;:0")
+    for i in range(passengers):
+        area = AREAS[i % len(AREAS)]
+        request(conn, f"register:student{i}:Student {i}:s{i}@mail.aub.edu:pw:{area}:0")
+        request(conn, f"request_ride:student{i}:{area}:mon:07:00:0")
+    rides = []
+    for i in range(drivers):
+        reply = request(conn, f"get_pending:driver{i}")
+        if reply.startswith("success:") and '"id": "' in reply:
+            rides.append(reply.split('"id": "', 1)[1].split('"', 1)[0])
+    if not rides:
+        raise RuntimeError("Seeding produced no ride requests.")
+    body = base64.b64encode(b"On my way, see you at the main gate.").decode()
+    for ride in rides:
+        for _ in range(20):
+            request(conn, f"send_message:{ride}:student0:driver0:{body}")
+    conn[0].close()
+    return rides
+
+
+def client(port, connections, seconds, drivers, passengers, rides, seed_value, results):
+    rng = random.Random(seed_value)
+    body = base64.b64encode(b"Running five minutes late.").decode()
+    mix = [
+        (40, lambda: f"login:student{rng.randrange(passengers)}:pw"),
+        (20, lambda: f"get_pending:driver{rng.randrange(drivers)}"),
+        (15, lambda: f"get_active_rides:student{rng.randrange(passengers)}"),
+        (20, lambda: f"get_messages:{rng.choice(rides)}"),
+        (5, lambda: f"send_message:{rng.choice(rides)}:student0:driver0:{body}"),
+    ]
+    weights = [w for w, _ in mix]
+    conns = [connect(port) for _ in range(connections)]
+    done = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        # Round-robin the connections so each one is a closed-loop client.
+        for conn in conns:
+            _, make = rng.choices(mix, weights)[0]
+            request(conn, make())
+            done += 1
+    for sock, _ in conns:
+        sock.close()
+    results.put(done)
+
+
+def run(processes, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "server.py"), "--port", str(args.port),
+             "--db", os.path.join(tmp, "bench.db"), "--processes", str(processes)],
+            cwd=tmp, stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(args.port)
+            rides = seed(args.port, args.drivers, args.passengers)
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=client, args=(
+                    args.port, args.connections, args.seconds, args.drivers,
+                    args.passengers, rides, i, results))
+                for i in range(args.clients)
+            ]
+            start = time.monotonic()
+            for w in workers:
+                w.start()
+            total = sum(results.get(timeout=args.seconds + 60) for _ in workers)
+            elapsed = time.monotonic() - start
+            for w in workers:
+                w.join()
+        finally:
+            server.terminate()
+            server.wait()
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8, help="client processes")
+    parser.add_argument("--connections", type=int, default=4, help="connections per client")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--passengers", type=int, default=200)
+    parser.add_argument("--port", type=int, default=12399)
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} {'req/s':>10} {'speedup':>8}")
+    base = None
+    for processes in args.processes:
+        rate = run(processes, args)
+        base = base or rate
+        print(f"{processes:>9} {rate:>10.0f} {rate / base:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Traffic capture for record-and-replay benchmarking.
+
+With server.py --record FILE every request is appended to FILE:
+
+    MAGIC, version byte, then one frame (protocol.HEADER + payload) per
+    request whose payload is encode_value([micros, conn, mode, request])
+
+micros is the time since recording started, conn numbers the client
+connection, mode is MODE_LEGACY, MODE_TEXT or MODE_BINARY, and request is
+[command, *args] (text arguments as strings, binary ones as sent).
+
+Requests are anonymized using each command's Arg.sensitive markers:
+usernames (also inside subscription topics and batches) become stable
+salted hashes, names/emails are derived from those, passwords become
+REPLAY_PASSWORD, and chat bodies are replaced by filler of the same
+length. Unknown commands keep only their name.
+
+The request thread only enqueues the raw frame; parsing, anonymizing and
+writing happen on a background thread. replay.py reads captures back.
+"""
+
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+import stats
+from commands import COMMANDS, ArgumentError
+from protocol import (
+    FLAG_BINARY,
+    FLAG_COMPRESSED,
+    FrameDecoder,
+    ProtocolError,
+    decode_value,
+    decompress_payload,
+    encode_frame,
+    encode_value,
+)
+
+MAGIC = b"AUBC"
+VERSION = 1
+MODE_LEGACY, MODE_TEXT, MODE_BINARY = 0, 1, 2
+REPLAY_PASSWORD = "pw"  # every captured password is replaced by this
+MAX_PENDING = 50000     # raw requests queued for the writer before dropping
+
+
+class Anonymizer:
+    def __init__(self, salt: bytes):
+        self._salt = salt
+        self._cache = {}
+
+    def user(self, name: str) -> str:
+        anon = self._cache.get(name)
+        if anon is None:
+            digest = hmac.new(self._salt, name.encode(), hashlib.sha256).hexdigest()
+            anon = self._cache[name] = "u" + digest[:12]
+        return anon
+
+    def value(self, kind, value, text: bool, username: str):
+        if kind is None or not isinstance(value, str):
+            return value
+        if kind == "user":
+            return self.user(value)
+        if kind == "password":
+            return REPLAY_PASSWORD
+        if kind == "personal":
+            # Keep emails unique (the users table requires it) and names plausible.
+            return f"{username}@example.invalid" if "@" in value else f"User {username}"
+        if kind == "text":
+            if text:
+                try:
+                    size = len(base64.b64decode(value.encode(), validate=True))
+                except ValueError:
+                    return value
+                return base64.b64encode(b"x" * size).decode()
+            return "x" * len(value)
+        if kind == "topic":
+            prefix, _, rest = value.partition(":")
+            return f"user:{self.user(rest)}" if prefix == "user" else value
+        return value
+
+    def request(self, name: str, args: list, text: bool) -> list:
+        cmd = COMMANDS.get(name.lower())
+        if cmd is None:
+            return [name]
+        if cmd.name == "batch" and args:
+            try:
+                subcommands = json.loads(args[0])
+            except ValueError:
+                return [name]
+            if not isinstance(subcommands, list):
+                return [name]
+            return [name, json.dumps([self.text(c) for c in subcommands if isinstance(c, str)])]
+        username = next((self.user(v) for a, v in zip(cmd.args, args)
+                         if a.sensitive == "user" and isinstance(v, str)), "anon")
+        out = [name]
+        for i, value in enumerate(args):
+            kind = cmd.args[i].sensitive if i < len(cmd.args) else None
+            out.append(self.value(kind, value, text, username))
+        return out
+
+    def text(self, message: str) -> str:
+        """Anonymize a colon-delimited request, returning it in the same form."""
+        name, sep, raw = message.partition(":")
+        cmd = COMMANDS.get(name.lower())
+        if cmd is None or not sep:
+            return name
+        try:
+            args = cmd.split(raw)
+        except ArgumentError:
+            return name
+        return ":".join(self.request(name, args, True))
+
+
+class Recorder:
+    def __init__(self, path: str, salt: bytes = None):
+        """salt keys the username hashes; captures made with the same salt
+        (the FILE.i of one --processes server) name a user the same way."""
+        self.path = path
+        self._anon = Anonymizer(salt or os.urandom(16))
+        self._queue = queue.SimpleQueue()
+        self._start = time.monotonic()
+        self._conns = itertools.count(1)
+        self.recorded = 0
+        self.dropped = 0
+        # Timestamps restart with every recording, so never append to an old one.
+        self._out = open(path, "xb")
+        self._out.write(MAGIC + bytes((VERSION,)))
+        self._out.flush()
+        self._writer = threading.Thread(target=self._write_loop, name="capture-writer", daemon=True)
+        self._writer.start()
+        stats.register_source("capture", self.snapshot)
+
+    def new_connection(self) -> int:
+        return next(self._conns)
+
+    def record(self, conn: int, flags: int, payload: bytes):
+        """Queue one framed request (flags as received)."""
+        if self._queue.qsize() >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._queue.put((time.monotonic(), conn, flags, payload))
+
+    def record_legacy(self, conn: int, message: bytes):
+        self.record(conn, None, message)
+
+    def _convert(self, record):
+        ts, conn, flags, payload = record
+        micros = int((ts - self._start) * 1e6)
+        if flags is None:
+            mode, text = MODE_LEGACY, True
+        else:
+            if flags & FLAG_COMPRESSED:
+                payload = decompress_payload(payload)
+            mode, text = (MODE_BINARY, False) if flags & FLAG_BINARY else (MODE_TEXT, True)
+        if text:
+            message = payload.decode()
+            name, sep, raw = message.partition(":")
+            cmd = COMMANDS.get(name.lower())
+            try:
+                args = cmd.split(raw if sep else None) if cmd is not None else []
+            except ArgumentError:
+                args = []
+            request = self._anon.request(name, args, True)
+        else:
+            value = decode_value(payload)
+            if not isinstance(value, list) or not value or not isinstance(value[0], str):
+                return None
+            request = self._anon.request(value[0], value[1:], False)
+        return encode_frame(encode_value([micros, conn, mode, request]))
+
+    def _write_loop(self):
+        with self._out as out:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    out.flush()
+                    return
+                try:
+                    frame = self._convert(record)
+                except (ProtocolError, UnicodeDecodeError, ValueError):
+                    frame = None
+                if frame is not None:
+                    out.write(frame)
+                    self.recorded += 1
+                if self._queue.empty():
+                    out.flush()
+
+    def close(self, timeout: float = 5.0):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout)
+
+    def snapshot(self) -> dict:
+        return {"file": self.path, "recorded": self.recorded, "dropped": self.dropped,
+                "pending": self._queue.qsize()}
+
+
+def read_capture(path: str):
+    """Yield (micros, conn, mode, request) for each request in a capture file."""
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC) + 1)
+        if head[:len(MAGIC)] != MAGIC:
+            raise ProtocolError(f"{path} is not an AUBus capture.")
+        if head[len(MAGIC)] != VERSION:
+            raise ProtocolError(f"Unsupported capture version {head[len(MAGIC)]}.")
+        decoder = FrameDecoder()
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            decoder.feed(chunk)
+            while True:
+                frame = decoder.next_frame()
+                if frame is None:
+                    break
+                yield tuple(decode_value(frame[1]))
+        # A partial record left in the decoder means the server was killed
+        # mid-write; it is ignored.
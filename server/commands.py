@@ -0,0 +1,264 @@
+"""Command registry and dispatcher.
+
+Every server command is a Command object registered under its name. A
+request is split once into name and argument text; the name is looked up
+in COMMANDS (one dict lookup) and the arguments are parsed against the
+command's declared Arg schema before the handler is called.
+
+Handlers can live in any module: decorate them with @command(...) and make
+sure the module is imported before the server starts (see handlers.py).
+
+A handler returns either a plain message string or a Reply. Replies are
+rendered as "success:<json>" / "error:<message>" for text requests and as
+[status, data] for binary ones, so structured data is never JSON-encoded
+on the binary path.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import log
+import ratelimit
+import tracing
+from metrics import metrics
+from workers import PRIORITY_READ
+
+GENERIC_ERROR = "Error processing request. Connection closing.\n"
+
+
+class ArgumentError(Exception):
+    """Raised when a request's arguments don't match the command schema."""
+
+
+class Arg:
+    """One positional, colon-separated argument of a command.
+
+    convert turns the raw value into the handler's value. text_decode, if
+    given, is applied first on text requests only (e.g. base64 bodies that
+    binary requests send raw). A greedy argument may itself contain colons;
+    each command can declare at most one. In a text request no other
+    argument can: a colon there is taken as a separator and silently shifts
+    the later fields, so free text before the greedy argument (names,
+    usernames) is refused when it contains one (see handlers._no_colon).
+    If conversion fails, error (when given) is sent back to the client.
+
+    sensitive marks values that must not leave the server as-is, e.g. in a
+    traffic capture: "user" (a username), "password", "personal" (name or
+    email), "text" (a chat body) or "topic" (a subscription topic).
+    """
+
+    __slots__ = ("name", "convert", "greedy", "error", "text_decode", "sensitive")
+
+    def __init__(self, name: str, convert=str, greedy: bool = False, error: str = None,
+                 text_decode=None, sensitive: str = None):
+        self.name = name
+        self.convert = convert
+        self.greedy = greedy
+        self.error = error
+        self.text_decode = text_decode
+        self.sensitive = sensitive
+
+    def value(self, raw, text: bool):
+        try:
+            if text and self.text_decode is not None:
+                raw = self.text_decode(raw)
+            return self.convert(raw)
+        except (ValueError, TypeError):
+            if self.error is None:
+                raise
+            raise ArgumentError(self.error)
+
+
+class Failure(str):
+    """A plain message reply reporting a failure: sent like any message, counted as an error."""
+
+    __slots__ = ()
+
+
+class Reply:
+    """Structured handler result; status is "success" or "error"."""
+
+    __slots__ = ("status", "data")
+
+    def __init__(self, status: str, data):
+        self.status = status
+        self.data = data
+
+    @classmethod
+    def from_result(cls, result):
+        """Database getters return data on success and a message string on error."""
+        if isinstance(result, str):
+            return cls("error", str(result))
+        return cls("success", result)
+
+    def to_text(self) -> str:
+        if self.status == "success":
+            return "success:" + json.dumps(self.data)
+        return f"{self.status}:{self.data}"
+
+
+def render_text(result) -> str:
+    return result.to_text() if isinstance(result, Reply) else result
+
+
+def render_value(result) -> list:
+    if isinstance(result, Reply):
+        return [result.status, result.data]
+    return ["message", result]
+
+
+class Command:
+    """A named command: its argument schema and the handler that serves it.
+
+    priority is the worker-pool queue priority (see workers.py); rate_class
+    is the token bucket class it is limited by (see ratelimit.py), None for
+    unlimited commands.
+    """
+
+    __slots__ = ("name", "args", "handler", "usage_error", "priority", "rate_class",
+                 "_greedy", "_user_arg")
+
+    def __init__(self, name: str, handler, args=(), usage_error: str = None,
+                 priority: int = PRIORITY_READ, rate_class: str = "read"):
+        self.name = name.lower()
+        self.handler = handler
+        self.args = tuple(args)
+        self.usage_error = usage_error or GENERIC_ERROR
+        self.priority = priority
+        self.rate_class = rate_class
+        greedy = [i for i, a in enumerate(self.args) if a.greedy]
+        if len(greedy) > 1:
+            raise ValueError(f"Command {name!r} declares more than one greedy argument.")
+        self._greedy = greedy[0] if greedy else None
+        # The request acts as the user named by its first "user" argument.
+        users = [i for i, a in enumerate(self.args) if a.sensitive == "user"]
+        self._user_arg = users[0] if users else None
+
+    def split(self, raw):
+        """Split the argument text into one raw string per declared Arg."""
+        count = len(self.args)
+        if count == 0:
+            return []
+        if raw is None:
+            raise ArgumentError(self.usage_error)
+
+        g = self._greedy
+        if g is None:
+            # Trailing extra fields are ignored, as the old parser did.
+            parts = raw.split(":", count)[:count]
+        else:
+            head = raw.split(":", g)
+            if len(head) < g + 1:
+                raise ArgumentError(self.usage_error)
+            rest = head.pop()
+            after = count - g - 1
+            tail = rest.rsplit(":", after) if after else [rest]
+            parts = head + tail
+        if len(parts) < count:
+            raise ArgumentError(self.usage_error)
+        return parts
+
+    def parse(self, raw):
+        """Convert colon-delimited argument text into handler values."""
+        return [arg.value(text, True) for arg, text in zip(self.args, self.split(raw))]
+
+    def parse_values(self, raw_values):
+        """Convert already-typed binary request arguments into handler values."""
+        if len(raw_values) < len(self.args):
+            raise ArgumentError(self.usage_error)
+        return [arg.value(v, False) for arg, v in zip(self.args, raw_values)]
+
+
+COMMANDS = {}
+_context = threading.local()  # per-request state visible to handlers
+
+
+def register(cmd: Command) -> Command:
+    if cmd.name in COMMANDS:
+        raise ValueError(f"Command {cmd.name!r} is already registered.")
+    COMMANDS[cmd.name] = cmd
+    return cmd
+
+
+def command(name: str, *args: Arg, usage_error: str = None, priority: int = PRIORITY_READ,
+            rate_class: str = "read"):
+    """Decorator registering a handler function under a command name."""
+    def decorator(handler):
+        register(Command(name, handler, args, usage_error, priority, rate_class))
+        return handler
+    return decorator
+
+
+def command_priority(name: str) -> int:
+    cmd = COMMANDS.get(name.lower())
+    return cmd.priority if cmd is not None else PRIORITY_READ
+
+
+@contextmanager
+def connection_context(channel, client: str = None):
+    """Expose the requesting connection's push channel and IP address to handlers."""
+    _context.channel = channel
+    _context.client = client
+    try:
+        yield
+    finally:
+        _context.channel = None
+        _context.client = None
+
+
+def current_channel():
+    """Push channel of the connection being served, or None (legacy requests)."""
+    return getattr(_context, "channel", None)
+
+
+def current_client():
+    """IP address of the client being served, if the server passed it."""
+    return getattr(_context, "client", None)
+
+
+def _run(name: str, parse, raw):
+    cmd = COMMANDS.get(name.lower())
+    if cmd is None:
+        metrics.observe("invalid", 0.0, error=True)
+        return "Invalid command."
+    start = time.perf_counter()
+    error = True
+    try:
+        with tracing.request(cmd.name):
+            try:
+                with tracing.span("parse"):
+                    values = parse(cmd, raw)
+            except ArgumentError as e:
+                return str(e)
+            if ratelimit.limiter is not None and cmd.rate_class is not None:
+                user = values[cmd._user_arg] if cmd._user_arg is not None else None
+                wait = ratelimit.limiter.check(cmd.rate_class, user, current_client())
+                if wait:
+                    error = False  # counted by aubus_rate_limited_total instead
+                    return Reply("busy", wait)
+            result = cmd.handler(*values)
+            if isinstance(result, Failure):
+                return str(result)
+            error = isinstance(result, Reply) and result.status == "error"
+            return result
+    except Exception as e:
+        log.error("command.failed", exc_info=True, command=cmd.name, error=str(e),
+                  request_id=tracing.current_request_id())
+        return GENERIC_ERROR
+    finally:
+        metrics.observe(cmd.name, time.perf_counter() - start, error)
+
+
+def dispatch(message: str) -> str:
+    """Parse and run one colon-delimited request, returning the reply text."""
+    name, sep, raw = message.partition(":")
+    return render_text(_run(name, Command.parse, raw if sep else None))
+
+
+def dispatch_value(request) -> list:
+    """Run one binary request ([command, *args]) and return [status, data]."""
+    if not isinstance(request, list) or not request or not isinstance(request[0], str):
+        return ["error", "Malformed request."]
+    return render_value(_run(request[0], Command.parse_values, request[1:]))
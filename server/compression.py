@@ -0,0 +1,77 @@
+"""Opt-in zlib compression of large framed replies.
+
+Clients flag requests with FLAG_ACCEPT_COMPRESSED; replies of at least
+COMPRESS_THRESHOLD bytes are then deflated when that makes them smaller.
+The ratio and CPU cost are tracked per command and reported under
+"compression" by the stats command.
+"""
+
+import threading
+import time
+import zlib
+
+import stats
+from commands import COMMANDS
+from protocol import FLAG_COMPRESSED
+
+COMPRESS_THRESHOLD = 1024  # bytes; 0 disables compression
+COMPRESS_LEVEL = 6         # zlib level, 1 (fast) .. 9 (small)
+
+
+class CompressionStats:
+    """Per-command totals of compressed replies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_command = {}
+
+    def record(self, command: str, raw_bytes: int, sent_bytes: int, cpu_seconds: float):
+        with self._lock:
+            entry = self._by_command.get(command)
+            if entry is None:
+                entry = self._by_command[command] = [0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += raw_bytes
+            entry[2] += sent_bytes
+            entry[3] += cpu_seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            items = [(name, list(entry)) for name, entry in self._by_command.items()]
+        result = {}
+        for name, (count, raw_bytes, sent_bytes, cpu) in items:
+            result[name] = {
+                "responses": count,
+                "raw_bytes": raw_bytes,
+                "sent_bytes": sent_bytes,
+                "ratio": round(sent_bytes / raw_bytes, 4) if raw_bytes else None,
+                "cpu_ms": round(cpu * 1000, 3),
+                "cpu_us_per_kb": round(cpu * 1e6 / (raw_bytes / 1024), 2) if raw_bytes else None,
+            }
+        return result
+
+
+compression_stats = CompressionStats()
+stats.register_source("compression", compression_stats.snapshot)
+
+
+def compress_reply(command: str, payload: bytes, flags: int):
+    """Return (payload, flags), deflated if the reply is large enough to gain."""
+    if COMPRESS_THRESHOLD <= 0 or len(payload) < COMPRESS_THRESHOLD:
+        return payload, flags
+
+    start = time.thread_time()
+    packed = zlib.compress(payload, COMPRESS_LEVEL)
+    cpu = time.thread_time() - start
+
+    command = command.lower()
+    keep = len(packed) < len(payload)
+    compression_stats.record(
+        command if command in COMMANDS else "invalid",
+        len(payload),
+        len(packed) if keep else len(payload),
+        cpu,
+    )
+    if keep:
+        return packed, flags | FLAG_COMPRESSED
+    return payload, flags
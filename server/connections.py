@@ -0,0 +1,168 @@
+"""Connection limits and read/write deadlines.
+
+Every client connection is registered in `table` while it is open, with
+a state that says which deadline applies to it:
+
+  reading  a request (or the connection preamble) has started arriving
+           but is incomplete                          READ_TIMEOUT
+  idle     a keep-alive connection waits for its next request
+                                                      IDLE_TIMEOUT
+  writing  a reply is being written to the client     WRITE_TIMEOUT
+  working  the request is being served; no deadline
+
+A reaper thread wakes every REAP_INTERVAL seconds and closes connections
+that overstayed their state through the close callback they registered
+(shutting down a thread-per-connection socket wakes its blocked recv or
+sendall; asyncio transports are aborted on their loop). Reaped connections
+are counted in metrics by kind. Connections with subscriptions are exempt
+from the idle deadline, since push clients are idle by design; a stalled
+subscriber is dropped by pubsub's backlog limit instead.
+
+open() refuses connections beyond MAX_CONNECTIONS, so stalled clients
+cannot pin an unbounded number of threads. A limit or timeout of 0
+disables it. drain() implements the connection side of graceful shutdown.
+"""
+
+import threading
+import time
+
+import log
+import metrics
+import stats
+
+MAX_CONNECTIONS = 1000
+IDLE_TIMEOUT = 300.0  # seconds between requests on a keep-alive connection
+READ_TIMEOUT = 30.0   # seconds to receive a request once it has started
+WRITE_TIMEOUT = 30.0  # seconds for the client to accept a reply
+REAP_INTERVAL = 1.0
+
+IDLE, READING, WORKING, WRITING = "idle", "reading", "working", "writing"
+
+
+class Tracked:
+    """One open connection's state; the serving code moves it along."""
+
+    __slots__ = ("addr", "state", "since", "channel", "_close")
+
+    def __init__(self, addr, close):
+        self.addr = addr
+        self.state = READING  # the preamble is due right after connecting
+        self.since = time.monotonic()
+        self.channel = None   # set for framed connections (pubsub channel)
+        self._close = close
+
+    def _set(self, state: str):
+        self.state = state
+        self.since = time.monotonic()
+
+    def idle(self):
+        self._set(IDLE)
+
+    def reading(self):
+        if self.state != READING:
+            self._set(READING)
+
+    def working(self):
+        self._set(WORKING)
+
+    def writing(self):
+        self._set(WRITING)
+
+
+class ConnectionTable:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = set()
+        self._reaper = None
+        self.draining = False  # set by drain(): handlers stop after their current reply
+        self.rejected = 0
+        self.reaped = 0
+
+    def open(self, addr, close):
+        """Register a connection; None if MAX_CONNECTIONS are already open."""
+        with self._lock:
+            if MAX_CONNECTIONS and len(self._open) >= MAX_CONNECTIONS:
+                self.rejected += 1
+                rejected = True
+            else:
+                tracked = Tracked(addr, close)
+                self._open.add(tracked)
+                rejected = False
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, name="reaper", daemon=True)
+                self._reaper.start()
+        if rejected:
+            metrics.metrics.connection_rejected()
+            log.warning("connection.rejected", addr=addr, limit=MAX_CONNECTIONS)
+            return None
+        return tracked
+
+    def release(self, tracked):
+        with self._lock:
+            self._open.discard(tracked)
+
+    def drain(self, timeout: float) -> int:
+        """Close idle connections and wait for the rest to finish their request.
+
+        Serving loops check `draining` before waiting for another request,
+        so busy connections close on their own after replying. Whatever is
+        still open after timeout seconds is closed; returns how many were.
+        """
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        closed = set()
+        while True:
+            with self._lock:
+                if not self._open:
+                    return 0
+                expired = time.monotonic() >= deadline
+                victims = [t for t in self._open
+                           if t not in closed and (expired or t.state == IDLE)]
+            for tracked in victims:
+                closed.add(tracked)
+                try:
+                    tracked._close()
+                except (OSError, RuntimeError):
+                    pass
+            if expired:
+                return len(victims)
+            time.sleep(0.05)
+
+    def _expired(self, now: float):
+        limits = {IDLE: IDLE_TIMEOUT, READING: READ_TIMEOUT, WRITING: WRITE_TIMEOUT}
+        expired = []
+        with self._lock:
+            for tracked in self._open:
+                limit = limits.get(tracked.state)
+                if not limit or now - tracked.since < limit:
+                    continue
+                if tracked.state == IDLE and tracked.channel is not None and tracked.channel.topics:
+                    continue
+                expired.append((tracked, tracked.state))
+            for tracked, _ in expired:
+                self._open.discard(tracked)
+        return expired
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            for tracked, state in self._expired(time.monotonic()):
+                self.reaped += 1
+                metrics.metrics.timeout(state)
+                log.info("connection.timeout", addr=tracked.addr, state=state)
+                try:
+                    tracked._close()
+                except (OSError, RuntimeError):  # already closed / loop gone
+                    pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            states = {}
+            for tracked in self._open:
+                states[tracked.state] = states.get(tracked.state, 0) + 1
+            return {"open": len(self._open), "max": MAX_CONNECTIONS, "states": states,
+                    "rejected": self.rejected, "reaped": self.reaped, "draining": self.draining}
+
+
+table = ConnectionTable()
+stats.register_source("connections", table.snapshot)
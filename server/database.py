@@ -1,15 +1,289 @@
+import os
 import sqlite3
+import sys
 import threading
+import time
 import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import Tuple, List, Dict, Any
 
+import log
+import stats
+import tracing
+from commands import Failure
+from metrics import metrics
+from tracing import traced
+
 DB_FILE = "AUBus.db"  # Database file name
-db_lock = threading.RLock()  # Reentrant lock prevents nested DB operations from deadlocking
+DB_TIMEOUT = 10.0  # seconds a write waits for another connection's write transaction
+PRAGMAS = {  # applied to every new connection; server.py --db-pragma adds more
+    "cache_size": "-8000",  # KiB of page cache per connection
+    "temp_store": "MEMORY",
+    "synchronous": "NORMAL",  # safe with WAL: a crash can lose the last commits, not corrupt
+}
+HEALTH_CHECK_INTERVAL = 30.0  # seconds a cached connection may sit unused before it is pinged
+COMMUTE_COLUMNS = ("mon_commute", "tue_commute", "wed_commute", "thu_commute",
+                   "fri_commute", "sat_commute", "sun_commute")
+MATCH_TOLERANCE = 15  # minutes a driver's commute time may be off the requested time
+MIGRATION_BATCH = 200  # users whose pending_requests blob is migrated per transaction
+FANOUT_LIMIT = 10  # best-ranked drivers a ride request is offered to, at first and per widening (0: all)
+QUEUE_CAP = 50  # pending (not accepted) requests a driver's queue holds; full drivers are passed over (0: no cap)
+FANOUT_WIDEN_AFTER = 120.0  # seconds without an accept before a request goes to the next drivers (0: never)
+WIDEN_CHECK_INTERVAL = 5.0  # seconds between checks for requests to widen
+WIDEN_BATCH = 100  # requests widened per check at most
+REQUEST_MAX_AGE = 3600.0  # seconds after which a request is no longer widened (0: no limit)
+RANK_MINUTE_COST = 0.1  # rating points one minute of commute time difference costs a driver
+RANK_QUEUE_COST = 0.2  # rating points each request already in a driver's queue costs
+
+# Fields of a pending request, as stored in ride_requests and returned by get_pending.
+REQUEST_FIELDS = ("id", "passenger", "passenger_name", "area", "day", "time",
+                  "min_rating", "status", "accepted_by")
+CHANGE_LOG_KEEP = 10000  # commute_changes rows kept for in-memory matchers to catch up from
+
+# users columns that driver matching results depend on
+_COMMUTE_SOURCES = {"name", "area", "is_driver", "min_passenger_rating", *COMMUTE_COLUMNS}
+_RANK_CHUNK = 500  # usernames per IN (...) query, well under sqlite's variable limit
+# Requests waiting in a driver's queue for an accept; accepted rides stay
+# queued until completed but do not count against QUEUE_CAP.
+_PENDING_COUNT_SQL = """
+SELECT COUNT(*) FROM driver_requests d JOIN ride_requests r ON r.id = d.request_id
+WHERE d.driver = ? AND r.status = 'pending'
+"""
+_QUEUE_SQL = f"""
+SELECT {", ".join("r." + f for f in REQUEST_FIELDS)}
+FROM driver_requests d JOIN ride_requests r ON r.id = d.request_id
+WHERE d.driver = ?
+ORDER BY d.seq
+"""
+
+
+class ConnectionCache:
+    """One persistent sqlite connection per thread, reused by every call.
+
+    Opening a connection (and parsing the schema on first use) used to
+    happen on every database call, several times per request. Now each
+    thread keeps its connection, with PRAGMAS applied once. On checkout a
+    connection is replaced if DB_FILE changed or the process forked, and
+    one unused for HEALTH_CHECK_INTERVAL seconds is pinged first; a
+    transaction left open by a failed call is rolled back. The number of
+    connections is bounded by the number of threads doing database work
+    (the server's worker pool). close_all() closes them at shutdown.
+
+    Connections are opened with check_same_thread=False only so that
+    close_all() and pruning can close them; each is used by its own thread.
+
+    The database runs in WAL mode, so reads never wait: each statement
+    outside a transaction sees the last committed state, even while
+    another connection writes. Writes go through transaction(), which
+    starts with BEGIN IMMEDIATE: sqlite lets one connection at a time (in
+    any thread or process) hold the write lock and makes the others wait
+    up to DB_TIMEOUT for it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = {}  # thread -> connection
+        self.opened = 0
+        self.reused = 0
+        self.replaced = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def get(self):
+        entry = getattr(self._local, "entry", None)
+        if getattr(self._local, "depth", 0):
+            return entry[0]  # inside transaction(): keep using its connection
+        now = time.monotonic()
+        if entry is not None:
+            conn, path, pid, last_used = entry
+            if path == DB_FILE and pid == os.getpid() and self._usable(conn, now - last_used):
+                entry[3] = now
+                self.reused += 1
+                return conn
+            self.replaced += 1
+            self._forget(conn, close=pid == os.getpid())
+        conn = self._open()
+        self._local.entry = [conn, DB_FILE, os.getpid(), now]
+        return conn
+
+    def _usable(self, conn, idle: float) -> bool:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if idle >= HEALTH_CHECK_INTERVAL:
+                conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            log.warning("db.connection_unhealthy", error=str(e))
+            return False
+
+    def _open(self):
+        conn = sqlite3.connect(DB_FILE, timeout=DB_TIMEOUT, factory=tracing.connection_factory(),
+                               check_same_thread=False)
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        thread = threading.current_thread()
+        with self._lock:
+            self.opened += 1
+            dead = [t for t in self._conns if not t.is_alive()]
+            stale = [self._conns.pop(t) for t in dead]
+            self._conns[thread] = conn
+        for old in stale:
+            old.close()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block as one write transaction on this thread's connection.
+
+        Commits when the block ends and rolls back if it raises. Nested
+        blocks (a write function calling another) join the outer
+        transaction, so the whole operation commits or fails as one.
+        """
+        local = self._local
+        if getattr(local, "depth", 0):
+            local.depth += 1
+            try:
+                yield local.entry[0]
+            finally:
+                local.depth -= 1
+            return
+        conn = self.get()
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        end = time.perf_counter()
+        metrics.db_lock_wait.observe(end - start)
+        tracing.add_span("db_lock.wait", "lock", start, end)
+        local.depth = 1
+        local.on_commit = []
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            local.depth = 0
+            callbacks, local.on_commit = local.on_commit, []
+        for callback in callbacks:
+            callback()
+
+    def in_transaction(self) -> bool:
+        """Whether this thread is inside a transaction() block."""
+        return bool(getattr(self._local, "depth", 0))
+
+    def after_commit(self, callback):
+        """Call callback once the current transaction commits (now if there is none)."""
+        if getattr(self._local, "depth", 0):
+            self._local.on_commit.append(callback)
+        else:
+            callback()
+
+    def _forget(self, conn, close: bool):
+        with self._lock:
+            thread = threading.current_thread()
+            if self._conns.get(thread) is conn:
+                del self._conns[thread]
+        if close:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def _after_fork(self):
+        # Connections must not cross fork(); the child opens its own.
+        self._lock = threading.Lock()
+        self._conns = {}
+
+    def close_all(self):
+        """Close every cached connection (at shutdown, once requests have finished)."""
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            open_now = len(self._conns)
+        return {"open": open_now, "opened": self.opened, "reused": self.reused,
+                "replaced": self.replaced, "pragmas": dict(PRAGMAS)}
+
+
+connections = ConnectionCache()
+stats.register_source("db_connections", connections.snapshot)
+_listeners = []  # callables notified of committed writes, see add_listener()
+matcher = None  # matching.MatchIndex answering search_valid_drivers, when enabled
+_migrator = None  # background thread of start_migration()
+_migration_stop = threading.Event()
+_widener = None  # background thread of start_widening()
+_widening_stop = threading.Event()
+
+
+def _connect():
+    """Return this thread's persistent connection (see ConnectionCache).
+
+    Reads use it as is: `with conn:` would commit, ending the transaction
+    of a write function the read is made from.
+    """
+    return connections.get()
+
+
+def close_connections():
+    _migration_stop.set()
+    _widening_stop.set()
+    if _migrator is not None:
+        _migrator.join()  # at most one batch
+    if _widener is not None:
+        _widener.join()  # at most one request
+    connections.close_all()
+
+
+def write_transaction():
+    """Context manager: one BEGIN IMMEDIATE transaction for a write function."""
+    return connections.transaction()
+
+
+def add_listener(listener):
+    """Register listener(event: str, data: dict), called after a write commits.
+
+    Events: "message", "pending_added", "request_accepted",
+    "request_completed" and "request_expired" (a pending request was
+    dropped unaccepted). Listeners run on the writing thread and must not block.
+    """
+    _listeners.append(listener)
+
+
+def _emit(event: str, **data):
+    connections.after_commit(lambda: _notify(event, data))
+
+
+def _notify(event: str, data: dict):
+    for listener in _listeners:
+        try:
+            listener(event, data)
+        except Exception as e:
+            log.error("db.listener_failed", exc_info=True, event=event, error=str(e))
+
+
+def _db_error(e: sqlite3.Error) -> str:
+    """Log a failed database call and return the message sent to the client."""
+    log.error("db.error", function=sys._getframe(1).f_code.co_name, error=str(e))
+    return Failure(f"Database error: {e}")
+
 
- 
 def init_db():
     """Create the users table if it doesn't exist."""
-    with sqlite3.connect(DB_FILE) as conn:
+    with _connect() as conn:
+        # WAL is a property of the database file: set once, kept by every connection.
+        conn.execute("PRAGMA journal_mode=WAL")
         c = conn.cursor()
 
         # Create user table storing all user details
@@ -45,11 +319,13 @@ def init_db():
 
     ensure_extra_columns()
     ensure_messages_table()
+    ensure_ride_requests_tables()
+    ensure_commutes_table()
 
 
 def ensure_extra_columns():
     """Ensure new columns exist for active/completed rides."""
-    with sqlite3.connect(DB_FILE) as conn:
+    with _connect() as conn:
         c = conn.cursor()
         c.execute("PRAGMA table_info(users)")
         columns = [row[1] for row in c.fetchall()]
@@ -61,7 +337,7 @@ def ensure_extra_columns():
 
 
 def ensure_messages_table():
-    with sqlite3.connect(DB_FILE) as conn:
+    with _connect() as conn:
         c = conn.cursor()
         c.execute("""
         CREATE TABLE IF NOT EXISTS ride_messages (
@@ -73,9 +349,111 @@ def ensure_messages_table():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_ride_messages_ride "
+                  "ON ride_messages (ride_id, created_at, id)")
         conn.commit()
 
 
+def ensure_ride_requests_tables():
+    """Create the normalized pending-request tables.
+
+    ride_requests holds every requested ride once; driver_requests fans it
+    out to the queues of the drivers it was offered to, seq giving queue
+    order. They replace the users.pending_requests JSON blobs, which
+    migrate_pending_requests() empties; the partial index finds the blobs
+    still to be moved.
+
+    Requests from offer_ride_request() carry offered_at, the time of their
+    last fan-out, and list every driver they were offered to in
+    ride_offers; widen_ride_requests() offers them to further drivers
+    while they wait for an accept.
+    """
+    with _connect() as conn:
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS ride_requests (
+            id TEXT PRIMARY KEY,
+            passenger TEXT,
+            passenger_name TEXT,
+            area TEXT,
+            day TEXT,
+            time TEXT,
+            min_rating REAL NOT NULL DEFAULT 0.0,
+            status TEXT NOT NULL DEFAULT 'pending',             -- pending / active
+            accepted_by TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            offered_at REAL                                     -- last fan-out; NULL: not widened
+        )
+        """)
+        c.execute("PRAGMA table_info(ride_requests)")
+        if "offered_at" not in [row[1] for row in c.fetchall()]:
+            c.execute("ALTER TABLE ride_requests ADD COLUMN offered_at REAL")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS driver_requests (
+            seq INTEGER PRIMARY KEY,                            -- queue order
+            driver TEXT NOT NULL,
+            request_id TEXT NOT NULL,
+            UNIQUE (driver, request_id)
+        )
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS ride_offers (
+            request_id TEXT NOT NULL,
+            driver TEXT NOT NULL,
+            PRIMARY KEY (request_id, driver)
+        ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_driver_requests_request "
+                  "ON driver_requests (request_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_ride_requests_status ON ride_requests (status)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_ride_requests_widen ON ride_requests (offered_at) "
+                  "WHERE status = 'pending' AND offered_at IS NOT NULL")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_pending_blob "
+                  "ON users (username) WHERE pending_requests <> '[]'")
+        conn.commit()
+
+
+def ensure_commutes_table():
+    """Create driver_commutes, the searchable copy of drivers' *_commute columns.
+
+    One row per commute time: (driver, weekday, direction "from"/"to",
+    minute of day), with the driver's area and min_passenger_rating copied
+    in so that idx_driver_commutes_match covers search_valid_drivers.
+    register_user and edit_fields keep it in sync; a database that
+    predates the table is filled when it is created.
+
+    Every change is also appended to commute_changes (driver NULL: all of
+    them), from which in-memory matchers in any process catch up (see
+    matching.py). Only the last CHANGE_LOG_KEEP entries are kept.
+    """
+    with write_transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS commute_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            driver TEXT
+        )
+        """)
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='driver_commutes'")
+        if c.fetchone():
+            return
+        c.execute("""
+        CREATE TABLE driver_commutes (
+            driver TEXT NOT NULL,
+            day TEXT NOT NULL,                                  -- mon ... sun
+            direction TEXT NOT NULL,                            -- from / to
+            minute INTEGER NOT NULL,                            -- minutes since midnight
+            area TEXT,
+            min_rating REAL NOT NULL DEFAULT 0.0
+        )
+        """)
+        c.execute("CREATE INDEX idx_driver_commutes_match "
+                  "ON driver_commutes (day, area, minute, min_rating, driver)")
+        c.execute("CREATE INDEX idx_driver_commutes_driver ON driver_commutes (driver)")
+        rebuild_commutes()
+
+
+@traced
 def register_user(
     username: str,
     name: str,
@@ -94,58 +472,58 @@ def register_user(
         "thu_commute", "fri_commute", "sat_commute", "sun_commute"
     ]
 
-    with db_lock:  # Lock DB to avoid race conditions
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-
-                # If passenger → no commute schedule & no rating filter
-                if is_driver != 1:
-                    commute_schedule = {d: [] for d in days}  # empty list for each day
-                    min_passenger_rating = 0.0
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+
+            # If passenger → no commute schedule & no rating filter
+            if is_driver != 1:
+                commute_schedule = {d: [] for d in days}  # empty list for each day
+                min_passenger_rating = 0.0
+            else:
+                # Ensure schedule dict exists for all days
+                if commute_schedule is None:
+                    commute_schedule = {d: [] for d in days}
                 else:
-                    # Ensure schedule dict exists for all days
-                    if commute_schedule is None:
-                        commute_schedule = {d: [] for d in days}
-                    else:
-                        for d in days:
-                            commute_schedule.setdefault(d, [])
-
-                # Convert schedule dictionaries into JSON strings
-                commute_values = [json.dumps(commute_schedule[d]) for d in days]
-
-                # Insert the new user into the database
-                c.execute("""
-                INSERT INTO users (
-                    username, name, email, password, area, is_driver,
-                    min_passenger_rating,
-                    driver_rating, driver_rating_count,
-                    passenger_rating, passenger_rating_count,
-                    mon_commute, tue_commute, wed_commute, thu_commute,
-                    fri_commute, sat_commute, sun_commute,
-                    active_rides, completed_rides
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    username, name, email, password, area, is_driver,
-                    float(min_passenger_rating),
-                    5.0, 1,            # driver rating + count
-                    5.0, 1,            # passenger rating + count
-                    *commute_values,   # unpack commute schedule JSON
-                    "[]", "[]"
-                ))
+                    for d in days:
+                        commute_schedule.setdefault(d, [])
+
+            # Convert schedule dictionaries into JSON strings
+            commute_values = [json.dumps(commute_schedule[d]) for d in days]
+
+            # Insert the new user into the database
+            c.execute("""
+            INSERT INTO users (
+                username, name, email, password, area, is_driver,
+                min_passenger_rating,
+                driver_rating, driver_rating_count,
+                passenger_rating, passenger_rating_count,
+                mon_commute, tue_commute, wed_commute, thu_commute,
+                fri_commute, sat_commute, sun_commute,
+                active_rides, completed_rides
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                username, name, email, password, area, is_driver,
+                float(min_passenger_rating),
+                5.0, 1,            # driver rating + count
+                5.0, 1,            # passenger rating + count
+                *commute_values,   # unpack commute schedule JSON
+                "[]", "[]"
+            ))
 
-                conn.commit()  # Save DB
+            if is_driver == 1:
+                _sync_commutes(c, username)
 
-            return "User registered successfully."
+        return "User registered successfully."
 
-        except sqlite3.IntegrityError as e:  # duplicate username or email
-            if "UNIQUE" in str(e):
-                return "Username or email already exists."
-            return f"Database error: {e}"
+    except sqlite3.IntegrityError as e:  # duplicate username or email
+        if "UNIQUE" in str(e):
+            return Failure("Username or email already exists.")
+        return _db_error(e)
 
-        except sqlite3.Error as e:  # generic SQLite error
-            return f"Database error: {e}"
+    except sqlite3.Error as e:  # generic SQLite error
+        return _db_error(e)
 
 
 def _normalize_commute_entry(raw_value):
@@ -169,97 +547,110 @@ def _normalize_commute_entry(raw_value):
     return {"from": None, "to": None}
 
 
+@traced
 def login_user(username: str, password: str) -> str:
     """Validate username/password and return packed user info."""
+    payload = get_login_payload(username, password)
+    if isinstance(payload, str):
+        return "error:" + payload
+
+    # Return JSON payload to client
+    return "success:" + json.dumps(payload)
+
+
+@traced
+def get_login_payload(username: str, password: str):
+    """Validate username/password and return the user info dict (or an error message)."""
+
+    conn = _connect()
+    c = conn.cursor()
+
+    # Retrieve user info
+    c.execute("""
+    SELECT *
+    FROM users WHERE username=?
+    """, (username,))
+
+    row = c.fetchone()
+
+    # User does not exist
+    if not row:
+        return Failure("User not found.")
+
+    (username_db, name, email, stored_pw, area, is_driver,
+     min_passenger_rating,
+     driver_rating, driver_rating_count, pending_requests,
+     passenger_rating, passenger_rating_count,
+     mon_commute, tue_commute, wed_commute, thu_commute,
+        fri_commute, sat_commute, sun_commute, active_rides_json, completed_rides_json) = row
+
+    # Password incorrect
+    if stored_pw != password:
+        return Failure("Incorrect password.")
+
+    if pending_requests != "[]":  # not migrated yet
+        with write_transaction() as wconn:
+            _migrate_queue(wconn.cursor(), username_db)
+    pending_list = _queue(c, username_db)
+
+    day_map = [
+        ("Mon", mon_commute),
+        ("Tue", tue_commute),
+        ("Wed", wed_commute),
+        ("Thu", thu_commute),
+        ("Fri", fri_commute),
+        ("Sat", sat_commute),
+        ("Sun", sun_commute),
+    ]
 
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-
-        # Retrieve user info
-        c.execute("""
-        SELECT *
-        FROM users WHERE username=?
-        """, (username,))
-
-        row = c.fetchone()
-
-        # User does not exist
-        if not row:
-            return "error:User not found."
-
-        (username_db, name, email, stored_pw, area, is_driver,
-         min_passenger_rating,
-         driver_rating, driver_rating_count, pending_requests,
-         passenger_rating, passenger_rating_count,
-         mon_commute, tue_commute, wed_commute, thu_commute,
-            fri_commute, sat_commute, sun_commute, active_rides_json, completed_rides_json) = row
-
-        # Password incorrect
-        if stored_pw != password:
-            return "error:Incorrect password."
-
-        try:
-            pending_list = json.loads(pending_requests or "[]")
-        except json.JSONDecodeError:
-            pending_list = []
-
-        day_map = [
-            ("Mon", mon_commute),
-            ("Tue", tue_commute),
-            ("Wed", wed_commute),
-            ("Thu", thu_commute),
-            ("Fri", fri_commute),
-            ("Sat", sat_commute),
-            ("Sun", sun_commute),
-        ]
+    availability = {day: _normalize_commute_entry(raw) for day, raw in day_map}
 
-        availability = {day: _normalize_commute_entry(raw) for day, raw in day_map}
+    try:
+        active_rides = json.loads(active_rides_json or "[]")
+    except json.JSONDecodeError:
+        active_rides = []
 
-        try:
-            active_rides = json.loads(active_rides_json or "[]")
-        except json.JSONDecodeError:
-            active_rides = []
+    try:
+        completed_rides = json.loads(completed_rides_json or "[]")
+    except json.JSONDecodeError:
+        completed_rides = []
+
+    payload = {
+        "username": username_db,
+        "name": name,
+        "email": email,
+        "area": area,
+        "is_driver": bool(is_driver),
+        "min_passenger_rating": min_passenger_rating,
+        "driver_rating": driver_rating,
+        "passenger_rating": passenger_rating,
+        "pending_requests": pending_list,
+        "availability": availability,
+        "active_rides": active_rides,
+        "completed_rides": completed_rides
+    }
 
-        try:
-            completed_rides = json.loads(completed_rides_json or "[]")
-        except json.JSONDecodeError:
-            completed_rides = []
-
-        payload = {
-            "username": username_db,
-            "name": name,
-            "email": email,
-            "area": area,
-            "is_driver": bool(is_driver),
-            "min_passenger_rating": min_passenger_rating,
-            "driver_rating": driver_rating,
-            "passenger_rating": passenger_rating,
-            "pending_requests": pending_list,
-            "availability": availability,
-            "active_rides": active_rides,
-            "completed_rides": completed_rides
-        }
-
-        # Return JSON payload to client
-        return "success:" + json.dumps(payload)
+    return payload
 
 
+@traced
 def get_user_display_name(username: str) -> str:
     """Return the stored full name for a username (falling back to username)."""
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT name FROM users WHERE username=?", (username,))
-        row = c.fetchone()
-        if row and row[0]:
-            return row[0]
+    conn = _connect()
+    c = conn.cursor()
+    c.execute("SELECT name FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if row and row[0]:
+        return row[0]
     return username
 
 
+@traced
 def edit_fields(username: str, fields: Dict[str, Any]) -> str:
     """Update specific user fields (except ratings)."""
 
     if not fields:
-        return "No fields provided to update."
+        return Failure("No fields provided to update.")
 
     # List of editable columns
     valid_columns = {
@@ -272,7 +663,7 @@ def edit_fields(username: str, fields: Dict[str, Any]) -> str:
     updates = {k: v for k, v in fields.items() if k in valid_columns}
 
     if not updates:
-        return "No valid fields to update."
+        return Failure("No valid fields to update.")
 
     # Convert commute schedule lists to JSON strings
     for d in updates:
@@ -285,107 +676,173 @@ def edit_fields(username: str, fields: Dict[str, Any]) -> str:
     # Build value list for SQL
     values = list(updates.values()) + [username]
 
-    with db_lock:  # Lock DB for safety
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
 
-                # Update user
-                c.execute(f"UPDATE users SET {set_clause} WHERE username=?", values)
-                conn.commit()
+            # Update user
+            c.execute(f"UPDATE users SET {set_clause} WHERE username=?", values)
 
-                # If no rows were affected → user does not exist
-                if c.rowcount == 0:
-                    return "User not found."
+            # If no rows were affected → user does not exist
+            if c.rowcount == 0:
+                return Failure("User not found.")
 
-                return "User updated successfully."
+            # Keep the searchable commute rows in step with the user row
+            if updates.keys() & _COMMUTE_SOURCES:
+                _sync_commutes(c, username)
 
-        except sqlite3.IntegrityError as e:
-            if "UNIQUE" in str(e):  # email already used
-                return "Email already exists."
-            return f"Database error: {e}"
+            return "User updated successfully."
 
-        except sqlite3.Error as e:  # generic DB error
-            return f"Database error: {e}"
+    except sqlite3.IntegrityError as e:
+        if "UNIQUE" in str(e):  # email already used
+            return Failure("Email already exists.")
+        return _db_error(e)
 
+    except sqlite3.Error as e:  # generic DB error
+        return _db_error(e)
 
-def search_valid_drivers(area: str, day: str, time: str, min_rating: float = 0.0):
-    """Find drivers in an area who have a commute time that exactly matches the given time."""
 
-    valid_days = [
-        "mon_commute", "tue_commute", "wed_commute",
-        "thu_commute", "fri_commute", "sat_commute", "sun_commute"
-    ]
+def _commute_windows(raw_value) -> list:
+    """(direction, "HH:MM") pairs of one stored *_commute value, in stored order."""
+    try:
+        commute_data = json.loads(raw_value or "[]")
+    except (json.JSONDecodeError, TypeError):
+        return []
 
-    if day not in valid_days:
-        return "Invalid day provided."
+    windows = []
 
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
+    # Case 1: stored as a single object {"from": "...", "to": "..."}
+    if isinstance(commute_data, dict):
+        commute_data = [commute_data]
 
-                # Query drivers in the area who allow passengers with >= min_rating
-                c.execute(f"""
-                SELECT username, name, area, {day}, min_passenger_rating
-                FROM users
-                WHERE is_driver = 1
-                  AND area = ?
-                  AND min_passenger_rating <= ?
-                """, (area, min_rating))
-
-                matched_drivers = []
-
-                for username, name, ar, commute_json, req_rating in c.fetchall():
-                    # Parse commute JSON safely
-                    try:
-                        commute_data = json.loads(commute_json or "[]")
-                    except:
-                        commute_data = []
-
-                    #
-                    # ---- Normalize commute data into a flat list of expected-times ----
-                    #
-                    commute_times = []
-
-                    # Case 1: stored as a single object {"from": "...", "to": "..."}
-                    if isinstance(commute_data, dict):
-                        if "from" in commute_data:
-                            commute_times.append(commute_data["from"])
-                        if "to" in commute_data:
-                            commute_times.append(commute_data["to"])
-
-                    # Case 2: stored as a list
-                    elif isinstance(commute_data, list):
-                        for entry in commute_data:
-
-                            # ["08:00", "20:00"] format
-                            if isinstance(entry, list) and len(entry) == 2:
-                                commute_times.extend(entry)
-
-                            # {"from": "...", "to": "..."} format
-                            elif isinstance(entry, dict):
-                                if "from" in entry:
-                                    commute_times.append(entry["from"])
-                                if "to" in entry:
-                                    commute_times.append(entry["to"])
-
-                    #
-                    # ---- Check if requested time EXACTLY matches any commute time ----
-                    #
-                    if time in commute_times:
-                        matched_drivers.append({
-                            "username": username,
-                            "name": name,
-                            "area": ar,
-                            "min_passenger_rating": req_rating,
-                            "commute_times": commute_times
-                        })
-
-                return "No valid drivers found." if not matched_drivers else matched_drivers
+    # Case 2: stored as a list
+    if isinstance(commute_data, list):
+        for entry in commute_data:
 
-        except sqlite3.Error as e:
-            return f"Database error: {e}"
+            # ["08:00", "20:00"] format
+            if isinstance(entry, list) and len(entry) == 2:
+                windows += [("from", entry[0]), ("to", entry[1])]
+
+            # {"from": "...", "to": "..."} format
+            elif isinstance(entry, dict):
+                windows += [(d, entry[d]) for d in ("from", "to") if d in entry]
+
+    return windows
+
+
+def _minute_of_day(value):
+    """Minutes since midnight of an "HH:MM" string, or None if it is not one."""
+    try:
+        hour, minute = str(value).split(":")
+        hour, minute = int(hour), int(minute)
+    except ValueError:
+        return None
+    if 0 <= hour < 24 and 0 <= minute < 60:
+        return hour * 60 + minute
+    return None
+
+
+def _sync_commutes(c, username: str):
+    """Rewrite a user's driver_commutes rows from their users row (in a write transaction)."""
+    _log_commute_change(c, username)
+    c.execute("DELETE FROM driver_commutes WHERE driver=?", (username,))
+    c.execute(f"""
+    SELECT area, min_passenger_rating, {", ".join(COMMUTE_COLUMNS)}
+    FROM users WHERE username=? AND is_driver=1
+    """, (username,))
+    row = c.fetchone()
+    if row:
+        c.executemany(
+            "INSERT INTO driver_commutes (driver, day, direction, minute, area, min_rating) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            _commute_rows(username, *row),
+        )
+
+
+def _log_commute_change(c, username):
+    c.execute("INSERT INTO commute_changes (driver) VALUES (?)", (username,))
+    if c.lastrowid % 1000 == 0:
+        c.execute("DELETE FROM commute_changes WHERE id <= ?", (c.lastrowid - CHANGE_LOG_KEEP,))
+
+
+def _commute_rows(username, area, min_rating, *commutes):
+    for column, raw in zip(COMMUTE_COLUMNS, commutes):
+        for direction, value in _commute_windows(raw):
+            minute = _minute_of_day(value)
+            if minute is not None:
+                yield username, column[:3], direction, minute, area, min_rating
+
+
+def rebuild_commutes():
+    """Refill driver_commutes from every driver's users row (e.g. after a bulk load)."""
+    with write_transaction() as conn:
+        c = conn.cursor()
+        _log_commute_change(c, None)
+        c.execute("DELETE FROM driver_commutes")
+        users = conn.execute(f"""
+        SELECT username, area, min_passenger_rating, {", ".join(COMMUTE_COLUMNS)}
+        FROM users WHERE is_driver=1
+        """)
+        c.executemany(
+            "INSERT INTO driver_commutes (driver, day, direction, minute, area, min_rating) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (r for user in users for r in _commute_rows(*user)),
+        )
+
+
+@traced
+def search_valid_drivers(area: str, day: str, time: str, min_rating: float = 0.0,
+                         tolerance: int = None):
+    """Find drivers in an area with a commute time within tolerance minutes of the given time.
+
+    tolerance defaults to MATCH_TOLERANCE. Drivers are ranked by how far
+    their closest commute time is from the requested one (minutes_off),
+    then by username.
+    """
+
+    if day not in COMMUTE_COLUMNS:
+        return Failure("Invalid day provided.")
+
+    minute = _minute_of_day(time)
+    if minute is None:
+        return "No valid drivers found."
+    if tolerance is None:
+        tolerance = MATCH_TOLERANCE
+    if matcher is not None:
+        return matcher.search(area, day, minute, min_rating, tolerance)
+
+    try:
+        conn = _connect()
+        c = conn.cursor()
+
+        # Drivers in the area leaving or returning within the window who allow
+        # passengers with >= min_rating: one range of idx_driver_commutes_match
+        c.execute(f"""
+        SELECT u.username, u.name, u.area, u.{day}, u.min_passenger_rating,
+               MIN(ABS(dc.minute - ?)) AS minutes_off
+        FROM driver_commutes dc JOIN users u ON u.username = dc.driver
+        WHERE dc.day = ? AND dc.area = ? AND dc.minute BETWEEN ? AND ?
+          AND dc.min_rating <= ?
+        GROUP BY dc.driver
+        ORDER BY minutes_off, dc.driver
+        """, (minute, day[:3], area, minute - tolerance, minute + tolerance, min_rating))
+
+        matched_drivers = [
+            {
+                "username": username,
+                "name": name,
+                "area": ar,
+                "min_passenger_rating": req_rating,
+                "commute_times": [t for _, t in _commute_windows(commute_json)],
+                "minutes_off": minutes_off,
+            }
+            for username, name, ar, commute_json, req_rating, minutes_off in c.fetchall()
+        ]
+
+        return "No valid drivers found." if not matched_drivers else matched_drivers
+
+    except sqlite3.Error as e:
+        return _db_error(e)
 
 
 def calculate_rating(current: float, count: int, new: float) -> Tuple[float, int]:
@@ -405,501 +862,767 @@ def _rate_user(username: str, new_rating: float, role: str) -> str:
     rating_col = f"{role}_rating"               # column storing rating value
     count_col = f"{role}_rating_count"          # column storing rating count
 
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-
-                # Fetch current rating and count
-                c.execute(f"""
-                SELECT {rating_col}, {count_col}
-                FROM users
-                WHERE username=?
-                """, (username,))
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
 
-                row = c.fetchone()
+            # Fetch current rating and count
+            c.execute(f"""
+            SELECT {rating_col}, {count_col}
+            FROM users
+            WHERE username=?
+            """, (username,))
 
-                # User not found
-                if not row:
-                    return "User not found."
+            row = c.fetchone()
 
-                current, count = row
+            # User not found
+            if not row:
+                return Failure("User not found.")
 
-                # Recalculate rating
-                new_avg, new_count = calculate_rating(current, count, new_rating)
+            current, count = row
 
-                # Update the database with new rating
-                c.execute(f"""
-                UPDATE users
-                SET {rating_col} = ?, {count_col} = ?
-                WHERE username = ?
-                """, (new_avg, new_count, username))
+            # Recalculate rating
+            new_avg, new_count = calculate_rating(current, count, new_rating)
 
-                conn.commit()
+            # Update the database with new rating
+            c.execute(f"""
+            UPDATE users
+            SET {rating_col} = ?, {count_col} = ?
+            WHERE username = ?
+            """, (new_avg, new_count, username))
 
-                return f"{role.capitalize()} rating updated."
+            return f"{role.capitalize()} rating updated."
 
-        except sqlite3.Error as e:  # DB error
-            return f"Database error: {e}"
+    except sqlite3.Error as e:  # DB error
+        return _db_error(e)
 
 
+@traced
 def rate_driver(username: str, new_rating: float) -> str:
     """Public function to rate a driver."""
     return _rate_user(username, new_rating, "driver")
 
 
+@traced
 def rate_passenger(username: str, new_rating: float) -> str:
     """Public function to rate a passenger."""
     return _rate_user(username, new_rating, "passenger")
 
 
-def get_pending_requests(driver_username: str):
-    """Return the list of pending ride requests for the given driver."""
-
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
+def _check_driver(c, username: str):
+    """Return an error message if username is not a driver, else None.
+
+    A driver whose pending_requests blob migrate_pending_requests() has
+    not reached yet gets it moved into the request tables first.
+    """
+    c.execute("SELECT is_driver, pending_requests FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if not row:
+        return Failure("Driver not found.")
+    if not row[0]:
+        return Failure("User is not registered as a driver.")
+    if row[1] != "[]":
+        with write_transaction() as conn:
+            _migrate_queue(conn.cursor(), username)
+    return None
+
+
+def _queue(c, driver_username: str) -> list:
+    """The driver's pending queue, oldest first, as request dicts."""
+    c.execute(_QUEUE_SQL, (driver_username,))
+    return [dict(zip(REQUEST_FIELDS, row)) for row in c.fetchall()]
+
+
+def _store_request(c, request: dict):
+    """Store a request in ride_requests (once; a later non-pending status wins)."""
+    c.execute("""
+    INSERT INTO ride_requests (id, passenger, passenger_name, area, day, time,
+                               min_rating, status, accepted_by)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET status=excluded.status, accepted_by=excluded.accepted_by
+    WHERE excluded.status <> 'pending'
+    """, (
+        request["id"], request.get("passenger"), request.get("passenger_name"),
+        request.get("area"), request.get("day"), request.get("time"),
+        float(request.get("min_rating") or 0.0), request.get("status") or "pending",
+        request.get("accepted_by"),
+    ))
+
+
+def _enqueue(c, driver_username: str, request: dict):
+    """Store a request (once) and add it to the driver's queue (once)."""
+    _store_request(c, request)
+    c.execute(
+        "INSERT OR IGNORE INTO driver_requests (driver, request_id) VALUES (?, ?)",
+        (driver_username, request["id"]),
+    )
+
+
+def _drop_request(c, request_id: str):
+    """Delete a request; its passenger is told if it was still waiting for an accept."""
+    c.execute("SELECT passenger FROM ride_requests WHERE id=? AND status='pending'", (request_id,))
+    row = c.fetchone()
+    c.execute("DELETE FROM ride_requests WHERE id=?", (request_id,))
+    c.execute("DELETE FROM ride_offers WHERE request_id=?", (request_id,))
+    if row and row[0]:
+        _emit("request_expired", request_id=request_id, passenger=row[0])
+
+
+def _stop_widening(c, request_id: str):
+    """Offer a request to no more drivers: drop it unless a queue still holds it."""
+    c.execute("SELECT 1 FROM driver_requests WHERE request_id=? LIMIT 1", (request_id,))
+    if c.fetchone():
+        c.execute("UPDATE ride_requests SET offered_at=NULL WHERE id=?", (request_id,))
+    else:
+        _drop_request(c, request_id)
+
+
+def _ride_passed(day: str, ride_time: str, created: float, now: float) -> bool:
+    """Whether the ride a request asks for, the first day/time at or after created, has begun.
+
+    day is a *_commute column and ride_time "HH:MM", in the server's local
+    time; a request whose day or time cannot be read never passes.
+    """
+    minute = _minute_of_day(ride_time)
+    if minute is None or day not in COMMUTE_COLUMNS:
+        return False
+    made = datetime.fromtimestamp(created)
+    ride = made.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    ride += timedelta(days=(COMMUTE_COLUMNS.index(day) - made.weekday()) % 7)
+    if ride < made:
+        ride += timedelta(days=7)
+    return now >= ride.timestamp()
+
+
+def _dequeue(c, seq: int, request_id: str):
+    """Remove one queue entry, and the request once no queue holds it.
+
+    A pending request that is being widened, and whose ride is still
+    ahead, is kept instead and made due for widening at once: every
+    driver it reached has declined it.
+    """
+    c.execute("DELETE FROM driver_requests WHERE seq=?", (seq,))
+    c.execute("SELECT 1 FROM driver_requests WHERE request_id=? LIMIT 1", (request_id,))
+    if c.fetchone():
+        return
+    if FANOUT_WIDEN_AFTER:
+        c.execute("SELECT day, time, strftime('%s', created_at) FROM ride_requests "
+                  "WHERE id=? AND status='pending' AND offered_at IS NOT NULL", (request_id,))
+        row = c.fetchone()
+        now = time.time()
+        if row and not _ride_passed(row[0], row[1], float(row[2] or now), now):
+            c.execute("UPDATE ride_requests SET offered_at=0 WHERE id=?", (request_id,))
+            return
+    _drop_request(c, request_id)
+
+
+def _rank_drivers(c, drivers: list, skip) -> Tuple[List[str], int]:
+    """Rank search_valid_drivers() results for a fan-out, best first.
+
+    A driver scores their driver_rating, less RANK_MINUTE_COST per minute
+    their commute time is off the requested one and RANK_QUEUE_COST per
+    pending request already in their queue; ties go to the closer commute time,
+    then the username. Drivers in skip and drivers whose queue holds
+    QUEUE_CAP requests are left out. Returns (usernames, number left out
+    for a full queue).
+    """
+    offs = {d["username"]: d["minutes_off"] for d in drivers if d["username"] not in skip}
+    names = list(offs)
+    ranked, full = [], 0
+    for i in range(0, len(names), _RANK_CHUNK):
+        chunk = names[i:i + _RANK_CHUNK]
+        c.execute(f"""
+        SELECT u.username, u.driver_rating, u.pending_requests <> '[]',
+               (SELECT COUNT(*) FROM driver_requests d JOIN ride_requests r ON r.id = d.request_id
+                WHERE d.driver = u.username AND r.status = 'pending')
+        FROM users u
+        WHERE u.username IN ({", ".join("?" * len(chunk))}) AND u.is_driver = 1
+        """, chunk)
+        for username, rating, unmigrated, queued in c.fetchall():
+            if unmigrated:  # count (and keep) the queue migrate_pending_requests() has not reached
+                _migrate_queue(c, username)
+                c.execute(_PENDING_COUNT_SQL, (username,))
+                queued = c.fetchone()[0]
+            if QUEUE_CAP and queued >= QUEUE_CAP:
+                full += 1
+                continue
+            off = offs[username]
+            score = rating - RANK_MINUTE_COST * off - RANK_QUEUE_COST * queued
+            ranked.append((-score, off, username))
+    ranked.sort()
+    return [username for _, _, username in ranked], full
+
+
+def _offer(c, request: dict, drivers: list) -> Tuple[List[str], int]:
+    """Queue a request for the best FANOUT_LIMIT drivers it was not offered to yet.
+
+    Returns (usernames offered to, drivers passed over for a full queue).
+    """
+    c.execute("SELECT driver FROM ride_offers WHERE request_id=?", (request["id"],))
+    ranked, full = _rank_drivers(c, drivers, {row[0] for row in c.fetchall()})
+    chosen = ranked[:FANOUT_LIMIT] if FANOUT_LIMIT else ranked
+    rows = [(username, request["id"]) for username in chosen]
+    c.executemany("INSERT OR IGNORE INTO driver_requests (driver, request_id) VALUES (?, ?)", rows)
+    c.executemany("INSERT OR IGNORE INTO ride_offers (driver, request_id) VALUES (?, ?)", rows)
+    for username in chosen:
+        _emit("pending_added", driver=username, request=dict(request))
+    return chosen, full
+
+
+def _migrate_queue(c, username: str) -> int:
+    """Move a user's pending_requests blob into the request tables (in a write transaction)."""
+    c.execute("SELECT pending_requests FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if not row or row[0] == "[]":
+        return 0  # another thread or process got here first
+    try:
+        entries = json.loads(row[0] or "[]")
+    except json.JSONDecodeError:
+        entries = []
+    moved = 0
+    for req in entries if isinstance(entries, list) else []:
+        if isinstance(req, dict) and req.get("id"):
+            _enqueue(c, username, req)
+            moved += 1
+    c.execute("UPDATE users SET pending_requests='[]' WHERE username=?", (username,))
+    return moved
+
+
+def migrate_pending_requests(batch: int = MIGRATION_BATCH) -> int:
+    """Move every remaining users.pending_requests blob into the request tables.
+
+    Works through the partial index on unmigrated blobs in transactions of
+    batch users, so the server keeps serving (and writing) meanwhile and an
+    interrupted migration simply resumes on the next start. Returns the
+    number of requests moved.
+    """
+    users = moved = 0
+    try:
+        while not _migration_stop.is_set():
+            with write_transaction() as conn:
                 c = conn.cursor()
+                c.execute("SELECT username FROM users WHERE pending_requests <> '[]' LIMIT ?",
+                          (batch,))
+                names = [row[0] for row in c.fetchall()]
+                for name in names:
+                    moved += _migrate_queue(c, name)
+            if not names:
+                break
+            users += len(names)
+    except sqlite3.Error as e:
+        log.error("db.migration_failed", error=str(e), users=users, requests=moved)
+        return moved
+    if users:
+        log.info("db.migrated", table="ride_requests", users=users, requests=moved)
+    return moved
+
+
+def start_migration():
+    """Run migrate_pending_requests() on a background thread (once per process)."""
+    global _migrator
+    if _migrator is None or not _migrator.is_alive():
+        _migration_stop.clear()
+        _migrator = threading.Thread(target=migrate_pending_requests, name="migrate", daemon=True)
+        _migrator.start()
+
+
+def _widen_loop():
+    while not _widening_stop.wait(WIDEN_CHECK_INTERVAL):
+        widen_ride_requests()
+
+
+def start_widening():
+    """Run widen_ride_requests() every WIDEN_CHECK_INTERVAL seconds on a background thread."""
+    global _widener
+    if FANOUT_WIDEN_AFTER and (_widener is None or not _widener.is_alive()):
+        _widening_stop.clear()
+        _widener = threading.Thread(target=_widen_loop, name="widen", daemon=True)
+        _widener.start()
+
+
+@traced
+def offer_ride_request(request: dict, drivers: list):
+    """Offer a new ride request to the best-ranked of the matched drivers, in one transaction.
+
+    drivers are search_valid_drivers() results, ranked by _rank_drivers();
+    the request goes to the first FANOUT_LIMIT. It is stored (and, with
+    FANOUT_WIDEN_AFTER set, widened later by widen_ride_requests()) only
+    if at least one driver got it. Returns (usernames offered to, drivers
+    passed over for a full queue), or an error message.
+    """
+
+    if not request.get("id"):
+        return Failure("Invalid request ID.")
 
-                # Get pending requests JSON
-                c.execute(
-                    "SELECT pending_requests, is_driver FROM users WHERE username=?",
-                    (driver_username,),
-                )
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            offered, full = _offer(c, request, drivers)
+            if offered:
+                _store_request(c, request)
+                if FANOUT_WIDEN_AFTER:
+                    c.execute("UPDATE ride_requests SET offered_at=? WHERE id=?",
+                              (time.time(), request["id"]))
+            return offered, full
+
+    except sqlite3.Error as e:  # DB error
+        return _db_error(e)
+
+
+@traced
+def widen_ride_requests(now: float = None) -> int:
+    """Offer requests nobody accepted within FANOUT_WIDEN_AFTER seconds to the next drivers.
+
+    Each due request (at most WIDEN_BATCH, oldest first) is matched again
+    and offered to the best FANOUT_LIMIT drivers that have not had it, one
+    transaction per request; requests every driver declined are due at
+    once. A request with no such driver left, older than REQUEST_MAX_AGE
+    or whose ride time has passed stops widening, and is dropped (its passenger told
+    with a "request_expired" event) if no queue holds it. Returns the
+    number of requests widened.
+    """
+    now = time.time() if now is None else now
+    cutoff = now - FANOUT_WIDEN_AFTER
+    widened = 0
+    try:
+        conn = _connect()
+        due = [row[0] for row in conn.execute("""
+        SELECT id FROM ride_requests
+        WHERE status = 'pending' AND offered_at IS NOT NULL AND offered_at <= ?
+        ORDER BY offered_at LIMIT ?
+        """, (cutoff, WIDEN_BATCH))]
+
+        for request_id in due:
+            if _widening_stop.is_set():
+                break
+            with write_transaction() as conn:
+                c = conn.cursor()
+                c.execute(f"SELECT {', '.join(REQUEST_FIELDS)}, strftime('%s', created_at) "
+                          "FROM ride_requests WHERE id=? AND status='pending' AND offered_at <= ?",
+                          (request_id, cutoff))
                 row = c.fetchone()
-
-                # User not found
                 if not row:
-                    return "Driver not found."
+                    continue  # accepted, or widened by another process, meanwhile
+                request = dict(zip(REQUEST_FIELDS, row))
+                created = float(row[-1] or now)
+                if ((REQUEST_MAX_AGE and now - created >= REQUEST_MAX_AGE)
+                        or _ride_passed(request["day"], request["time"], created, now)):
+                    _stop_widening(c, request_id)
+                    log.info("ride.widening_expired", request_id=request_id,
+                             age=round(now - created))
+                    continue
+                drivers = search_valid_drivers(request["area"], request["day"], request["time"],
+                                               request["min_rating"])
+                if isinstance(drivers, str) and drivers.startswith("Database error"):
+                    continue  # retried at the next check
+                offered, full = _offer(c, request, drivers if isinstance(drivers, list) else [])
+                if offered or full:
+                    c.execute("UPDATE ride_requests SET offered_at=? WHERE id=?",
+                              (now, request_id))
+                    widened += bool(offered)
+                    log.info("ride.widened" if offered else "ride.widening_deferred",
+                             request_id=request_id, added=len(offered), skipped_full=full)
+                    continue
+                _stop_widening(c, request_id)
+                log.info("ride.widening_exhausted", request_id=request_id)
+
+    except sqlite3.Error as e:  # DB error
+        log.error("db.widening_failed", error=str(e), widened=widened)
+    return widened
+
+
+@traced
+def get_pending_requests(driver_username: str):
+    """Return the list of pending ride requests for the given driver."""
 
-                pending_json, is_driver = row
+    try:
+        conn = _connect()
+        c = conn.cursor()
 
-                # Not a driver
-                if not is_driver:
-                    return "User is not registered as a driver."
+        # User missing or not a driver
+        error = _check_driver(c, driver_username)
+        if error:
+            return error
 
-                # Return parsed JSON list
-                try:
-                    return json.loads(pending_json or "[]")
-                except json.JSONDecodeError:
-                    return []
+        return _queue(c, driver_username)
 
-        except sqlite3.Error as e:  # DB error
-            return f"Database error: {e}"
+    except sqlite3.Error as e:  # DB error
+        return _db_error(e)
 
 
+@traced
 def add_pending_request(driver_username: str, request: dict) -> str:
     """Append a pending ride request to the driver's queue."""
 
-    request_json = json.dumps(request)  # convert dict → JSON string
+    if not request.get("id"):
+        return Failure("Invalid request ID.")
 
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-
-                # Fetch current pending requests
-                c.execute(
-                    "SELECT pending_requests, is_driver FROM users WHERE username=?",
-                    (driver_username,),
-                )
-                row = c.fetchone()
-
-                # User not found
-                if not row:
-                    return "Driver not found."
-
-                pending_json, is_driver = row
-
-                # Ensure user is driver
-                if not is_driver:
-                    return "User is not registered as a driver."
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
 
-                # Parse JSON safely
-                try:
-                    pending_requests = json.loads(pending_json or "[]")
-                except json.JSONDecodeError:
-                    pending_requests = []
+            # User missing or not a driver
+            error = _check_driver(c, driver_username)
+            if error:
+                return error
 
-                # Append request
-                pending_requests.append(json.loads(request_json))
+            if QUEUE_CAP:
+                c.execute(_PENDING_COUNT_SQL, (driver_username,))
+                if c.fetchone()[0] >= QUEUE_CAP:
+                    return Failure("Driver's pending queue is full.")
 
-                # Save updated list to DB
-                c.execute(
-                    "UPDATE users SET pending_requests=? WHERE username=?",
-                    (json.dumps(pending_requests), driver_username),
-                )
-                conn.commit()
+            _enqueue(c, driver_username, request)
+            _emit("pending_added", driver=driver_username, request=dict(request))
 
-                return "Request added to pending queue."
+            return "Request added to pending queue."
 
-        except sqlite3.Error as e:  # DB error
-            return f"Database error: {e}"
+    except sqlite3.Error as e:  # DB error
+        return _db_error(e)
 
 
+@traced
 def delete_pending_request(driver_username: str, index: int) -> str:
     """Delete a pending request from a driver's queue by index."""
 
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
 
-                # Fetch current pending requests
+            # User missing or not a driver
+            error = _check_driver(c, driver_username)
+            if error:
+                return error
+
+            # Find the index-th entry of the queue
+            row = None
+            if index >= 0:
                 c.execute(
-                    "SELECT pending_requests, is_driver FROM users WHERE username=?",
-                    (driver_username,),
+                    "SELECT seq, request_id FROM driver_requests WHERE driver=? "
+                    "ORDER BY seq LIMIT 1 OFFSET ?",
+                    (driver_username, index),
                 )
                 row = c.fetchone()
 
-                # User not found
-                if not row:
-                    return "Driver not found."
-
-                pending_json, is_driver = row
+            # Check invalid index
+            if not row:
+                return Failure("Invalid request index.")
 
-                # User is not a driver
-                if not is_driver:
-                    return "User is not registered as a driver."
+            _dequeue(c, *row)
 
-                # Parse JSON list
-                try:
-                    pending_requests = json.loads(pending_json or "[]")
-                except json.JSONDecodeError:
-                    pending_requests = []
+            return "Request deleted."
 
-                # Check invalid index
-                if index < 0 or index >= len(pending_requests):
-                    return "Invalid request index."
-
-                # Remove item → remaining items shift automatically
-                pending_requests.pop(index)
-
-                # Save back the updated list
-                c.execute(
-                    "UPDATE users SET pending_requests=? WHERE username=?",
-                    (json.dumps(pending_requests), driver_username),
-                )
-                conn.commit()
-
-                return "Request deleted."
-
-        except sqlite3.Error as e:  # DB error
-            return f"Database error: {e}"
+    except sqlite3.Error as e:  # DB error
+        return _db_error(e)
 
 
+@traced
 def accept_pending_request(driver_username: str, request_id: str) -> str:
     """Mark a request as accepted for one driver and remove it from others."""
 
     if not request_id:
-        return "Invalid request ID."
+        return Failure("Invalid request ID.")
 
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+
+            error = _check_driver(c, driver_username)
+            if error:
+                return error
+
+            # Queues not migrated yet that hold the request (none once migration is done)
+            c.execute(
+                "SELECT username FROM users "
+                "WHERE pending_requests <> '[]' AND instr(pending_requests, ?) > 0",
+                (request_id,),
+            )
+            for (uname,) in c.fetchall():
+                _migrate_queue(c, uname)
+
+            c.execute("""
+            SELECT r.passenger, r.passenger_name, r.area, r.day, r.time
+            FROM driver_requests d JOIN ride_requests r ON r.id = d.request_id
+            WHERE d.driver = ? AND d.request_id = ?
+            """, (driver_username, request_id))
+            row = c.fetchone()
+            if not row:
+                return Failure("Request not found.")
+
+            passenger, passenger_name, area, day, ride_time = row
+            ride_for_passenger = {
+                "id": request_id,
+                "driver": driver_username,
+                "driver_name": get_user_display_name(driver_username),
+                "area": area,
+                "day": day,
+                "time": ride_time,
+                "status": "active",
+                "passenger": passenger,
+                "passenger_name": passenger_name or get_user_display_name(passenger),
+            }
+
+            # Withdraw the request from every other driver's queue
+            c.execute(
+                "SELECT driver FROM driver_requests WHERE request_id=? AND driver<>?",
+                (request_id, driver_username),
+            )
+            withdrawn_from = [r[0] for r in c.fetchall()]
+            c.execute(
+                "DELETE FROM driver_requests WHERE request_id=? AND driver<>?",
+                (request_id, driver_username),
+            )
+            c.execute(
+                "UPDATE ride_requests SET status='active', accepted_by=? WHERE id=?",
+                (driver_username, request_id),
+            )
+            c.execute("DELETE FROM ride_offers WHERE request_id=?", (request_id,))
 
-                c.execute("SELECT is_driver FROM users WHERE username=?", (driver_username,))
-                row = c.fetchone()
-                if not row:
-                    return "Driver not found."
-                if not row[0]:
-                    return "User is not registered as a driver."
-
-                driver_name = get_user_display_name(driver_username)
-
-                c.execute("SELECT username, pending_requests FROM users WHERE is_driver=1")
-                rows = c.fetchall()
-
-                found = False
-                passenger = None
-                ride_for_passenger = None
-
-                for uname, pending_json in rows:
-                    try:
-                        pending_requests = json.loads(pending_json or "[]")
-                    except json.JSONDecodeError:
-                        pending_requests = []
-
-                    changed = False
-
-                    if uname == driver_username:
-                        for req in pending_requests:
-                            if req.get("id") == request_id:
-                                req["status"] = "active"
-                                req["accepted_by"] = driver_username
-                                passenger = req.get("passenger")
-                                passenger_name = req.get("passenger_name") or get_user_display_name(passenger)
-                                ride_for_passenger = {
-                                    "id": request_id,
-                                    "driver": driver_username,
-                                    "driver_name": driver_name,
-                                    "area": req.get("area"),
-                                    "day": req.get("day"),
-                                    "time": req.get("time"),
-                                    "status": "active",
-                                    "passenger": passenger,
-                                    "passenger_name": passenger_name,
-                                }
-                                changed = True
-                                found = True
-                                break
-                    else:
-                        filtered = [req for req in pending_requests if req.get("id") != request_id]
-                        if len(filtered) != len(pending_requests):
-                            pending_requests = filtered
-                            changed = True
-
-                    if changed:
-                        c.execute(
-                            "UPDATE users SET pending_requests=? WHERE username=?",
-                            (json.dumps(pending_requests), uname),
-                        )
-
-                conn.commit()
-
-                if found and passenger:
-                    add_active_ride(passenger, ride_for_passenger)
-
-                return "Request accepted." if found else "Request not found."
+            if passenger:
+                add_active_ride(passenger, ride_for_passenger)
 
-        except sqlite3.Error as e:
-            return f"Database error: {e}"
+            _emit("request_accepted", request_id=request_id, driver=driver_username,
+                  passenger=passenger, ride=ride_for_passenger, withdrawn_from=withdrawn_from)
+            return "Request accepted."
+
+    except sqlite3.Error as e:
+        return _db_error(e)
 
 
+@traced
 def complete_pending_request(driver_username: str, request_id: str) -> str:
     """Remove a pending/active request from the accepting driver's queue."""
 
     if not request_id:
-        return "Invalid request ID."
-
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-
-                c.execute(
-                    "SELECT pending_requests, is_driver FROM users WHERE username=?",
-                    (driver_username,),
-                )
-                row = c.fetchone()
-
-                if not row:
-                    return "Driver not found."
-
-                pending_json, is_driver = row
-                if not is_driver:
-                    return "User is not registered as a driver."
-
-                try:
-                    pending_requests = json.loads(pending_json or "[]")
-                except json.JSONDecodeError:
-                    pending_requests = []
-
-                passenger_username = None
-                passenger_ride = None
-                new_pending = []
-                for req in pending_requests:
-                    if req.get("id") == request_id:
-                        passenger_username = req.get("passenger")
-                        passenger_ride = {
-                            "id": request_id,
-                            "driver": req.get("accepted_by") or driver_username,
-                            "driver_name": req.get("driver_name") or get_user_display_name(req.get("accepted_by") or driver_username),
-                            "area": req.get("area"),
-                            "day": req.get("day"),
-                            "time": req.get("time"),
-                            "status": "completed",
-                            "passenger": passenger_username,
-                            "passenger_name": req.get("passenger_name") or get_user_display_name(passenger_username or "")
-                        }
-                        continue
-                    new_pending.append(req)
-
-                if len(new_pending) == len(pending_requests):
-                    return "Request not found."
-
-                c.execute(
-                    "UPDATE users SET pending_requests=? WHERE username=?",
-                    (json.dumps(new_pending), driver_username),
-                )
-                conn.commit()
-                if passenger_username:
-                    remove_active_ride(passenger_username, request_id)
-                    if passenger_ride:
-                        add_completed_ride(passenger_username, passenger_ride)
-                return "Request completed."
+        return Failure("Invalid request ID.")
 
-        except sqlite3.Error as e:
-            return f"Database error: {e}"
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+
+            error = _check_driver(c, driver_username)
+            if error:
+                return error
+
+            c.execute("""
+            SELECT d.seq, r.passenger, r.passenger_name, r.area, r.day, r.time, r.accepted_by
+            FROM driver_requests d JOIN ride_requests r ON r.id = d.request_id
+            WHERE d.driver = ? AND d.request_id = ?
+            """, (driver_username, request_id))
+            row = c.fetchone()
+            if not row:
+                return Failure("Request not found.")
+
+            seq, passenger_username, passenger_name, area, day, ride_time, accepted_by = row
+            driver = accepted_by or driver_username
+            passenger_ride = {
+                "id": request_id,
+                "driver": driver,
+                "driver_name": get_user_display_name(driver),
+                "area": area,
+                "day": day,
+                "time": ride_time,
+                "status": "completed",
+                "passenger": passenger_username,
+                "passenger_name": passenger_name or get_user_display_name(passenger_username or "")
+            }
+
+            _dequeue(c, seq, request_id)
+            if passenger_username:
+                remove_active_ride(passenger_username, request_id)
+                add_completed_ride(passenger_username, passenger_ride)
+            _emit("request_completed", request_id=request_id, driver=driver_username,
+                  passenger=passenger_username, ride=passenger_ride)
+            return "Request completed."
+
+    except sqlite3.Error as e:
+        return _db_error(e)
+
+
+@traced
 def get_active_rides(username: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT active_rides FROM users WHERE username=?", (username,))
-        row = c.fetchone()
-        if not row:
-            return "User not found."
-        try:
-            return json.loads(row[0] or "[]")
-        except json.JSONDecodeError:
-            return []
+    conn = _connect()
+    c = conn.cursor()
+    c.execute("SELECT active_rides FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if not row:
+        return Failure("User not found.")
+    try:
+        return json.loads(row[0] or "[]")
+    except json.JSONDecodeError:
+        return []
 
 
+@traced
 def get_completed_rides(username: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT completed_rides FROM users WHERE username=?", (username,))
-        row = c.fetchone()
-        if not row:
-            return "User not found."
-        try:
-            return json.loads(row[0] or "[]")
-        except json.JSONDecodeError:
-            return []
+    conn = _connect()
+    c = conn.cursor()
+    c.execute("SELECT completed_rides FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if not row:
+        return Failure("User not found.")
+    try:
+        return json.loads(row[0] or "[]")
+    except json.JSONDecodeError:
+        return []
 
 
+@traced
 def add_active_ride(passenger_username: str, ride: dict):
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute("SELECT active_rides FROM users WHERE username=?", (passenger_username,))
-                row = c.fetchone()
-                if not row:
-                    return
-                try:
-                    rides = json.loads(row[0] or "[]")
-                except json.JSONDecodeError:
-                    rides = []
-                rides = [r for r in rides if r.get("id") != ride.get("id")]
-                rides.append(ride)
-                c.execute("UPDATE users SET active_rides=? WHERE username=?", (json.dumps(rides), passenger_username))
-                conn.commit()
-        except sqlite3.Error:
-            return
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute("SELECT active_rides FROM users WHERE username=?", (passenger_username,))
+            row = c.fetchone()
+            if not row:
+                return
+            try:
+                rides = json.loads(row[0] or "[]")
+            except json.JSONDecodeError:
+                rides = []
+            rides = [r for r in rides if r.get("id") != ride.get("id")]
+            rides.append(ride)
+            c.execute("UPDATE users SET active_rides=? WHERE username=?", (json.dumps(rides), passenger_username))
+    except sqlite3.Error:
+        if connections.in_transaction():
+            raise  # part of a larger write (accept/complete), which must roll back as a whole
+        return
 
 
+@traced
 def remove_active_ride(passenger_username: str, request_id: str):
     if not request_id:
         return
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute("SELECT active_rides FROM users WHERE username=?", (passenger_username,))
-                row = c.fetchone()
-                if not row:
-                    return
-                try:
-                    rides = json.loads(row[0] or "[]")
-                except json.JSONDecodeError:
-                    rides = []
-                new_rides = [r for r in rides if r.get("id") != request_id]
-                if len(new_rides) == len(rides):
-                    return
-                c.execute("UPDATE users SET active_rides=? WHERE username=?", (json.dumps(new_rides), passenger_username))
-                conn.commit()
-        except sqlite3.Error:
-            return
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute("SELECT active_rides FROM users WHERE username=?", (passenger_username,))
+            row = c.fetchone()
+            if not row:
+                return
+            try:
+                rides = json.loads(row[0] or "[]")
+            except json.JSONDecodeError:
+                rides = []
+            new_rides = [r for r in rides if r.get("id") != request_id]
+            if len(new_rides) == len(rides):
+                return
+            c.execute("UPDATE users SET active_rides=? WHERE username=?", (json.dumps(new_rides), passenger_username))
+    except sqlite3.Error:
+        if connections.in_transaction():
+            raise  # part of a larger write (accept/complete), which must roll back as a whole
+        return
 
 
+@traced
 def add_completed_ride(passenger_username: str, ride: dict):
     if not ride.get("id"):
         return
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute("SELECT completed_rides FROM users WHERE username=?", (passenger_username,))
-                row = c.fetchone()
-                if not row:
-                    return
-                try:
-                    rides = json.loads(row[0] or "[]")
-                except json.JSONDecodeError:
-                    rides = []
-                rides = [r for r in rides if r.get("id") != ride["id"]]
-                rides.append(ride)
-                c.execute(
-                    "UPDATE users SET completed_rides=? WHERE username=?",
-                    (json.dumps(rides), passenger_username),
-                )
-                conn.commit()
-        except sqlite3.Error:
-            return
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute("SELECT completed_rides FROM users WHERE username=?", (passenger_username,))
+            row = c.fetchone()
+            if not row:
+                return
+            try:
+                rides = json.loads(row[0] or "[]")
+            except json.JSONDecodeError:
+                rides = []
+            rides = [r for r in rides if r.get("id") != ride["id"]]
+            rides.append(ride)
+            c.execute(
+                "UPDATE users SET completed_rides=? WHERE username=?",
+                (json.dumps(rides), passenger_username),
+            )
+    except sqlite3.Error:
+        if connections.in_transaction():
+            raise  # part of a larger write (accept/complete), which must roll back as a whole
+        return
 
 
+@traced
 def remove_completed_ride(passenger_username: str, request_id: str):
     if not request_id:
         return
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute("SELECT completed_rides FROM users WHERE username=?", (passenger_username,))
-                row = c.fetchone()
-                if not row:
-                    return
-                try:
-                    rides = json.loads(row[0] or "[]")
-                except json.JSONDecodeError:
-                    rides = []
-                new_rides = [r for r in rides if r.get("id") != request_id]
-                if len(new_rides) == len(rides):
-                    return
-                c.execute(
-                    "UPDATE users SET completed_rides=? WHERE username=?",
-                    (json.dumps(new_rides), passenger_username),
-                )
-                conn.commit()
-        except sqlite3.Error:
-            return
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute("SELECT completed_rides FROM users WHERE username=?", (passenger_username,))
+            row = c.fetchone()
+            if not row:
+                return
+            try:
+                rides = json.loads(row[0] or "[]")
+            except json.JSONDecodeError:
+                rides = []
+            new_rides = [r for r in rides if r.get("id") != request_id]
+            if len(new_rides) == len(rides):
+                return
+            c.execute(
+                "UPDATE users SET completed_rides=? WHERE username=?",
+                (json.dumps(new_rides), passenger_username),
+            )
+    except sqlite3.Error:
+        if connections.in_transaction():
+            raise  # part of a larger write (accept/complete), which must roll back as a whole
+        return
 
 
+@traced
 def add_ride_message(ride_id: str, sender: str, recipient: str, message: str):
     if not ride_id or not sender or not recipient or message is None:
-        return "Invalid message data."
-    with db_lock:
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute(
-                    """
-                    INSERT INTO ride_messages (ride_id, sender, recipient, message)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (ride_id, sender, recipient, message),
-                )
-                conn.commit()
-                return "Message sent."
-        except sqlite3.Error as e:
-            return f"Database error: {e}"
-
-
+        return Failure("Invalid message data.")
+    try:
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute(
+                """
+                INSERT INTO ride_messages (ride_id, sender, recipient, message)
+                VALUES (?, ?, ?, ?)
+                """,
+                (ride_id, sender, recipient, message),
+            )
+            c.execute("SELECT created_at FROM ride_messages WHERE id=?", (c.lastrowid,))
+            created_at = c.fetchone()[0]
+            _emit("message", ride_id=ride_id, message={
+                "sender": sender,
+                "sender_name": get_user_display_name(sender),
+                "recipient": recipient,
+                "message": message,
+                "timestamp": created_at,
+            })
+            return "Message sent."
+    except sqlite3.Error as e:
+        return _db_error(e)
+
+
+@traced
 def get_ride_messages(ride_id: str):
     if not ride_id:
-        return "Invalid ride ID."
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute(
-            """
-            SELECT sender, recipient, message, created_at
-            FROM ride_messages
-            WHERE ride_id=?
-            ORDER BY created_at ASC, id ASC
-            """,
-            (ride_id,),
+        return Failure("Invalid ride ID.")
+    conn = _connect()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT m.sender, COALESCE(NULLIF(u.name, ''), m.sender),
+               m.recipient, m.message, m.created_at
+        FROM ride_messages m
+        LEFT JOIN users u ON u.username = m.sender
+        WHERE m.ride_id=?
+        ORDER BY m.created_at ASC, m.id ASC
+        """,
+        (ride_id,),
+    )
+    rows = c.fetchall()
+    messages = []
+    for sender, sender_name, recipient, message, created_at in rows:
+        messages.append(
+            {
+                "sender": sender,
+                "sender_name": sender_name,
+                "recipient": recipient,
+                "message": message,
+                "timestamp": created_at,
+            }
         )
-        rows = c.fetchall()
-        messages = []
-        for sender, recipient, message, created_at in rows:
-            messages.append(
-                {
-                    "sender": sender,
-                    "sender_name": get_user_display_name(sender),
-                    "recipient": recipient,
-                    "message": message,
-                    "timestamp": created_at,
-                }
-            )
-        return messages
+    return messages
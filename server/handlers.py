@@ -0,0 +1,259 @@
+"""Handlers for the AUBus client commands.
+
+Importing this module registers every command with the dispatcher in
+commands.py.
+"""
+
+import base64
+import json
+import uuid
+
+import log
+import stats
+from metrics import metrics
+from commands import Arg, Reply, command, dispatch
+from workers import PRIORITY_CRITICAL, PRIORITY_POLL, PRIORITY_WRITE
+from database import (
+    register_user,
+    get_login_payload,
+    edit_fields,
+    search_valid_drivers,
+    offer_ride_request,
+    get_pending_requests,
+    delete_pending_request,
+    accept_pending_request,
+    complete_pending_request,
+    get_active_rides,
+    get_completed_rides,
+    remove_completed_ride,
+    rate_driver,
+    rate_passenger,
+    get_user_display_name,
+    add_ride_message,
+    get_ride_messages,
+)
+
+MAX_BATCH_SIZE = 32  # sub-commands accepted in one batch request
+DAYS_ORDER = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+FEATURES = ["batch", "binary", "compression", "subscribe"]  # advertised by the features command
+
+
+def _b64_text(encoded: str) -> str:
+    return base64.b64decode(encoded.encode()).decode()
+
+
+def _no_colon(value: str) -> str:
+    """Free text that is not a command's greedy argument.
+
+    In a text request only the greedy argument may contain ':' (any other
+    colon shifts the fields after it), so such values are refused
+    outright; binary requests are held to the same rule so that every
+    stored value can be sent back as text.
+    """
+    if ":" in value:
+        raise ValueError(value)
+    return value
+
+
+NO_COLON_ERROR = "Usernames, names, emails and passwords cannot contain ':'."
+
+
+@command("register",
+         Arg("username", _no_colon, error=NO_COLON_ERROR, sensitive="user"),
+         Arg("name", _no_colon, error=NO_COLON_ERROR, sensitive="personal"),
+         Arg("email", _no_colon, error=NO_COLON_ERROR, sensitive="personal"),
+         Arg("password", _no_colon, error=NO_COLON_ERROR, sensitive="password"),
+         Arg("area", greedy=True), Arg("is_driver", int),
+         priority=PRIORITY_WRITE, rate_class="auth")
+def handle_register(username, name, email, password, area, is_driver):
+    log.info("user.register", username=username, area=area, is_driver=is_driver)
+    return register_user(username, name, email, password, area, is_driver)
+
+
+@command("login", Arg("username", sensitive="user"), Arg("password", sensitive="password"),
+         rate_class="auth")
+def handle_login(username, password):
+    log.debug("user.login", username=username)
+    return Reply.from_result(get_login_payload(username, password))
+
+
+@command("editprofile",
+         Arg("username", sensitive="user"),
+         Arg("full_name", _no_colon, error=NO_COLON_ERROR, sensitive="personal"),
+         Arg("area", greedy=True), Arg("is_driver", int),
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_edit_profile(username, full_name, area, is_driver):
+    log.info("user.edit_profile", username=username)
+    return edit_fields(username, {"name": full_name, "area": area, "is_driver": is_driver})
+
+
+@command("update_availability",
+         Arg("username", sensitive="user"), Arg("availability"), Arg("min_rating"),
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_update_availability(username, availability_str, min_rating):
+    log.debug("availability.update", username=username, availability=availability_str)
+
+    # One "HH.MM-HH.MM" entry (or an empty string) per day, Monday first
+    parts = availability_str.split(";")
+    update_fields = {}
+    for i, day in enumerate(DAYS_ORDER):
+        entry = parts[i]
+        if entry:
+            from_time, to_time = entry.split("-")
+            update_fields[f"{day}_commute"] = {
+                "from": from_time.replace(".", ":"),
+                "to": to_time.replace(".", ":")
+            }
+        else:
+            update_fields[f"{day}_commute"] = []
+    update_fields["min_passenger_rating"] = min_rating
+
+    return edit_fields(username, update_fields)
+
+
+@command("request_ride",
+         Arg("passenger", sensitive="user"), Arg("area", greedy=True), Arg("day"),
+         Arg("hour"), Arg("minute"), Arg("min_rating", float),
+         priority=PRIORITY_WRITE, rate_class="fanout")
+def handle_request_ride(passenger, area, day, hour, minute, min_rating):
+    day = day + "_commute"
+    ride_time = f"{hour}:{minute}"
+    passenger_name = get_user_display_name(passenger)
+    drivers = search_valid_drivers(area, day, ride_time, min_rating)
+    if isinstance(drivers, str):
+        # No drivers or error message
+        return drivers
+
+    request_payload = {
+        "id": str(uuid.uuid4()),
+        "passenger": passenger,
+        "passenger_name": passenger_name,
+        "area": area,
+        "day": day,
+        "time": ride_time,
+        "min_rating": min_rating,
+        "status": "pending",
+        "accepted_by": None
+    }
+
+    # Only the best-ranked drivers get it; more if none of them accepts (see database.py)
+    result = offer_ride_request(request_payload, drivers)
+    if isinstance(result, str):
+        return result
+    offered, full = result
+
+    log.info("ride.requested", passenger=passenger, area=area, day=day, time=ride_time,
+             matched=len(drivers), added=len(offered), skipped_full=full)
+    if not offered:
+        # Nothing was stored: there is no request for the passenger to wait on or cancel.
+        if full:
+            return f"All {full} matching driver(s) are busy, try again later."
+        return "No valid drivers found."
+    return f"Request added to {len(offered)} driver(s)."
+
+
+@command("get_pending", Arg("username", sensitive="user"))
+def handle_get_pending(username):
+    return Reply.from_result(get_pending_requests(username))
+
+
+@command("get_active_rides", Arg("username", sensitive="user"))
+def handle_get_active_rides(username):
+    return Reply.from_result(get_active_rides(username))
+
+
+@command("get_completed_rides", Arg("username", sensitive="user"))
+def handle_get_completed_rides(username):
+    return Reply.from_result(get_completed_rides(username))
+
+
+@command("delete_request", Arg("username", sensitive="user"), Arg("index", int),
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_delete_request(username, index):
+    return delete_pending_request(username, index)
+
+
+@command("accept_request", Arg("driver", sensitive="user"), Arg("request_id"),
+         priority=PRIORITY_CRITICAL, rate_class="write")
+def handle_accept_request(driver_username, request_id):
+    return accept_pending_request(driver_username, request_id)
+
+
+@command("end_request", Arg("driver", sensitive="user"), Arg("request_id"),
+         priority=PRIORITY_CRITICAL, rate_class="write")
+def handle_end_request(driver_username, request_id):
+    return complete_pending_request(driver_username, request_id)
+
+
+@command("rate_passenger",
+         Arg("passenger", sensitive="user"), Arg("rating", float, error="Invalid rating."),
+         usage_error="Invalid rating.",
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_rate_passenger(passenger_username, rating):
+    return rate_passenger(passenger_username, rating)
+
+
+@command("rate_driver_ride",
+         Arg("passenger", sensitive="user"), Arg("driver", sensitive="user"), Arg("request_id"),
+         Arg("rating", float, error="Invalid rating."),
+         usage_error="Invalid rating.",
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_rate_driver_ride(passenger_username, driver_username, request_id, rating):
+    result = rate_driver(driver_username, rating)
+    if result.lower().startswith("driver rating updated"):
+        remove_completed_ride(passenger_username, request_id)
+    return result
+
+
+@command("send_message",
+         Arg("ride_id"), Arg("sender", sensitive="user"), Arg("recipient", sensitive="user"),
+         Arg("message", text_decode=_b64_text, error="Invalid message encoding.", sensitive="text"),
+         usage_error="Invalid message payload.",
+         priority=PRIORITY_WRITE, rate_class="write")
+def handle_send_message(ride_id, sender, recipient, message_text):
+    return add_ride_message(ride_id, sender, recipient, message_text)
+
+
+@command("get_messages", Arg("ride_id"), usage_error="Invalid ride id.", priority=PRIORITY_POLL,
+         rate_class="poll")
+def handle_get_messages(ride_id):
+    return Reply.from_result(get_ride_messages(ride_id))
+
+
+@command("batch", Arg("commands", greedy=True), rate_class=None)
+def handle_batch(payload):
+    """Run a JSON list of commands and return every reply."""
+    try:
+        commands = json.loads(payload)
+    except (json.JSONDecodeError, RecursionError):  # RecursionError: nested too deeply
+        return Reply("error", "Invalid batch payload.")
+    if not isinstance(commands, list) or not all(isinstance(c, str) for c in commands):
+        return Reply("error", "Batch must be a list of commands.")
+    if len(commands) > MAX_BATCH_SIZE:
+        return Reply("error", f"Batch too large (max {MAX_BATCH_SIZE} commands).")
+
+    results = []
+    for cmd in commands:
+        if cmd.partition(":")[0].lower() == "batch":
+            results.append("error:Nested batches are not allowed.")
+        else:
+            results.append(dispatch(cmd))
+    return Reply("success", results)
+
+
+@command("features", rate_class=None)
+def handle_features():
+    """Protocol features this server supports, for client negotiation."""
+    return Reply("success", FEATURES)
+
+
+@command("stats", priority=PRIORITY_POLL, rate_class="poll")
+def handle_stats():
+    """Snapshot of the server statistics registered in stats.py."""
+    return Reply("success", stats.collect())
+
+
+@command("metrics", priority=PRIORITY_POLL, rate_class="poll")
+def handle_metrics():
+    """Request metrics in the Prometheus text format (see metrics.py)."""
+    return Reply("success", metrics.prometheus())
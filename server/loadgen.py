@@ -0,0 +1,379 @@
+"""End-to-end load generator for server.py.
+
+Starts server.py on a throwaway database (or targets a running server
+with --target), seeds it with synthetic drivers, passengers and ride
+requests, then drives it over real framed sockets from several client
+processes. Each connection is a closed-loop client picking operations
+from a weighted mix:
+
+  login           passenger login (largest JSON payload)
+  request_ride    passenger asks for a ride at a driver's commute time
+  get_pending     driver polls their pending queue
+  accept_request  driver accepts the first pending request, if any
+  send_message    chat message on a seeded ride
+  get_messages    chat history of a seeded ride
+
+With --populate USERS the throwaway database is bulk-loaded by
+populate.py instead, for tests at realistic data volume.
+
+It reports throughput and per-operation latency percentiles. Results can
+be saved as a baseline (--save-baseline) and later runs compared against
+it (--baseline); a throughput drop or p95 increase beyond --tolerance
+fails the run with exit status 1.
+
+Usage:
+  python loadgen.py --seconds 10 --mix login=40,get_messages=30,send_message=30
+  python loadgen.py --baseline loadgen_baseline.json
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import populate
+from protocol import MAGIC, FrameDecoder, encode_frame, recv_frame
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AREAS = ["Hamra", "Achrafieh", "Verdun", "Jounieh", "Baabda", "Byblos", "Dbayeh", "Aley"]
+DAYS = ["mon", "tue", "wed", "thu", "fri"]
+COMMUTES = ["07.00-15.00", "07.30-16.00", "08.00-17.00", "09.00-18.00"]
+DEFAULT_MIX = ("login=25,request_ride=5,get_pending=20,accept_request=5,"
+               "send_message=15,get_messages=30")
+ERROR_PREFIXES = ("error:", "busy:", "Connection error", "Error processing", "Database error")
+
+
+class Client:
+    """One framed connection sending a request at a time."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.sendall(MAGIC)
+        self.decoder = FrameDecoder()
+
+    def request(self, message: str) -> str:
+        self.sock.sendall(encode_frame(message.encode()))
+        _, payload = recv_frame(self.sock, self.decoder)
+        return payload.decode()
+
+    def close(self):
+        self.sock.close()
+
+
+class Population:
+    """Synthetic users, deterministic for a given size and seed."""
+
+    def __init__(self, drivers=0, passengers=0, seed=1):
+        rng = random.Random(seed)
+        self.drivers = []
+        for i in range(drivers):
+            days = {d: rng.choice(COMMUTES) for d in rng.sample(DAYS, rng.randint(2, 5))}
+            self.drivers.append({"username": f"driver{i}", "area": rng.choice(AREAS), "days": days})
+        self.passengers = [
+            {"username": f"student{i}", "area": rng.choice(AREAS)} for i in range(passengers)
+        ]
+        self.rides = []  # ride ids with chat history, filled by seed()
+
+    @classmethod
+    def from_generated(cls, generated, sample, seed):
+        """Use (a sample of) the users a populate.py run created; no seeding needed."""
+        rng = random.Random(seed)
+        pop = cls()
+        # Drivers need a commute day for request_ride to match them.
+        drivers = [d for d in generated.drivers if d["days"]]
+        pop.drivers = rng.sample(drivers, min(sample, len(drivers)))
+        pop.passengers = rng.sample(generated.passengers, min(sample, len(generated.passengers)))
+        pop.rides = rng.sample(generated.rides, min(sample, len(generated.rides)))
+        return pop
+
+    def seed(self, client: Client, rides: int, messages: int):
+        for d in self.drivers:
+            client.request(f"register:{d['username']}:Driver {d['username'][6:]}:"
+                           f"{d['username']}@mail.aub.edu:pw:{d['area']}:1")
+            schedule = ";".join(d["days"].get(day, "") for day in DAYS + ["sat", "sun"])
+            client.request(f"update_availability:{d['username']}:{schedule}:0")
+        for p in self.passengers:
+            client.request(f"register:{p['username']}:Student {p['username'][7:]}:"
+                           f"{p['username']}@mail.aub.edu:pw:{p['area']}:0")
+        rng = random.Random(len(self.drivers))
+        for _ in range(rides):
+            request_ride(rng, client, self)
+        for d in self.drivers:
+            reply = client.request(f"get_pending:{d['username']}")
+            if reply.startswith("success:"):
+                self.rides += [r["id"] for r in json.loads(reply[8:])][:2]
+        if not self.rides:
+            raise RuntimeError("Seeding produced no ride requests.")
+        body = base64.b64encode(b"See you at the main gate in ten minutes.").decode()
+        for ride in self.rides:
+            for _ in range(messages):
+                client.request(f"send_message:{ride}:student0:driver0:{body}")
+
+
+# ---- operations: each sends its requests and returns the reply to time ----
+
+def login(rng, client, pop):
+    return client.request(f"login:{rng.choice(pop.passengers)['username']}:pw")
+
+
+def request_ride(rng, client, pop):
+    driver = rng.choice(pop.drivers)
+    day, window = rng.choice(list(driver["days"].items()))
+    hour, minute = window.split("-")[0].split(".")
+    passenger = rng.choice(pop.passengers)["username"]
+    return client.request(f"request_ride:{passenger}:{driver['area']}:{day}:{hour}:{minute}:0")
+
+
+def get_pending(rng, client, pop):
+    return client.request(f"get_pending:{rng.choice(pop.drivers)['username']}")
+
+
+def accept_request(rng, client, pop):
+    driver = rng.choice(pop.drivers)["username"]
+    reply = client.request(f"get_pending:{driver}")
+    pending = json.loads(reply[8:]) if reply.startswith("success:") else []
+    pending = [r for r in pending if r.get("status") == "pending"]
+    if not pending:
+        return None  # nothing to accept; not timed
+    return client.request(f"accept_request:{driver}:{pending[0]['id']}")
+
+
+def send_message(rng, client, pop):
+    body = base64.b64encode(b"Running five minutes late, sorry!").decode()
+    return client.request(f"send_message:{rng.choice(pop.rides)}:student0:driver0:{body}")
+
+
+def get_messages(rng, client, pop):
+    return client.request(f"get_messages:{rng.choice(pop.rides)}")
+
+
+OPERATIONS = {f.__name__: f for f in
+              (login, request_ride, get_pending, accept_request, send_message, get_messages)}
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r} (choose from {', '.join(OPERATIONS)}).")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_client(host, port, connections, seconds, mix, pop, seed_value, results):
+    rng = random.Random(seed_value)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    clients = [Client(host, port) for _ in range(connections)]
+    latencies = {n: [] for n in names}
+    errors = {n: 0 for n in names}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for client in clients:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            reply = OPERATIONS[name](rng, client, pop)
+            if reply is None:
+                continue
+            latencies[name].append(time.perf_counter() - start)
+            if reply.startswith(ERROR_PREFIXES):
+                errors[name] += 1
+    for client in clients:
+        client.close()
+    results.put((latencies, errors))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(latencies, errors, elapsed) -> dict:
+    ops = {}
+    total = 0
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        total += len(values)
+        ops[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "rps": round(len(values) / elapsed, 1),
+            **{f"p{int(q * 100)}_ms": round(percentile(values, q) * 1000, 3) if values else None
+               for q in (0.5, 0.95, 0.99)},
+        }
+    return {"throughput_rps": round(total / elapsed, 1), "requests": total, "operations": ops}
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on port {port}.")
+
+
+def start_server(db_path, port, extra_args):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "server.py"), "--port", str(port),
+         "--db", db_path, "--log-level", "warning", *extra_args],
+        cwd=os.path.dirname(db_path), stdout=subprocess.DEVNULL,
+    )
+    wait_for_port("127.0.0.1", port)
+    return server
+
+
+def run(args, mix) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "loadgen.db")
+        if args.populate:
+            drivers = args.populate_drivers or args.populate // 5
+            generated = populate.populate(db_path, args.populate, drivers, args.seed)
+            pop = Population.from_generated(generated, args.sample, args.seed)
+        else:
+            pop = Population(args.drivers, args.passengers, args.seed)
+        server = None
+        if args.target:
+            host, _, port = args.target.rpartition(":")
+            port = int(port)
+        else:
+            host, port = "127.0.0.1", args.port
+            server = start_server(db_path, port, args.server_args.split())
+        try:
+            if not args.populate:
+                seeder = Client(host, port)
+                pop.seed(seeder, args.rides, args.messages)
+                seeder.close()
+
+            results = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(target=run_client, args=(
+                    host, port, args.connections, args.seconds, mix, pop,
+                    args.seed + i + 1, results))
+                for i in range(args.clients)
+            ]
+            start = time.monotonic()
+            for p in procs:
+                p.start()
+            latencies = {n: [] for n in mix}
+            errors = {n: 0 for n in mix}
+            for _ in procs:
+                lat, err = results.get(timeout=args.seconds + 60)
+                for n in mix:
+                    latencies[n] += lat[n]
+                    errors[n] += err[n]
+            elapsed = time.monotonic() - start
+            for p in procs:
+                p.join()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    return summarize(latencies, errors, elapsed)
+
+
+def compare(result, baseline, tolerance) -> list:
+    """Regressions of result against baseline, as human-readable lines."""
+    problems = []
+    base_rps = baseline["throughput_rps"]
+    if result["throughput_rps"] < base_rps * (1 - tolerance):
+        problems.append(f"throughput {result['throughput_rps']} req/s < baseline {base_rps}")
+    for name, base in baseline["operations"].items():
+        op = result["operations"].get(name)
+        if not op or base.get("p95_ms") is None or op.get("p95_ms") is None:
+            continue
+        if op["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name} p95 {op['p95_ms']} ms > baseline {base['p95_ms']} ms")
+    return problems
+
+
+def print_report(result, baseline=None):
+    print(f"{'operation':<16} {'count':>8} {'errors':>7} {'req/s':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, op in result["operations"].items():
+        cells = [f"{op[k]:>9.2f}" if op[k] is not None else f"{'-':>9}"
+                 for k in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<16} {op['count']:>8} {op['errors']:>7} {op['rps']:>9.1f} {' '.join(cells)}")
+    line = f"total: {result['throughput_rps']} req/s over {result['requests']} requests"
+    if baseline:
+        change = result["throughput_rps"] / baseline["throughput_rps"] - 1
+        line += f" ({change:+.1%} vs baseline)"
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight,... (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--connections", type=int, default=4, help="connections per client process")
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--passengers", type=int, default=400)
+    parser.add_argument("--rides", type=int, default=200, help="ride requests created while seeding")
+    parser.add_argument("--messages", type=int, default=10, help="chat messages per seeded ride")
+    parser.add_argument("--populate", type=int, default=0, metavar="USERS",
+                        help="bulk-load USERS synthetic users with populate.py instead of "
+                             "seeding through the server (for scale tests)")
+    parser.add_argument("--populate-drivers", type=int, default=0,
+                        help="drivers among the populated users (default 20%%)")
+    parser.add_argument("--sample", type=int, default=5000,
+                        help="populated users/rides the clients pick from")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=12398, help="port for the throwaway server")
+    parser.add_argument("--server-args", default="", help="extra server.py arguments")
+    parser.add_argument("--target", metavar="HOST:PORT",
+                        help="load an already running server instead (it must be empty)")
+    parser.add_argument("--baseline", help="compare against this baseline JSON")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the result as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed relative regression before failing (default 0.15)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    result = run(args, mix)
+    result["config"] = {k: getattr(args, k) for k in (
+        "mix", "seconds", "clients", "connections", "drivers", "passengers", "rides",
+        "messages", "populate", "populate_drivers", "sample", "seed", "server_args")}
+    result["machine"] = {"python": platform.python_version(), "cpus": os.cpu_count(),
+                         "platform": platform.platform()}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    if baseline:
+        if baseline.get("config") != result["config"]:
+            print("warning: baseline was recorded with a different configuration")
+        problems = compare(result, baseline, args.tolerance)
+        for p in problems:
+            print(f"REGRESSION: {p}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""Structured, asynchronous server logging.
+
+Call sites log an event name plus keyword fields:
+
+    log.info("ride.requested", passenger=passenger, drivers=len(drivers))
+
+Records below the configured level are discarded before anything is
+built. The rest are put on a SimpleQueue (no lock held by the caller) and
+a background thread formats them, as text or JSON lines, and writes them
+to stdout or to a size-rotated file. The request thread never waits on
+stdout or disk.
+
+High-volume events can be sampled: with a rate of N only every Nth
+occurrence of the event is written, carrying a "sampled" field of N. If
+the writer falls MAX_PENDING records behind, new records are dropped and
+counted instead of queueing without bound. Counters are reported under
+"logging" by the stats command.
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import stats
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+
+MAX_PENDING = 10000  # records queued for the writer before new ones are dropped
+DEFAULT_SAMPLING = {"connection.open": 100, "request.rate_limited": 100}  # event -> write 1 in N
+
+_STOP = object()
+
+
+class Logger:
+    def __init__(self):
+        self.level = INFO
+        self.format = "text"
+        self.path = None
+        self.max_bytes = 10 * 1024 * 1024
+        self.backups = 5
+        self.sampling = dict(DEFAULT_SAMPLING)
+        self._seen = {}  # sampled event -> occurrences
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        self._start_lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def configure(self, level="info", format="text", path=None, max_bytes=None,
+                  backups=None, sampling=None):
+        self.level = LEVELS[level]
+        self.format = format
+        self.path = path
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if backups is not None:
+            self.backups = backups
+        if sampling:
+            self.sampling.update(sampling)
+
+    def for_worker(self, index: int):
+        """Give a forked worker process its own log file (rotation isn't multi-process safe)."""
+        if self.path:
+            root, ext = os.path.splitext(self.path)
+            self.path = f"{root}.{index}{ext}"
+
+    def log(self, level: int, event: str, fields: dict):
+        if level < self.level:
+            return
+        rate = self.sampling.get(event)
+        if rate is not None and rate > 1:
+            n = self._seen.get(event, 0)
+            self._seen[event] = n + 1  # racy under threads; sampling only needs to be approximate
+            if n % rate:
+                self.sampled_out += 1
+                return
+            fields["sampled"] = rate
+        if self._writer is None:
+            self._start()
+        if self._queue.qsize() >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._queue.put((time.time(), level, event, fields))
+
+    def _start(self):
+        with self._start_lock:
+            if self._writer is None:
+                writer = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+                writer.start()
+                self._writer = writer
+
+    def _after_fork(self):
+        # The child inherits the queue and records but not the writer thread;
+        # the parent still writes what it had queued.
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        self._start_lock = threading.Lock()
+
+    def _format(self, record) -> str:
+        ts, level, event, fields = record
+        if self.format == "json":
+            entry = {"ts": round(ts, 6), "level": _LEVEL_NAMES[level], "event": event}
+            entry.update(fields)
+            return json.dumps(entry, default=str)
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+        text = " ".join(f"{k}={v}" for k, v in fields.items() if k != "traceback")
+        line = f"{stamp}.{int(ts % 1 * 1000):03d} {_LEVEL_NAMES[level].upper():<7} {event} {text}"
+        if "traceback" in fields:
+            line += "\n" + fields["traceback"].rstrip()
+        return line
+
+    def _open(self):
+        if self.path is None:
+            return sys.stdout, 0
+        stream = open(self.path, "a", encoding="utf-8")
+        return stream, stream.tell()
+
+    def _rotate(self, stream):
+        stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return self._open()
+
+    def _write_loop(self):
+        stream, size = self._open()
+        while True:
+            record = self._queue.get()
+            stop = record is _STOP
+            while not stop:
+                try:
+                    line = self._format(record) + "\n"
+                except Exception as e:  # a bad field must not kill the writer
+                    line = f"log format error: {e}\n"
+                stream.write(line)
+                self.written += 1
+                size += len(line)
+                if self.path is not None and size >= self.max_bytes:
+                    stream, size = self._rotate(stream)
+                try:
+                    record = self._queue.get_nowait()  # drain before flushing
+                except queue.Empty:
+                    break
+                stop = record is _STOP
+            stream.flush()
+            if stop:
+                if stream is not sys.stdout:
+                    stream.close()
+                return
+
+    def close(self, timeout: float = 5.0):
+        """Write out everything queued so far and stop the writer thread."""
+        writer = self._writer
+        if writer is not None and writer.is_alive():
+            self._queue.put(_STOP)
+            writer.join(timeout)
+        self._writer = None
+
+    def snapshot(self) -> dict:
+        return {
+            "level": _LEVEL_NAMES[self.level],
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+
+logger = Logger()
+stats.register_source("logging", logger.snapshot)
+atexit.register(logger.close)
+
+configure = logger.configure
+close = logger.close
+
+
+def debug(event: str, **fields):
+    logger.log(DEBUG, event, fields)
+
+
+def info(event: str, **fields):
+    logger.log(INFO, event, fields)
+
+
+def warning(event: str, **fields):
+    logger.log(WARNING, event, fields)
+
+
+def error(event: str, exc_info: bool = False, **fields):
+    """Log an error; exc_info=True attaches the traceback being handled."""
+    if exc_info:
+        fields["traceback"] = traceback.format_exc()
+    logger.log(ERROR, event, fields)
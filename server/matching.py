@@ -0,0 +1,281 @@
+"""In-memory driver matching (server.py --match-in-memory).
+
+MatchIndex holds every driver's commute times in compact sorted arrays,
+one set per (area, weekday): minutes of day (array of unsigned shorts),
+the driver's min_passenger_rating (array of doubles) and the driver's
+username, kept in step. search() answers database.search_valid_drivers
+without touching the disk: two bisects find the tolerance window, the
+entries in it are filtered by rating and ranked exactly as the SQL query
+ranks them.
+
+It is loaded once from the database when enabled. Changes reach it
+through the commute_changes log that database._sync_commutes appends to
+in the same transaction as the change (register_user, edit_fields,
+update_availability, rebuild_commutes). Before each search the index
+checks PRAGMA data_version on its own connection, which moves whenever
+any other connection (in this process or another, e.g. a --processes
+sibling or a handoff successor) has committed; only then does it read
+the log past the last entry it applied and reload those drivers. If it
+fell behind further than the log keeps, it reloads everything.
+
+verify() compares the index with the database and returns the drivers
+whose entries differ; bench_matching.py measures both at 100k drivers.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+import database
+import log
+import stats
+
+NO_MATCH = "No valid drivers found."
+
+
+class _Driver:
+    __slots__ = ("name", "area", "min_rating", "raw", "entries", "_times")
+
+    def __init__(self, name, area, min_rating, raw):
+        self.name = name
+        self.area = area
+        self.min_rating = min_rating
+        self.raw = dict(zip(database.COMMUTE_COLUMNS, raw))  # stored *_commute values
+        self.entries = []  # ((area, day), minute) of each of this driver's slot entries
+        self._times = {}
+
+    def times(self, day: str) -> list:
+        """The day's commute time strings, as search results list them (parsed on first use).
+
+        The list is shared by every result naming this driver: read-only.
+        """
+        times = self._times.get(day)
+        if times is None:
+            times = self._times[day] = [t for _, t in database._commute_windows(self.raw[day])]
+        return times
+
+
+class _Slot:
+    """The entries of one (area, day), sorted by (minute, username)."""
+
+    __slots__ = ("minutes", "ratings", "drivers")
+
+    def __init__(self):
+        self.minutes = array("H")
+        self.ratings = array("d")
+        self.drivers = []
+
+    def _find(self, minute: int, username: str) -> int:
+        lo = bisect_left(self.minutes, minute)
+        return bisect_left(self.drivers, username, lo, bisect_right(self.minutes, minute, lo))
+
+    def add(self, minute: int, rating: float, username: str):
+        i = self._find(minute, username)
+        self.minutes.insert(i, minute)
+        self.ratings.insert(i, rating)
+        self.drivers.insert(i, username)
+
+    def remove(self, minute: int, username: str):
+        i = self._find(minute, username)
+        if i < len(self.drivers) and self.drivers[i] == username and self.minutes[i] == minute:
+            del self.minutes[i], self.ratings[i], self.drivers[i]
+
+
+_DRIVER_SQL = f"""
+SELECT username, name, area, min_passenger_rating, {", ".join(database.COMMUTE_COLUMNS)}
+FROM users WHERE is_driver=1
+"""
+# Slot order; idx_driver_commutes_match provides all but the driver part.
+_ENTRIES_SQL = """
+SELECT day, area, minute, min_rating, driver FROM driver_commutes
+ORDER BY day, area, minute, driver
+"""
+
+
+class MatchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}    # (area, day) -> _Slot
+        self._drivers = {}  # username -> _Driver
+        self._conn = None
+        self._pid = None
+        self._data_version = None
+        self._applied = 0   # last commute_changes id reflected in the index
+        self.loads = 0
+        self.updates = 0
+        self.searches = 0
+        self.load_seconds = 0.0
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # Connections must not cross fork(). A forked child keeps the
+            # inherited index and catches up from the log (version unknown).
+            self._conn = sqlite3.connect(database.DB_FILE, timeout=database.DB_TIMEOUT,
+                                         check_same_thread=False)
+            self._pid = os.getpid()
+            self._data_version = None
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = self._pid = None
+
+    def load(self):
+        """(Re)build the whole index from the database."""
+        with self._lock:
+            self._load(self._connection())
+
+    def _load(self, conn):
+        start = time.perf_counter()
+        # Baseline first: anything committed after it makes _catch_up read the log.
+        self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        conn.execute("BEGIN")  # one snapshot for the log position and the rows
+        try:
+            self._applied = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM commute_changes").fetchone()[0]
+            drivers = {row[0]: _Driver(*row[1:4], row[4:]) for row in conn.execute(_DRIVER_SQL)}
+            slots, slot, current = {}, None, None
+            for day, area, minute, rating, username in conn.execute(_ENTRIES_SQL):
+                if (area, day) != current:
+                    current = (area, day)
+                    slot = slots[current] = _Slot()
+                slot.minutes.append(minute)
+                slot.ratings.append(rating)
+                slot.drivers.append(username)
+                drivers[username].entries.append((current, minute))
+        finally:
+            conn.rollback()
+        self._slots, self._drivers = slots, drivers
+        self.loads += 1
+        self.load_seconds = time.perf_counter() - start
+        log.info("matching.loaded", drivers=len(drivers), entries=self.entries(),
+                 seconds=round(self.load_seconds, 3))
+
+    def _remove(self, username: str):
+        driver = self._drivers.pop(username, None)
+        if driver is None:
+            return
+        for key, minute in driver.entries:
+            slot = self._slots.get(key)
+            if slot is not None:
+                slot.remove(minute, username)
+                if not slot.drivers:
+                    del self._slots[key]
+
+    def _reload(self, conn, username: str):
+        self._remove(username)
+        row = conn.execute(_DRIVER_SQL + " AND username=?", (username,)).fetchone()
+        if row is None:
+            return
+        driver = self._drivers[username] = _Driver(*row[1:4], row[4:])
+        for day, area, minute, rating in conn.execute(
+                "SELECT day, area, minute, min_rating FROM driver_commutes WHERE driver=?",
+                (username,)):
+            key = (area, day)
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+            slot.add(minute, rating, username)
+            driver.entries.append((key, minute))
+        self.updates += 1
+
+    def _catch_up(self):
+        conn = self._connection()
+        if not self.loads:
+            self._load(conn)
+            return
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return  # nobody committed anything since the last check
+        self._data_version = version
+        changes = conn.execute("SELECT id, driver FROM commute_changes WHERE id > ? ORDER BY id",
+                               (self._applied,)).fetchall()
+        if not changes:
+            return
+        if changes[0][0] != self._applied + 1 or any(d is None for _, d in changes):
+            self._load(conn)  # fell behind the kept log, or everything changed
+            return
+        for username in dict.fromkeys(d for _, d in changes):
+            self._reload(conn, username)
+        self._applied = changes[-1][0]
+
+    def search(self, area: str, day: str, minute: int, min_rating: float, tolerance: int):
+        """search_valid_drivers() from memory: day is a *_commute column, minute a minute of day."""
+        with self._lock:
+            try:
+                self._catch_up()
+            except sqlite3.Error as e:  # serve what we have; the next search retries
+                log.warning("matching.catch_up_failed", error=str(e))
+            self.searches += 1
+            slot = self._slots.get((area, day[:3]))
+            if slot is None:
+                return NO_MATCH
+            lo = bisect_left(slot.minutes, max(minute - tolerance, 0))
+            hi = bisect_right(slot.minutes, minute + tolerance)
+            best = {}
+            for m, rating, username in zip(slot.minutes[lo:hi], slot.ratings[lo:hi],
+                                           slot.drivers[lo:hi]):
+                if rating <= min_rating:
+                    off = m - minute if m >= minute else minute - m
+                    if off < best.get(username, 1440):
+                        best[username] = off
+            if not best:
+                return NO_MATCH
+            drivers = self._drivers
+            matched = []
+            for off, username in sorted(zip(best.values(), best.keys())):
+                driver = drivers[username]
+                matched.append({
+                    "username": username,
+                    "name": driver.name,
+                    "area": driver.area,
+                    "min_passenger_rating": driver.min_rating,
+                    "commute_times": driver.times(day),
+                    "minutes_off": off,
+                })
+            return matched
+
+    def entries(self) -> int:
+        return sum(len(slot.drivers) for slot in self._slots.values())
+
+    def verify(self) -> list:
+        """Usernames whose in-memory entries differ from the database (empty if consistent)."""
+        expected = MatchIndex()
+        expected.load()
+        expected.close()
+        with self._lock:
+            self._catch_up()
+            actual = self._snapshot_entries()
+        wanted = expected._snapshot_entries()
+        return sorted(u for u in actual.keys() | wanted.keys() if actual.get(u) != wanted.get(u))
+
+    def _snapshot_entries(self) -> dict:
+        entries = {}
+        for key, slot in self._slots.items():
+            for minute, rating, username in zip(slot.minutes, slot.ratings, slot.drivers):
+                entries.setdefault(username, []).append((key, minute, rating))
+        for username, driver in self._drivers.items():
+            entries.setdefault(username, []).append(
+                (driver.name, driver.area, driver.min_rating, driver.raw))
+        return {u: sorted(e, key=repr) for u, e in entries.items()}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"drivers": len(self._drivers), "slots": len(self._slots),
+                    "entries": self.entries(), "applied_change": self._applied,
+                    "loads": self.loads, "updates": self.updates, "searches": self.searches,
+                    "load_seconds": round(self.load_seconds, 3)}
+
+
+def enable() -> MatchIndex:
+    """Load the index and let search_valid_drivers answer from it."""
+    index = MatchIndex()
+    index.load()
+    database.matcher = index
+    stats.register_source("matching", index.snapshot)
+    return index
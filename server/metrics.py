@@ -0,0 +1,250 @@
+"""Always-on request metrics.
+
+Recorded per command: request count, error count and a latency histogram.
+Server-wide: bytes received/sent, active connections and the time spent
+waiting for the database write lock (BEGIN IMMEDIATE). Recording is a
+bisect and a few integer increments under an uncontended lock, cheap
+enough to leave on.
+
+The numbers are reported under "metrics" by the stats command (with
+p50/p95/p99 estimated from the histogram buckets), as Prometheus text by
+the metrics command, and over HTTP at /metrics with --metrics-port.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stats
+
+# Histogram bucket upper bounds in seconds, as in Prometheus' "le" labels.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram."""
+
+    __slots__ = ("_lock", "counts", "total", "count")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.total += seconds
+            self.count += 1
+
+    def copy(self):
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+    @staticmethod
+    def quantile(counts, count, q: float):
+        """Estimate the q-quantile by interpolating inside its bucket."""
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+    def summary(self) -> dict:
+        counts, total, count = self.copy()
+        result = {"count": count, "avg_ms": round(total / count * 1000, 3) if count else None}
+        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            value = self.quantile(counts, count, q)
+            result[name] = round(value * 1000, 3) if value is not None else None
+        return result
+
+
+class CommandMetrics:
+    __slots__ = ("errors", "latency")
+
+    def __init__(self):
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self.db_lock_wait = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.timeouts = {}  # connection state when reaped -> count
+        self.rejected = 0
+        self.limited = {}   # rate class -> requests refused by the rate limiter
+
+    def _command(self, name: str) -> CommandMetrics:
+        entry = self._commands.get(name)
+        if entry is None:
+            with self._lock:
+                entry = self._commands.setdefault(name, CommandMetrics())
+        return entry
+
+    def observe(self, command: str, seconds: float, error: bool = False):
+        """Record one request of a command (use "invalid" for unknown names)."""
+        entry = self._command(command)
+        entry.latency.observe(seconds)
+        if error:
+            with self._lock:
+                entry.errors += 1
+
+    def traffic(self, received: int, sent: int):
+        with self._lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections -= 1
+
+    def connection_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def rate_limited(self, rate_class: str):
+        with self._lock:
+            self.limited[rate_class] = self.limited.get(rate_class, 0) + 1
+
+    def timeout(self, state: str):
+        """Count a connection closed for overstaying a deadline ("idle", "reading", "writing")."""
+        with self._lock:
+            self.timeouts[state] = self.timeouts.get(state, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            commands = dict(self._commands)
+            errors = {name: entry.errors for name, entry in commands.items()}
+            totals = {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                      "active_connections": self.connections,
+                      "rejected_connections": self.rejected,
+                      "timeouts": dict(self.timeouts),
+                      "rate_limited": dict(self.limited)}
+        result = {
+            "commands": {
+                name: dict(entry.latency.summary(), errors=errors[name])
+                for name, entry in sorted(commands.items())
+            },
+            "db_lock_wait": self.db_lock_wait.summary(),
+        }
+        result.update(totals)
+        return result
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            commands = sorted(self._commands.items())
+            errors = {name: entry.errors for name, entry in commands}
+            bytes_in, bytes_out, connections = self.bytes_in, self.bytes_out, self.connections
+            rejected, timeouts = self.rejected, sorted(self.timeouts.items())
+            limited = sorted(self.limited.items())
+
+        lines = [
+            "# HELP aubus_requests_total Requests handled, by command.",
+            "# TYPE aubus_requests_total counter",
+        ]
+        histograms = [(name, entry.latency.copy()) for name, entry in commands]
+        for name, (_, _, count) in histograms:
+            lines.append(f'aubus_requests_total{{command="{name}"}} {count}')
+        lines += [
+            "# HELP aubus_request_errors_total Requests answered with an error, by command.",
+            "# TYPE aubus_request_errors_total counter",
+        ]
+        for name, _ in commands:
+            lines.append(f'aubus_request_errors_total{{command="{name}"}} {errors[name]}')
+        lines += [
+            "# HELP aubus_request_duration_seconds Time spent running a command.",
+            "# TYPE aubus_request_duration_seconds histogram",
+        ]
+        for name, data in histograms:
+            _histogram_lines(lines, "aubus_request_duration_seconds", data, f'command="{name}",')
+        lines += [
+            "# HELP aubus_db_lock_wait_seconds Time spent waiting for the database write lock.",
+            "# TYPE aubus_db_lock_wait_seconds histogram",
+        ]
+        _histogram_lines(lines, "aubus_db_lock_wait_seconds", self.db_lock_wait.copy(), "")
+        lines += [
+            "# HELP aubus_received_bytes_total Request bytes read from clients.",
+            "# TYPE aubus_received_bytes_total counter",
+            f"aubus_received_bytes_total {bytes_in}",
+            "# HELP aubus_sent_bytes_total Reply bytes written to clients.",
+            "# TYPE aubus_sent_bytes_total counter",
+            f"aubus_sent_bytes_total {bytes_out}",
+            "# HELP aubus_active_connections Client connections currently open.",
+            "# TYPE aubus_active_connections gauge",
+            f"aubus_active_connections {connections}",
+            "# HELP aubus_rejected_connections_total Connections refused at the connection limit.",
+            "# TYPE aubus_rejected_connections_total counter",
+            f"aubus_rejected_connections_total {rejected}",
+            "# HELP aubus_connection_timeouts_total Connections closed for missing a deadline, "
+            "by the state they were in.",
+            "# TYPE aubus_connection_timeouts_total counter",
+        ]
+        lines += [f'aubus_connection_timeouts_total{{state="{state}"}} {count}'
+                  for state, count in timeouts]
+        lines += [
+            "# HELP aubus_rate_limited_total Requests refused by the per-client rate limiter.",
+            "# TYPE aubus_rate_limited_total counter",
+        ]
+        lines += [f'aubus_rate_limited_total{{class="{name}"}} {count}'
+                  for name, count in limited]
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(lines, metric, data, labels):
+    counts, total, count = data
+    cumulative = 0
+    for bound, n in zip(BUCKETS, counts):
+        cumulative += n
+        lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_bucket{{{labels}le="+Inf"}} {count}')
+    labels = labels.rstrip(",")
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{metric}_sum{suffix} {total}")
+    lines.append(f"{metric}_count{suffix} {count}")
+
+
+metrics = Metrics()
+stats.register_source("metrics", metrics.snapshot)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the console
+
+
+def serve_http(host: str, port: int):
+    """Serve /metrics for Prometheus scrapes on a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,263 @@
+"""Bulk-load a synthetic AUBus database for scale testing.
+
+Generates N users (M of them drivers) with realistic shape:
+  - areas drawn from a skewed distribution (a few busy neighbourhoods)
+  - driver commute windows on most weekdays, departures clustered around
+    07:30-08:00 and returns around 17:00, as update_availability stores them
+  - pending queues on drivers (ride_requests/driver_requests), made of
+    requests from passengers in their area that match their schedule
+  - passengers' completed ride histories and some active rides, which also
+    appear, accepted, in the driver's queue
+  - chat logs for those rides in ride_messages
+
+Rows are built in Python and inserted with executemany() inside a single
+transaction (with synchronous=OFF while loading), which is orders of
+magnitude faster than calling register_user() per row. Every generated
+user's password is "pw".
+
+Usage: python populate.py --db big.db --users 1000000 --drivers 100000
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import time
+
+import database
+
+AREAS = {  # area -> relative weight
+    "Hamra": 20, "Achrafieh": 14, "Verdun": 10, "Ras Beirut": 9, "Mar Mikhael": 6,
+    "Jounieh": 8, "Dbayeh": 6, "Baabda": 7, "Hazmieh": 5, "Aley": 4,
+    "Byblos": 3, "Khaldeh": 4, "Dora": 4,
+}
+DAY_COLUMNS = ["mon_commute", "tue_commute", "wed_commute", "thu_commute",
+               "fri_commute", "sat_commute", "sun_commute"]
+DAY_ACTIVE = [0.9, 0.9, 0.9, 0.9, 0.85, 0.2, 0.05]  # chance a driver commutes that day
+DEPARTURES = {"06:45": 2, "07:00": 6, "07:15": 8, "07:30": 14, "07:45": 12, "08:00": 14,
+              "08:15": 6, "08:30": 6, "09:00": 4, "09:30": 2, "10:00": 2}
+RETURNS = {"14:00": 2, "15:00": 4, "15:30": 3, "16:00": 8, "16:30": 6, "17:00": 12,
+           "17:30": 8, "18:00": 6, "19:00": 2}
+PHRASES = [
+    "I'm at the main gate.", "Running five minutes late, sorry!", "See you at 8.",
+    "Can you pick me up near Bliss street?", "On my way.", "Thanks for the ride!",
+    "Traffic is terrible today.", "I'll be wearing a blue jacket.", "Are you outside?",
+]
+USER_COLUMNS = (
+    "username, name, email, password, area, is_driver, min_passenger_rating, "
+    "driver_rating, driver_rating_count, pending_requests, passenger_rating, "
+    "passenger_rating_count, " + ", ".join(DAY_COLUMNS) + ", active_rides, completed_rides"
+)
+
+
+class Generated:
+    """What was generated, for tools (e.g. loadgen.py) that need valid ids."""
+
+    def __init__(self):
+        self.drivers = []     # {"username", "area", "days": {"mon": "07.30-17.00", ...}}
+        self.passengers = []  # {"username", "area"}
+        self.rides = []       # ride ids that have chat history
+        self.counts = {}
+
+
+def _weighted(rng, table):
+    names = list(table)
+    cumulative = list(itertools.accumulate(table.values()))
+    return lambda: rng.choices(names, cum_weights=cumulative)[0]
+
+
+def _ride_id(rng):
+    h = "%032x" % rng.getrandbits(128)
+    return f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{h[16:20]}-{h[20:]}"
+
+
+def _below(rng, n):
+    """Uniform int in [0, n); much cheaper than rng.randrange in the hot loops."""
+    return int(rng.random() * n)
+
+
+def _make_drivers(rng, count, pick_area, gen):
+    pick_departure = _weighted(rng, DEPARTURES)
+    pick_return = _weighted(rng, RETURNS)
+    drivers = []
+    for i in range(count):
+        area = pick_area()
+        columns = []
+        days = {}
+        for column, chance in zip(DAY_COLUMNS, DAY_ACTIVE):
+            if rng.random() < chance:
+                window = {"from": pick_departure(), "to": pick_return()}
+                days[column[:3]] = f"{window['from'].replace(':', '.')}-{window['to'].replace(':', '.')}"
+                columns.append(json.dumps(window))
+            else:
+                columns.append("[]")
+        rating = round(3.5 + rng.random() * 1.5, 2)
+        drivers.append({
+            "username": f"driver{i}", "name": f"Driver {i}", "area": area, "days": days,
+            "columns": columns, "rating": rating, "rating_count": 1 + _below(rng, 200),
+            "min_rating": rng.choice([0.0] * 6 + [3.0, 3.5, 4.0, 4.5]),
+            "pending": [], "day_list": list(days.items()),
+        })
+        gen.drivers.append({"username": f"driver{i}", "area": area, "days": days})
+    return drivers
+
+
+def _ride(rng, driver, passenger, status):
+    days = driver["day_list"]
+    day, window = days[_below(rng, len(days))] if days else ("mon", "08.00-17.00")
+    return {
+        "id": _ride_id(rng),
+        "driver": driver["username"],
+        "driver_name": driver["name"],
+        "area": passenger["area"],
+        "day": f"{day}_commute",
+        "time": window.split("-")[0].replace(".", ":"),
+        "status": status,
+        "passenger": passenger["username"],
+        "passenger_name": passenger["name"],
+    }
+
+
+def _pending_entry(ride, min_rating, accepted_by=None):
+    return {
+        "id": ride["id"], "passenger": ride["passenger"], "passenger_name": ride["passenger_name"],
+        "area": ride["area"], "day": ride["day"], "time": ride["time"], "min_rating": min_rating,
+        "status": ride["status"], "accepted_by": accepted_by,
+    }
+
+
+def populate(db_path, users, drivers, seed=1, history=3, pending=2, active=0.1, messages=4,
+             progress=print) -> Generated:
+    """Create db_path (which must not exist) and fill it; returns a Generated summary."""
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} already exists; populate only builds new databases.")
+    if drivers > users:
+        raise ValueError("drivers cannot exceed users.")
+    rng = random.Random(seed)
+    gen = Generated()
+    started = time.perf_counter()
+
+    database.DB_FILE = db_path
+    database.init_db()
+
+    pick_area = _weighted(rng, AREAS)
+    driver_rows = _make_drivers(rng, drivers, pick_area, gen)
+    by_area = {}
+    for d in driver_rows:
+        by_area.setdefault(d["area"], []).append(d)
+
+    timestamps = [f"2026-{rng.randint(1, 9):02d}-{rng.randint(1, 28):02d} "
+                  f"{rng.randint(6, 20):02d}:{rng.randint(0, 59):02d}:00" for _ in range(4096)]
+    message_rows = []
+    passenger_rows = []
+    ride_count = 0
+    for i in range(users - drivers):
+        passenger = {"username": f"student{i}", "name": f"Student {i}", "area": pick_area()}
+        gen.passengers.append({"username": passenger["username"], "area": passenger["area"]})
+        completed, current = [], []
+        local = by_area.get(passenger["area"]) or driver_rows
+        if local:
+            for _ in range(_below(rng, 2 * history + 1)):
+                completed.append(_ride(rng, local[_below(rng, len(local))], passenger, "completed"))
+            if rng.random() < active:
+                driver = local[_below(rng, len(local))]
+                ride = _ride(rng, driver, passenger, "active")
+                current.append(ride)
+                driver["pending"].append(_pending_entry(ride, 0.0, driver["username"]))
+        for ride in completed[-2:] + current:
+            if messages:
+                gen.rides.append(ride["id"])
+                for n in range(1 + _below(rng, 2 * messages)):
+                    sender, recipient = ((ride["passenger"], ride["driver"]) if n % 2 == 0
+                                         else (ride["driver"], ride["passenger"]))
+                    message_rows.append((ride["id"], sender, recipient,
+                                         PHRASES[_below(rng, len(PHRASES))],
+                                         timestamps[_below(rng, len(timestamps))]))
+        ride_count += len(completed) + len(current)
+        passenger_rows.append((
+            passenger["username"], passenger["name"], f"{passenger['username']}@mail.aub.edu", "pw",
+            passenger["area"], 0, 0.0, 5.0, 1, "[]",
+            round(3.0 + rng.random() * 2.0, 2), 1 + _below(rng, 60),
+            *["[]"] * 7, json.dumps(current), json.dumps(completed),
+        ))
+
+    passengers_by_area = {}
+    for p in gen.passengers:
+        passengers_by_area.setdefault(p["area"], []).append(p)
+    for d in driver_rows:
+        local = passengers_by_area.get(d["area"])
+        for _ in range(_below(rng, 2 * pending + 1) if local else 0):
+            p = local[_below(rng, len(local))]
+            ride = _ride(rng, d, {**p, "name": f"Student {p['username'][7:]}"}, "pending")
+            d["pending"].append(_pending_entry(ride, 0.0))
+
+    def driver_tuples():
+        for d in driver_rows:
+            yield (d["username"], d["name"], f"{d['username']}@mail.aub.edu", "pw", d["area"], 1,
+                   d["min_rating"], d["rating"], d["rating_count"], "[]",
+                   5.0, 1, *d["columns"], "[]", "[]")
+
+    generated_at = time.perf_counter()
+    placeholders = ", ".join("?" * (12 + len(DAY_COLUMNS) + 2))
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA synchronous=OFF")
+        with conn:  # one transaction for everything
+            conn.executemany(f"INSERT INTO users ({USER_COLUMNS}) VALUES ({placeholders})",
+                             driver_tuples())
+            conn.executemany(f"INSERT INTO users ({USER_COLUMNS}) VALUES ({placeholders})",
+                             passenger_rows)
+            conn.executemany(
+                "INSERT INTO ride_messages (ride_id, sender, recipient, message, created_at) "
+                "VALUES (?, ?, ?, ?, ?)", message_rows)
+            conn.executemany(
+                f"INSERT INTO ride_requests ({', '.join(database.REQUEST_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(database.REQUEST_FIELDS))})",
+                (tuple(entry[f] for f in database.REQUEST_FIELDS)
+                 for d in driver_rows for entry in d["pending"]))
+            conn.executemany(
+                "INSERT INTO driver_requests (driver, request_id) VALUES (?, ?)",
+                ((d["username"], entry["id"]) for d in driver_rows for entry in d["pending"]))
+    finally:
+        conn.close()
+    database.rebuild_commutes()  # the bulk insert bypassed register_user
+
+    gen.counts = {
+        "users": users, "drivers": drivers, "rides": ride_count,
+        "pending": sum(len(d["pending"]) for d in driver_rows), "messages": len(message_rows),
+    }
+    done = time.perf_counter()
+    progress(f"Generated in {generated_at - started:.1f}s, inserted in {done - generated_at:.1f}s: "
+             + ", ".join(f"{v} {k}" for k, v in gen.counts.items()))
+    return gen
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True,
+                        help="database file to create (never the server's by default)")
+    parser.add_argument("--users", type=int, default=10000, help="total users")
+    parser.add_argument("--drivers", type=int, default=None, help="drivers among them (default 20%%)")
+    parser.add_argument("--history", type=int, default=3, help="average completed rides per passenger")
+    parser.add_argument("--pending", type=int, default=2, help="average pending requests per driver")
+    parser.add_argument("--active", type=float, default=0.1, help="share of passengers on an active ride")
+    parser.add_argument("--messages", type=int, default=4, help="average chat messages per recent ride")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--force", action="store_true",
+                        help="replace an existing database file (and its -wal/-shm files)")
+    args = parser.parse_args(argv)
+
+    drivers = args.drivers if args.drivers is not None else args.users // 5
+    if args.force:
+        # A stale WAL left next to the new file would be replayed into it.
+        for path in (args.db, args.db + "-wal", args.db + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    populate(args.db, args.users, drivers, args.seed, args.history, args.pending,
+             args.active, args.messages)
+
+
+if __name__ == "__main__":
+    main()
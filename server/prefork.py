@@ -0,0 +1,191 @@
+"""Pre-fork multi-process serving.
+
+The supervisor forks N worker processes. Each one opens its own listening
+socket on the same port with SO_REUSEPORT, so the kernel spreads incoming
+connections across them and request handling is no longer limited to one
+core by the GIL. Workers that die are restarted, with a growing delay if
+they keep crashing right after starting.
+
+All workers share the SQLite database. It runs in WAL mode, so their
+reads run concurrently, and write transactions start with BEGIN IMMEDIATE,
+which sqlite serialises across processes (see database.ConnectionCache).
+Subscriptions live in the process that
+accepted the connection, so every worker forwards the write events it
+commits to its siblings over Unix datagram sockets (EventRelay).
+
+SIGTERM/SIGINT are forwarded to the workers, which drain gracefully (see
+shutdown.py). SIGHUP handoff is single-process only.
+"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import log
+import pubsub
+import tracing
+
+MIN_UPTIME = 5.0          # a worker exiting sooner than this counts as a crash loop
+MAX_RESTART_DELAY = 30.0  # upper bound for the restart backoff
+MAX_EVENT_SIZE = 65536    # largest event datagram forwarded between workers
+
+
+def supported() -> bool:
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+def check_port(host: str, port: int):
+    """Fail fast (OSError) if the port is held by a non-SO_REUSEPORT socket."""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        probe.bind((host, port))
+    finally:
+        probe.close()
+
+
+class EventRelay:
+    """Forwards committed-write events to the sibling worker processes.
+
+    forward() is registered with database.add_listener() and never blocks:
+    if a sibling is restarting or its socket buffer is full the event is
+    dropped for it, and its subscribers resync when they reconnect.
+    """
+
+    def __init__(self, directory: str, index: int, processes: int):
+        self._peers = [self._path(directory, i) for i in range(processes) if i != index]
+        path = self._path(directory, index)
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by the crashed worker this one replaces
+        self._inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._inbox.bind(path)
+        self._outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._outbox.setblocking(False)
+        self.forwarded = 0
+        self.received = 0
+        self.lost = 0
+        threading.Thread(target=self._receive, name="event-relay", daemon=True).start()
+
+    @staticmethod
+    def _path(directory: str, index: int) -> str:
+        return os.path.join(directory, f"worker-{index}.sock")
+
+    def forward(self, event: str, data: dict):
+        message = json.dumps([event, data]).encode()
+        if len(message) > MAX_EVENT_SIZE:
+            self.lost += len(self._peers)
+            return
+        for peer in self._peers:
+            try:
+                self._outbox.sendto(message, peer)
+                self.forwarded += 1
+            except OSError:
+                self.lost += 1
+
+    def _receive(self):
+        while True:
+            message = self._inbox.recv(MAX_EVENT_SIZE)
+            try:
+                event, data = json.loads(message)
+                pubsub.route_db_event(event, data)
+                self.received += 1
+            except Exception as e:
+                log.error("relay.failed", exc_info=True, error=str(e))
+
+    def snapshot(self) -> dict:
+        return {"forwarded": self.forwarded, "received": self.received, "lost": self.lost}
+
+
+class Supervisor:
+    """Forks worker processes running run_worker(index, event_dir) and keeps them alive."""
+
+    def __init__(self, processes: int, run_worker):
+        self.processes = processes
+        self.run_worker = run_worker
+        self.event_dir = tempfile.mkdtemp(prefix="aubus-events-")
+        self.restarts = 0
+        self._children = {}  # pid -> worker index
+        self._started = {}   # worker index -> start time
+        self._delay = {}     # worker index -> current restart delay
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        sys.stdout.flush()  # don't let the child inherit and re-print buffered output
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self.run_worker(index, self.event_dir)
+                code = 0
+            except KeyboardInterrupt:
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                log.error("worker.crashed", exc_info=True, worker=index, error=repr(e))
+            finally:
+                tracing.close()
+                log.close()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self._children[pid] = index
+        self._started[index] = time.monotonic()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _hangup(self, signum, frame):
+        log.warning("supervisor.handoff_unsupported",
+                    hint="start the new server on the same port, then SIGTERM this one")
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM/SIGINT."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._hangup)
+        log.info("supervisor.start", pid=os.getpid(), processes=self.processes)
+        try:
+            for index in range(self.processes):
+                self._spawn(index)
+            while self._children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                index = self._children.pop(pid, None)
+                if index is None or self._stopping:
+                    continue
+                self._restart(index, status)
+        finally:
+            shutil.rmtree(self.event_dir, ignore_errors=True)
+
+    def _restart(self, index: int, status: int):
+        uptime = time.monotonic() - self._started[index]
+        if uptime < MIN_UPTIME:
+            delay = min(self._delay.get(index, 0.5) * 2, MAX_RESTART_DELAY)
+        else:
+            delay = 0.5
+        self._delay[index] = delay
+        code = os.waitstatus_to_exitcode(status)
+        log.warning("supervisor.worker_exited", worker=index, code=code,
+                    uptime=round(uptime, 1), restart_in=delay)
+        time.sleep(delay)
+        if not self._stopping:
+            self.restarts += 1
+            self._spawn(index)
@@ -0,0 +1,228 @@
+"""Server-push subscriptions for chat messages and ride request updates.
+
+A framed connection subscribes to topics with "subscribe:<topic>":
+  ride:<ride_id>   new chat messages of that ride
+  user:<username>  pending requests, accepted/completed rides and expired
+                   requests of that user
+The write paths in database.py report committed changes through
+database.add_listener(); each one is published to the matching topics and
+pushed to every subscribed connection as a FLAG_EVENT frame holding
+"event:<json>".
+
+Pushing never blocks the writer: each connection has a bounded backlog and
+a subscriber that falls too far behind is disconnected (its client
+reconnects and resynchronises).
+"""
+
+import json
+import queue
+import threading
+
+import stats
+from commands import Arg, Reply, command, current_channel
+from database import add_listener
+from protocol import FLAG_EVENT, encode_frame
+
+MAX_TOPICS_PER_CHANNEL = 64
+MAX_BACKLOG = 256                # queued events per threaded subscriber
+MAX_WRITE_BUFFER = 1024 * 1024   # bytes buffered per asyncio subscriber
+TOPIC_PREFIXES = ("ride:", "user:")
+
+
+class Broker:
+    """Maps topics to the channels subscribed to them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = {}  # topic -> set of channels
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, channel, topic: str) -> bool:
+        with self._lock:
+            if topic not in channel.topics and len(channel.topics) >= MAX_TOPICS_PER_CHANNEL:
+                return False
+            self._topics.setdefault(topic, set()).add(channel)
+            channel.topics.add(topic)
+            return True
+
+    def unsubscribe(self, channel, topic: str):
+        with self._lock:
+            self._remove(channel, topic)
+
+    def unsubscribe_all(self, channel):
+        with self._lock:
+            for topic in list(channel.topics):
+                self._remove(channel, topic)
+
+    def _remove(self, channel, topic):
+        channel.topics.discard(topic)
+        subscribers = self._topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(channel)
+            if not subscribers:
+                del self._topics[topic]
+
+    def publish(self, topics, event: dict):
+        """Push an event once to every channel subscribed to any of the topics."""
+        with self._lock:
+            channels = set()
+            for topic in topics:
+                channels.update(self._topics.get(topic, ()))
+            self.published += 1
+        if not channels:
+            return
+
+        frame = encode_frame(("event:" + json.dumps(event)).encode(), FLAG_EVENT)
+        lagging = [channel for channel in channels if not channel.push(frame)]
+        with self._lock:
+            self.delivered += len(channels) - len(lagging)
+            self.dropped += len(lagging)
+        for channel in lagging:
+            self.unsubscribe_all(channel)
+            channel.disconnect()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "topics": len(self._topics),
+                "subscriptions": sum(len(s) for s in self._topics.values()),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped_subscribers": self.dropped,
+            }
+
+
+class ThreadedChannel:
+    """Push channel of a thread-per-connection socket.
+
+    Replies and pushed events share the socket, so both are written under
+    write_lock. Events go through a bounded queue drained by a writer
+    thread that is started on the first subscription.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.topics = set()
+        self.write_lock = threading.Lock()
+        self._queue = queue.Queue(MAX_BACKLOG)
+        self._writer = None
+        self._start_lock = threading.Lock()
+
+    def push(self, frame: bytes) -> bool:
+        if self._writer is None:
+            with self._start_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._drain, daemon=True)
+                    self._writer.start()
+        try:
+            self._queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            return False
+
+    def send(self, data: bytes):
+        with self.write_lock:
+            self.conn.sendall(data)
+
+    def _drain(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            try:
+                self.send(frame)
+            except OSError:
+                return
+
+    def disconnect(self):
+        try:
+            self.conn.shutdown(2)  # SHUT_RDWR: wakes the connection's reader
+        except OSError:
+            pass
+
+    def close(self):
+        if self._writer is not None:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+
+class AsyncChannel:
+    """Push channel of an asyncio connection; writes happen on the event loop."""
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.topics = set()
+
+    def push(self, frame: bytes) -> bool:
+        transport = self.writer.transport
+        if transport.is_closing() or transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, frame)
+        except RuntimeError:  # loop already closed
+            return False
+        return True
+
+    def disconnect(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass
+
+    def close(self):
+        pass
+
+
+broker = Broker()
+stats.register_source("subscriptions", broker.snapshot)
+
+
+def route_db_event(event: str, data: dict):
+    """database.py listener: route committed writes to topics."""
+    if event == "message":
+        broker.publish([f"ride:{data['ride_id']}"],
+                       {"type": "message", "ride_id": data["ride_id"], "message": data["message"]})
+    elif event == "pending_added":
+        broker.publish([f"user:{data['driver']}"],
+                       {"type": "pending_added", "driver": data["driver"], "request": data["request"]})
+    elif event == "request_expired":
+        broker.publish([f"user:{data['passenger']}"],
+                       {"type": "request_expired", "request_id": data["request_id"],
+                        "passenger": data["passenger"]})
+    elif event in ("request_accepted", "request_completed"):
+        users = [data["driver"], data["passenger"], *data.get("withdrawn_from", ())]
+        broker.publish([f"user:{u}" for u in users if u], {
+            "type": event,
+            "request_id": data["request_id"],
+            "driver": data["driver"],
+            "passenger": data["passenger"],
+            "ride": data["ride"],
+        })
+
+
+add_listener(route_db_event)
+
+
+@command("subscribe", Arg("topic", greedy=True, sensitive="topic"))
+def handle_subscribe(topic):
+    channel = current_channel()
+    if channel is None:
+        return Reply("error", "Subscriptions need a framed connection.")
+    if not topic.startswith(TOPIC_PREFIXES) or topic.endswith(":"):
+        return Reply("error", "Unknown topic.")
+    if not broker.subscribe(channel, topic):
+        return Reply("error", f"Too many subscriptions (max {MAX_TOPICS_PER_CHANNEL}).")
+    return Reply("success", {"topic": topic})
+
+
+@command("unsubscribe", Arg("topic", greedy=True, sensitive="topic"))
+def handle_unsubscribe(topic):
+    channel = current_channel()
+    if channel is not None:
+        broker.unsubscribe(channel, topic)
+    return Reply("success", {"topic": topic})
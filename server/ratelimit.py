@@ -0,0 +1,126 @@
+"""Per-user and per-address rate limiting with token buckets.
+
+Every command belongs to a rate class (Command.rate_class, None for
+exempt commands like batch, whose sub-commands are limited one by one).
+When limiting is on (server.py --rate-limit) each request takes a token
+from two buckets of its class, whatever connection it arrives on: one
+for the client's IP address and one for the username it acts as (its
+first Arg marked sensitive="user") from that address. Usernames are
+whatever the client sends, so the user bucket is keyed by (username,
+address): bad login attempts for a victim's name from elsewhere cannot
+lock the victim out. The IP bucket is IP_FACTOR times larger, since many
+users can share an address behind NAT. A request that finds either
+bucket empty is answered "busy:<seconds>" (["busy", seconds] for binary
+requests), the time until a token is available, which clients already
+treat as a back-off hint.
+
+Buckets are kept in one LRU dict. A bucket that has been idle long
+enough to refill completely holds no information, so such buckets are
+swept from the old end as new ones are added, and the dict never grows
+past MAX_BUCKETS (the least recently used are evicted first): memory
+stays proportional to the clients that are actually active. Limits are
+per process; with --processes N a client can get up to N times the rate.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import log
+import stats
+from metrics import metrics
+
+# rate class -> (tokens per second, burst)
+DEFAULT_RATES = {
+    "auth": (1.0, 10),     # register/login: password guessing, signup floods
+    "fanout": (0.5, 5),    # request_ride: matching plus a queue write per offered driver
+    "write": (5.0, 20),
+    "read": (20.0, 60),
+    "poll": (10.0, 30),    # get_messages, polled by every open chat window; stats/metrics
+}
+IP_FACTOR = 10.0
+MAX_BUCKETS = 100000
+SWEEP_BATCH = 8  # refilled buckets dropped per request at most
+
+
+class RateLimiter:
+    def __init__(self, rates=None, ip_factor: float = IP_FACTOR, max_buckets: int = MAX_BUCKETS):
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.ip_factor = ip_factor
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # (class, kind, *id) -> [tokens, updated, rate, burst]
+        self.limited = {}              # rate class -> rejected requests
+        self.evicted = 0
+
+    def _bucket(self, key, rate: float, burst: float, now: float):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now, rate, burst]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def _sweep(self, now: float):
+        """Drop refilled buckets from the LRU end and make room for two new ones."""
+        buckets = self._buckets
+        while buckets and len(buckets) > self.max_buckets - 2:
+            buckets.popitem(last=False)
+            self.evicted += 1
+        for _ in range(SWEEP_BATCH):
+            if not buckets:
+                return
+            key = next(iter(buckets))
+            tokens, updated, rate, burst = buckets[key]
+            if tokens + (now - updated) * rate < burst:
+                return  # still refilling; stop rather than scan the whole dict
+            del buckets[key]
+
+    def check(self, rate_class: str, username=None, ip=None) -> float:
+        """Take a token for the request; 0.0 if allowed, else seconds to back off."""
+        limit = self.rates.get(rate_class)
+        if limit is None or limit[0] <= 0:
+            return 0.0
+        rate, burst = limit
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            buckets = []
+            if username:
+                buckets.append(self._bucket((rate_class, "user", username, ip), rate, burst, now))
+            if ip:
+                buckets.append(self._bucket((rate_class, "ip", ip), rate * self.ip_factor,
+                                            burst * self.ip_factor, now))
+            wait = max([(1 - b[0]) / b[2] for b in buckets if b[0] < 1], default=0.0)
+            if wait:
+                self.limited[rate_class] = self.limited.get(rate_class, 0) + 1
+            else:
+                for b in buckets:
+                    b[0] -= 1
+        if wait:
+            metrics.rate_limited(rate_class)
+            log.warning("request.rate_limited", rate_class=rate_class, username=username,
+                        ip=ip, retry_after=round(wait, 3))
+            return max(round(wait, 2), 0.01)
+        return 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "rates": {c: {"per_second": r, "burst": b} for c, (r, b) in self.rates.items()},
+                "ip_factor": self.ip_factor,
+                "buckets": len(self._buckets),
+                "evicted": self.evicted,
+                "limited": dict(self.limited),
+            }
+
+
+limiter = None  # RateLimiter when enabled
+
+
+def enable(rates=None, ip_factor: float = IP_FACTOR):
+    global limiter
+    limiter = RateLimiter(rates, ip_factor)
+    stats.register_source("rate_limits", limiter.snapshot)
@@ -0,0 +1,272 @@
+"""Replay a traffic capture (server.py --record) against a server.
+
+Each captured client connection becomes a replay connection on its own
+thread, sending its requests in order. Requests are scheduled at their
+captured offset divided by --speed, so 1 reproduces the original pacing,
+N compresses it N times and "max" sends every request as soon as the
+previous reply on that connection arrives. Legacy (unframed) requests are
+sent on a fresh socket each, as the old client did.
+
+By default a throwaway server is started on an empty database; --prepare
+first registers every user the capture mentions (password "pw", as the
+recorder rewrote it), and --db replays against a copy of an existing
+database instead. --target replays against an already running server.
+Ride ids are replayed as captured, so commands naming rides created in
+the original run fail unless the database is a copy from that time.
+
+It reports throughput, per-command latency percentiles, error replies and
+how far the replay fell behind its schedule. --baseline/--save-baseline
+work as in loadgen.py.
+
+Usage:
+  python server.py --record traffic.cap          # in the deployment
+  python replay.py traffic.cap --speed 10 --prepare
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import capture
+import loadgen
+from commands import COMMANDS
+from protocol import (
+    FLAG_BINARY,
+    FLAG_EVENT,
+    MAGIC,
+    FrameDecoder,
+    ProtocolError,
+    decode_value,
+    encode_frame,
+    encode_value,
+    recv_frame,
+)
+
+DRIVER_COMMANDS = {"update_availability", "get_pending", "accept_request", "end_request",
+                   "rate_passenger"}
+
+
+def load(paths) -> dict:
+    """Captured requests grouped by (file, connection), each list in capture order."""
+    conns = {}
+    for index, path in enumerate(paths):
+        for micros, conn, mode, request in capture.read_capture(path):
+            conns.setdefault((index, conn), []).append((micros / 1e6, mode, request))
+    return conns
+
+
+def captured_users(conns: dict) -> dict:
+    """Usernames in the capture -> is_driver, skipping ones it registers itself."""
+    users, registered = {}, set()
+    for requests in conns.values():
+        for _, _, request in requests:
+            name = request[0].lower()
+            cmd = COMMANDS.get(name)
+            if cmd is None:
+                continue
+            if name == "register" and len(request) > 1:
+                registered.add(request[1])
+            for arg, value in zip(cmd.args, request[1:]):
+                if arg.sensitive == "user" and isinstance(value, str):
+                    is_driver = name in DRIVER_COMMANDS and arg.name in ("username", "driver")
+                    users[value] = users.get(value, False) or is_driver
+    return {u: d for u, d in users.items() if u not in registered}
+
+
+def prepare(host, port, users: dict):
+    client = loadgen.Client(host, port)
+    try:
+        for username, is_driver in users.items():
+            client.request(f"register:{username}:User {username}:{username}@example.invalid:"
+                           f"{capture.REPLAY_PASSWORD}:Hamra:{int(is_driver)}")
+    finally:
+        client.close()
+
+
+def is_error(reply) -> bool:
+    if isinstance(reply, str):
+        return reply.startswith(loadgen.ERROR_PREFIXES)
+    return isinstance(reply, list) and bool(reply) and reply[0] in ("error", "busy")
+
+
+class Connection:
+    """Sends one captured connection's requests, framed or legacy."""
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = None
+        self.decoder = FrameDecoder()
+
+    def _framed(self, payload: bytes, flags: int) -> bytes:
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address)
+            self.sock.sendall(MAGIC)
+        self.sock.sendall(encode_frame(payload, flags))
+        while True:
+            frame = recv_frame(self.sock, self.decoder)
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            reply_flags, body = frame
+            if not reply_flags & FLAG_EVENT:  # pushes for replayed subscriptions
+                return body
+
+    def send(self, mode: int, request: list):
+        if mode == capture.MODE_BINARY:
+            return decode_value(self._framed(encode_value(request), FLAG_BINARY))
+        message = ":".join(str(v) for v in request)
+        if mode == capture.MODE_TEXT:
+            return self._framed(message.encode(), 0).decode()
+        with socket.create_connection(self.address) as sock:
+            sock.sendall(message.encode())
+            return sock.recv(1 << 20).decode()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+def replay_connection(host, port, requests, speed, start, results):
+    latencies, errors, lag = {}, {}, []
+    conn = Connection(host, port)
+    try:
+        for offset, mode, request in requests:
+            if speed is not None:
+                due = start + offset / speed
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    lag.append(-wait)
+            name = request[0]
+            sent = time.perf_counter()
+            try:
+                reply = conn.send(mode, request)
+            except (OSError, ProtocolError, UnicodeDecodeError):
+                errors[name] = errors.get(name, 0) + 1
+                conn.close()
+                conn = Connection(host, port)
+                continue
+            latencies.setdefault(name, []).append(time.perf_counter() - sent)
+            if is_error(reply):
+                errors[name] = errors.get(name, 0) + 1
+    finally:
+        conn.close()
+    results.append((latencies, errors, lag))
+
+
+def run(args, conns: dict) -> dict:
+    speed = None if args.speed == "max" else float(args.speed)
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        if args.target:
+            host, _, port = args.target.rpartition(":")
+            port = int(port)
+        else:
+            db_path = os.path.join(tmp, "replay.db")
+            if args.db:
+                shutil.copyfile(args.db, db_path)
+            host, port = "127.0.0.1", args.port
+            server = loadgen.start_server(db_path, port, args.server_args.split())
+        try:
+            if args.prepare:
+                prepare(host, port, captured_users(conns))
+            results = []
+            start = time.monotonic()
+            threads = [threading.Thread(target=replay_connection,
+                                        args=(host, port, requests, speed, start, results))
+                       for requests in conns.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - start
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    latencies, errors, lag = {}, {}, []
+    for lat, err, behind in results:
+        for name, values in lat.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, count in err.items():
+            errors[name] = errors.get(name, 0) + count
+            latencies.setdefault(name, [])
+        lag += behind
+    for name in latencies:
+        errors.setdefault(name, 0)
+    result = loadgen.summarize(latencies, errors, elapsed)
+    lag.sort()
+    result["connections"] = len(conns)
+    result["elapsed_s"] = round(elapsed, 3)
+    result["late_requests"] = len(lag)
+    result["max_lag_ms"] = round(lag[-1] * 1000, 3) if lag else 0.0
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", nargs="+",
+                        help="capture file(s) written by server.py --record; pass every "
+                             "FILE.i of a --processes server to replay them together")
+    parser.add_argument("--speed", default="1",
+                        help="1 for real time, N for N times faster, or max (default 1)")
+    parser.add_argument("--prepare", action="store_true",
+                        help="register the capture's users before replaying")
+    parser.add_argument("--db", help="replay against a copy of this database instead of an empty one")
+    parser.add_argument("--port", type=int, default=12399, help="port for the throwaway server")
+    parser.add_argument("--server-args", default="", help="extra server.py arguments")
+    parser.add_argument("--target", metavar="HOST:PORT", help="replay against a running server")
+    parser.add_argument("--baseline", help="compare against this baseline JSON")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the result as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed relative regression before failing (default 0.15)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+    if args.speed != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed must be a positive number or max.")
+
+    try:
+        conns = load(args.capture)
+    except (OSError, ProtocolError) as e:
+        parser.error(str(e))
+    result = run(args, conns)
+    result["config"] = {"capture": [os.path.basename(p) for p in args.capture], "speed": args.speed,
+                        "prepare": args.prepare, "server_args": args.server_args}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        loadgen.print_report(result, baseline)
+        print(f"{result['connections']} connections, {result['late_requests']} requests "
+              f"behind schedule (max {result['max_lag_ms']} ms)")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    if baseline:
+        if baseline.get("config") != result["config"]:
+            print("warning: baseline was recorded with a different configuration")
+        problems = loadgen.compare(result, baseline, args.tolerance)
+        for p in problems:
+            print(f"REGRESSION: {p}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,246 +1,625 @@
+import argparse
+import asyncio
+import functools
+import os
+import select
+import signal
 import socket
+import sys
 import threading
-import json
-import uuid
-import base64
-from database import (
-    init_db,
-    register_user,
-    login_user,
-    db_lock,
-    edit_fields,
-    search_valid_drivers,
-    add_pending_request,
-    get_pending_requests,
-    delete_pending_request,
-    accept_pending_request,
-    complete_pending_request,
-    get_active_rides,
-    get_completed_rides,
-    add_active_ride,
-    remove_active_ride,
-    add_completed_ride,
-    remove_completed_ride,
-    rate_driver,
-    rate_passenger,
-    get_user_display_name,
-    add_ride_message,
-    get_ride_messages,
+import capture
+import compression
+import connections
+import database
+import handlers  # noqa: F401  (registers the client commands)
+import log
+import matching
+import metrics
+import prefork
+import pubsub
+import ratelimit
+import shutdown
+import stats
+import tracing
+from commands import command_priority, connection_context, dispatch, dispatch_value
+from database import init_db
+from protocol import (
+    FLAG_ACCEPT_COMPRESSED,
+    FLAG_BINARY,
+    FLAG_COMPRESSED,
+    HEADER,
+    RECV_SIZE,
+    T_LIST8,
+    T_LIST32,
+    T_STR8,
+    FrameDecoder,
+    ProtocolError,
+    decode_value,
+    decompress_payload,
+    encode_frame,
+    encode_value,
+    split_preamble,
 )
+from workers import Busy, WorkerPool
 
 
 HOST = '0.0.0.0'
 PORT = 12345
+DB_WORKERS = 8    # worker threads that run requests and their blocking database calls
+QUEUE_SIZE = 256  # requests that may wait for a worker before the server sheds load
 
-def handle_client(conn, addr):
-    print(f"New connection from {addr}")
-    message = conn.recv(1024).decode()
+recorder = None  # capture.Recorder when started with --record
+
+
+def process_request(message: str) -> str:
+    """Run a single colon-delimited command and return the response text."""
+    return dispatch(message)
+
+
+def handle_legacy(message: str, client: str = None) -> str:
+    """process_request for a legacy connection from the client IP address."""
+    with connection_context(None, client):
+        return dispatch(message)
+
+
+def handle_frame(flags: int, payload: bytes, channel=None, client: str = None) -> bytes:
+    """Answer one framed request, replying in the encoding it was sent in.
+
+    channel is the connection's push channel, used by subscribe; client is
+    the peer's IP address, used by the rate limiter.
+    """
+    with connection_context(channel, client):
+        return _handle_frame(flags, payload)
+
+
+def _handle_frame(flags: int, payload: bytes) -> bytes:
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload)
+
+    if flags & FLAG_BINARY:
+        try:
+            request = decode_value(payload)
+        except ProtocolError as e:
+            request, reply = None, ["error", str(e)]
+        else:
+            reply = dispatch_value(request)
+        name = request[0] if isinstance(request, list) and request and isinstance(request[0], str) else ""
+        body, reply_flags = encode_value(reply), FLAG_BINARY
+    else:
+        message = payload.decode()
+        name = message.partition(":")[0]
+        body, reply_flags = process_request(message).encode(), 0
+
+    if flags & FLAG_ACCEPT_COMPRESSED:
+        body, reply_flags = compression.compress_reply(name, body, reply_flags)
+    return encode_frame(body, reply_flags)
+
+
+def _peek_command(flags: int, payload: bytes) -> str:
+    """Command name of a framed request, read without parsing the whole frame."""
+    if flags & FLAG_COMPRESSED:
+        return ""
+    if not flags & FLAG_BINARY:
+        return payload[:64].partition(b":")[0].decode(errors="replace")
+    # Binary requests start with a list header followed by the name string.
+    if payload[:1] == bytes((T_LIST8,)):
+        pos = 2
+    elif payload[:1] == bytes((T_LIST32,)):
+        pos = 5
+    else:
+        return ""
+    if payload[pos:pos + 1] != bytes((T_STR8,)) or len(payload) < pos + 2:
+        return ""
+    size = payload[pos + 1]
+    return payload[pos + 2:pos + 2 + size].decode(errors="replace")
+
+
+def _busy_frame(flags: int, retry_after: float) -> bytes:
+    if flags & FLAG_BINARY:
+        return encode_frame(encode_value(["busy", retry_after]), FLAG_BINARY)
+    return encode_frame(f"busy:{retry_after}".encode())
+
+
+def submit_frame(pool: WorkerPool, flags: int, payload: bytes, channel=None, client=None):
+    """Queue a framed request on the pool; returns a Future or a busy reply frame."""
+    priority = command_priority(_peek_command(flags, payload))
     try:
-        fields = message.split(":")
-        if fields[0].lower() == "register":
-            username = fields[1]
-            name = fields[2] 
-            email = fields[3] 
-            password = fields[4]
-            area = fields[5]
-            is_driver = int(fields[6])
-            print(f"Registering user: {username}, {name}, {email}, {area}, {is_driver}")
-            conn.sendall(register_user(username,name,email,password,area,is_driver).encode())
-        elif fields[0].lower() == "login":
-            username = fields[1]
-            password = fields[2]
-            print(f"Logging in user: {username}")
-            conn.sendall(login_user(username, password).encode())
-        elif fields[0].lower() == "editprofile":
-            username = fields[1]
-            full_name = fields[2]
-            area = fields[3]
-            is_driver = int(fields[4])
-            dict = {"name": full_name, "area": area, "is_driver": is_driver}
-            print(f"Editing profile for user: {username}")
-            conn.sendall(edit_fields(username, dict).encode())
-        elif fields[0].lower() == "update_availability":
-            username = fields[1]
-            availability_str = fields[2]
-            min_rating = fields[3]
-
-            print("Received availability:", availability_str)
-
-            parts = availability_str.split(";")
-
-            days_order = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-            availability = {}
-
-            for i, day in enumerate(days_order):
-                entry = parts[i]
-                if entry:
-                    from_time, to_time = entry.split("-")
-                    availability[day] = {
-                        "from": from_time.replace(".", ":"),
-                        "to": to_time.replace(".", ":")
-                    }
-                else:
-                    availability[day] = None
-
-            update_fields = {
-                "mon_commute": availability["mon"] or [],
-                "tue_commute": availability["tue"] or [],
-                "wed_commute": availability["wed"] or [],
-                "thu_commute": availability["thu"] or [],
-                "fri_commute": availability["fri"] or [],
-                "sat_commute": availability["sat"] or [],
-                "sun_commute": availability["sun"] or [],
-                "min_passenger_rating": min_rating
-            }
-
-            response = edit_fields(username, update_fields)
-            conn.sendall(response.encode())
-        elif fields[0].lower() == "request_ride":
-            passenger = fields[1]
-            area = fields[2]
-            day = fields[3] + "_commute"
-            ride_time = f"{fields[4]}:{fields[5]}"
-            min_rating = float(fields[6])
-            passenger_name = get_user_display_name(passenger)
-            drivers = search_valid_drivers(area, day, ride_time, min_rating)
-            print(f"Found drivers: {drivers}")
-            if isinstance(drivers, str):
-                # No drivers or error message
-                conn.sendall(drivers.encode())
-            else:
-                added = 0
-                failures = []
-                request_id = str(uuid.uuid4())
-                request_payload = {
-                    "id": request_id,
-                    "passenger": passenger,
-                    "passenger_name": passenger_name,
-                    "area": area,
-                    "day": day,
-                    "time": ride_time,
-                    "min_rating": min_rating,
-                    "status": "pending",
-                    "accepted_by": None
-                }
-
-                for d in drivers:
-                    try:
-                        res = add_pending_request(d["username"], request_payload)
-                        if "added" in res.lower() or "request added" in res.lower() or res == "Request added to pending queue.":
-                            added += 1
-                        else:
-                            # treat non-success as failure but continue
-                            failures.append(f"{d['username']}: {res}")
-                    except Exception as e:
-                        failures.append(f"{d.get('username','?')}: {e}")
-
-                resp = f"Request added to {added} driver(s)."
-                if failures:
-                    resp += " Failures: " + "; ".join(failures)
-                print(resp)
-                conn.sendall(resp.encode())
-        elif fields[0].lower() == "get_pending":
-            username = fields[1]
-            result = get_pending_requests(username)
-            if isinstance(result, str):
-                conn.sendall(("error:" + result).encode())
-            else:
-                conn.sendall(("success:" + json.dumps(result)).encode())
-        elif fields[0].lower() == "get_active_rides":
-            username = fields[1]
-            result = get_active_rides(username)
-            if isinstance(result, str):
-                conn.sendall(("error:" + result).encode())
-            else:
-                conn.sendall(("success:" + json.dumps(result)).encode())
-        elif fields[0].lower() == "get_completed_rides":
-            username = fields[1]
-            result = get_completed_rides(username)
-            if isinstance(result, str):
-                conn.sendall(("error:" + result).encode())
-            else:
-                conn.sendall(("success:" + json.dumps(result)).encode())
-        elif fields[0].lower() == "delete_request":
-            username = fields[1]
-            index = int(fields[2])
-
-            result = delete_pending_request(username, index)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "accept_request":
-            driver_username = fields[1]
-            request_id = fields[2]
-            result = accept_pending_request(driver_username, request_id)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "end_request":
-            driver_username = fields[1]
-            request_id = fields[2]
-            result = complete_pending_request(driver_username, request_id)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "rate_passenger":
-            passenger_username = fields[1]
-            try:
-                rating = float(fields[2])
-            except (ValueError, IndexError):
-                conn.sendall("Invalid rating.".encode())
-                return
-            result = rate_passenger(passenger_username, rating)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "rate_driver_ride":
-            passenger_username = fields[1]
-            driver_username = fields[2]
-            request_id = fields[3]
-            try:
-                rating = float(fields[4])
-            except (ValueError, IndexError):
-                conn.sendall("Invalid rating.".encode())
-                return
-            result = rate_driver(driver_username, rating)
-            if result.lower().startswith("driver rating updated"):
-                remove_completed_ride(passenger_username, request_id)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "send_message":
-            if len(fields) < 5:
-                conn.sendall("Invalid message payload.".encode())
-                return
-            ride_id = fields[1]
-            sender = fields[2]
-            recipient = fields[3]
-            encoded_msg = fields[4]
-            try:
-                message_text = base64.b64decode(encoded_msg.encode()).decode()
-            except Exception:
-                conn.sendall("Invalid message encoding.".encode())
-                return
-            result = add_ride_message(ride_id, sender, recipient, message_text)
-            conn.sendall(result.encode())
-        elif fields[0].lower() == "get_messages":
-            if len(fields) < 2:
-                conn.sendall("Invalid ride id.".encode())
+        return pool.submit(priority, handle_frame, flags, payload, channel, client)
+    except Busy as e:
+        return _busy_frame(flags, e.retry_after)
+
+
+def submit_legacy(pool: WorkerPool, message: str, client=None):
+    """Queue a legacy text request on the pool; returns a Future or a busy reply."""
+    priority = command_priority(message.partition(":")[0])
+    try:
+        return pool.submit(priority, handle_legacy, message, client)
+    except Busy as e:
+        return f"busy:{e.retry_after}"
+
+
+def _client_ip(addr):
+    return addr[0] if addr else None
+
+
+def _read_preamble(conn) -> bytes:
+    """Read until the first bytes tell a framed connection from a legacy one."""
+    data = conn.recv(1024)
+    while data and split_preamble(data)[0] is None:
+        chunk = conn.recv(1024)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _recv_request(conn, decoder: FrameDecoder, tracked):
+    """protocol.recv_frame that keeps tracked idle until a request starts arriving."""
+    if decoder.has_partial():
+        tracked.reading()
+    else:
+        tracked.idle()
+        if connections.table.draining:
+            return None  # shutting down: close between requests
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            tracked.working()
+            return frame
+        chunk = conn.recv(RECV_SIZE)
+        if not chunk:
+            if decoder.has_partial():
+                raise ProtocolError("Connection closed mid-frame.")
+            return None
+        decoder.feed(chunk)
+        tracked.reading()
+
+
+def serve_framed(conn, pool: WorkerPool, tracked, initial: bytes = b""):
+    """Answer framed requests on a keep-alive connection until the peer closes."""
+    decoder = FrameDecoder()
+    decoder.feed(initial)
+    channel = tracked.channel = pubsub.ThreadedChannel(conn)
+    client = _client_ip(tracked.addr)
+    conn_id = recorder.new_connection() if recorder is not None else 0
+    try:
+        while True:
+            frame = _recv_request(conn, decoder, tracked)
+            if frame is None:
                 return
-            ride_id = fields[1]
-            result = get_ride_messages(ride_id)
-            if isinstance(result, str):
-                conn.sendall(("error:" + result).encode())
-            else:
-                conn.sendall(("success:" + json.dumps(result)).encode())
+            flags, payload = frame
+            if recorder is not None:
+                recorder.record(conn_id, flags, payload)
+            reply = submit_frame(pool, flags, payload, channel, client)
+            if not isinstance(reply, bytes):
+                try:
+                    reply = reply.result()
+                except Busy as e:  # displaced from the queue by higher-priority work
+                    reply = _busy_frame(flags, e.retry_after)
+            metrics.metrics.traffic(HEADER.size + len(payload), len(reply))
+            tracked.writing()
+            channel.send(reply)
+    finally:
+        pubsub.broker.unsubscribe_all(channel)
+        channel.close()
+
 
+def handle_client(conn, addr, pool: WorkerPool, tracked):
+    """Per-connection thread for both framed and legacy clients.
 
+    The thread only does socket I/O; requests run on the shared worker pool.
+    tracked is the connection's entry in connections.table.
+    """
+    log.info("connection.open", addr=addr)
+    metrics.metrics.connection_opened()
+    try:
+        framed, data = split_preamble(_read_preamble(conn))
+        if framed:
+            serve_framed(conn, pool, tracked, data)
         else:
-            conn.sendall("Invalid command.".encode())
-    except Exception as e:
-        print(f"Error: {e}")
-        conn.sendall("Error processing request. Connection closing.\n".encode())
+            tracked.working()
+            if recorder is not None:
+                recorder.record_legacy(recorder.new_connection(), data)
+            reply = submit_legacy(pool, data.decode(), _client_ip(addr))
+            if not isinstance(reply, str):
+                try:
+                    reply = reply.result()
+                except Busy as e:
+                    reply = f"busy:{e.retry_after}"
+            reply = reply.encode()
+            metrics.metrics.traffic(len(data), len(reply))
+            tracked.writing()
+            conn.sendall(reply)
+    except (OSError, ProtocolError, UnicodeDecodeError) as e:
+        log.warning("connection.error", addr=addr, error=str(e))
     finally:
+        connections.table.release(tracked)
+        metrics.metrics.connection_closed()
         conn.close()
 
-init_db()
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((HOST, PORT))
-server_socket.listen()
-print(f"Server listening on port {PORT}...")
+def listen_socket(host=HOST, port=PORT, reuse_port=False, listen_fd=None):
+    """Bind the listening socket, or adopt the one a predecessor handed over."""
+    if listen_fd is not None:
+        # Left in whatever blocking mode the predecessor uses; both loops cope.
+        return socket.socket(fileno=listen_fd)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen()
+    return sock
+
+
+def _drain():
+    log.info("server.draining", timeout=shutdown.DRAIN_TIMEOUT)
+    cut_off = connections.table.drain(shutdown.DRAIN_TIMEOUT)
+    log.info("server.drained", cut_off=cut_off)
+
+
+def serve_threaded(pool: WorkerPool, sock, argv=None):
+    """Accept loop that spawns a thread running handle_client per connection.
+
+    Returns once connections have drained after SIGTERM/SIGINT, or after
+    SIGHUP handed the socket to a successor (only when argv is given).
+    """
+    requested = []  # signals received; the handlers only record them
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: requested.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: requested.append(signum))
+    if argv is not None:
+        signal.signal(signal.SIGHUP, lambda signum, frame: requested.append(signum))
+    log.info("server.listening", port=sock.getsockname()[1], mode="threaded",
+             workers=pool.workers)
+    shutdown.notify_ready()
+
+    while True:
+        if requested:
+            signum = requested.pop(0)
+            if signum != signal.SIGHUP or shutdown.hand_off(sock, argv):
+                break
+            continue
+        if not select.select([sock], [], [], 0.5)[0]:
+            continue
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:  # a handoff partner accepted it first
+            continue
+        # Refuse before starting a thread: the limit exists to bound threads.
+        tracked = connections.table.open(addr, functools.partial(conn.shutdown, socket.SHUT_RDWR))
+        if tracked is None:
+            conn.close()
+            continue
+        client_thread = threading.Thread(target=handle_client, args=(conn, addr, pool, tracked))
+        client_thread.start()
+    sock.close()
+    _drain()
+
+
+async def _read_preamble_async(reader) -> bytes:
+    data = await reader.read(1024)
+    while data and split_preamble(data)[0] is None:
+        chunk = await reader.read(1024)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def serve_framed_async(reader, writer, pool: WorkerPool, tracked, initial: bytes = b""):
+    loop = asyncio.get_running_loop()
+    decoder = FrameDecoder()
+    decoder.feed(initial)
+    channel = tracked.channel = pubsub.AsyncChannel(loop, writer)
+    client = _client_ip(tracked.addr)
+    conn_id = recorder.new_connection() if recorder is not None else 0
+    try:
+        while True:
+            frame = decoder.next_frame()
+            if frame is None:
+                if decoder.has_partial():
+                    tracked.reading()
+                else:
+                    tracked.idle()
+                    if connections.table.draining:
+                        return  # shutting down: close between requests
+                chunk = await reader.read(RECV_SIZE)
+                if not chunk:
+                    if decoder.has_partial():
+                        raise ProtocolError("Connection closed mid-frame.")
+                    return
+                decoder.feed(chunk)
+                continue
+            tracked.working()
+            flags, payload = frame
+            if recorder is not None:
+                recorder.record(conn_id, flags, payload)
+            reply = submit_frame(pool, flags, payload, channel, client)
+            if not isinstance(reply, bytes):
+                try:
+                    reply = await asyncio.wrap_future(reply)
+                except Busy as e:
+                    reply = _busy_frame(flags, e.retry_after)
+            metrics.metrics.traffic(HEADER.size + len(payload), len(reply))
+            tracked.writing()
+            writer.write(reply)
+            await writer.drain()
+    finally:
+        pubsub.broker.unsubscribe_all(channel)
+
+
+async def handle_client_async(reader, writer, pool: WorkerPool):
+    """Event-loop handler; the blocking database work runs on the worker pool."""
+    addr = writer.get_extra_info("peername")
+    loop = asyncio.get_running_loop()
+    tracked = connections.table.open(
+        addr, lambda: loop.call_soon_threadsafe(writer.transport.abort))
+    if tracked is None:
+        writer.close()
+        return
+    log.info("connection.open", addr=addr)
+    metrics.metrics.connection_opened()
+    try:
+        framed, data = split_preamble(await _read_preamble_async(reader))
+        if framed:
+            await serve_framed_async(reader, writer, pool, tracked, data)
+        else:
+            tracked.working()
+            if recorder is not None:
+                recorder.record_legacy(recorder.new_connection(), data)
+            reply = submit_legacy(pool, data.decode(), _client_ip(addr))
+            if not isinstance(reply, str):
+                try:
+                    reply = await asyncio.wrap_future(reply)
+                except Busy as e:
+                    reply = f"busy:{e.retry_after}"
+            reply = reply.encode()
+            metrics.metrics.traffic(len(data), len(reply))
+            tracked.writing()
+            writer.write(reply)
+            await writer.drain()
+    except (ConnectionError, ProtocolError, UnicodeDecodeError) as e:
+        log.warning("connection.error", addr=addr, error=str(e))
+    finally:
+        connections.table.release(tracked)
+        metrics.metrics.connection_closed()
+        writer.close()
+
+
+async def serve_asyncio(pool: WorkerPool, sock, argv=None):
+    """Serve every connection on one event loop; DB work goes to the pool.
+
+    Stops like serve_threaded: on SIGTERM/SIGINT, or SIGHUP with argv.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    server = await asyncio.start_server(lambda r, w: handle_client_async(r, w, pool), sock=sock)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    if argv is not None:
+        handoff = None
+
+        async def hand_off():
+            if await loop.run_in_executor(None, shutdown.hand_off, sock, argv):
+                stop.set()
+
+        def on_hangup():
+            nonlocal handoff
+            if handoff is None or handoff.done():
+                handoff = loop.create_task(hand_off())
+
+        loop.add_signal_handler(signal.SIGHUP, on_hangup)
+    log.info("server.listening", port=sock.getsockname()[1], mode="asyncio",
+             workers=pool.workers)
+    shutdown.notify_ready()
+    await stop.wait()
+    server.close()
+    await loop.run_in_executor(None, _drain)
+
+
+def serve(args, reuse_port=False, argv=None):
+    """Run one server process in the selected mode until it is stopped.
+
+    argv (the command line) enables SIGHUP handoff to a successor process.
+    """
+    global recorder
+    sock = listen_socket(args.host, args.port, reuse_port, args.listen_fd)
+    if args.record:
+        recorder = capture.Recorder(args.record, args.record_salt)
+    pool = WorkerPool(args.db_workers, args.queue_size, name="db")
+    stats.register_source("workers", pool.snapshot)
+    database.start_migration()
+    database.start_widening()
+    drained = False
+    try:
+        if args.mode == "threaded":
+            serve_threaded(pool, sock, argv)
+        else:
+            asyncio.run(serve_asyncio(pool, sock, argv))
+        drained = True
+    finally:
+        # After a graceful stop, queued database work still runs before exit.
+        pool.shutdown(wait=drained)
+        database.close_connections()
+        if recorder is not None:
+            recorder.close()
+    log.info("server.stopped")
+
+
+def serve_prefork(args):
+    """Supervise args.processes forked servers sharing the port via SO_REUSEPORT."""
+    prefork.check_port(args.host, args.port)
+
+    def run_worker(index, event_dir):
+        log.logger.for_worker(index)
+        if args.trace:
+            root, ext = os.path.splitext(args.trace)
+            tracing.enable(f"{root}.{index}{ext}", args.trace_sample, args.trace_min_ms)
+        if args.record:
+            args.record = f"{args.record}.{index}"
+        if args.metrics_port:
+            # Each worker has its own counters, so each gets its own port.
+            metrics.serve_http("127.0.0.1", args.metrics_port + index)
+        relay = prefork.EventRelay(event_dir, index, args.processes)
+        database.add_listener(relay.forward)
+        stats.register_source("process", lambda: {
+            "pid": os.getpid(), "worker": index, "processes": args.processes,
+        })
+        stats.register_source("relay", relay.snapshot)
+        serve(args, reuse_port=True)
+
+    prefork.Supervisor(args.processes, run_worker).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AUBus server")
+    parser.add_argument("--mode", choices=["asyncio", "threaded"], default="asyncio",
+                        help="asyncio event loop (default) or legacy thread-per-connection")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--db", default=database.DB_FILE, help="SQLite database file")
+    parser.add_argument("--db-pragma", action="append", default=[], metavar="NAME=VALUE",
+                        help="PRAGMA applied to every database connection (repeatable)")
+    parser.add_argument("--match-tolerance", type=int, default=database.MATCH_TOLERANCE,
+                        metavar="MINUTES",
+                        help="minutes a driver's commute time may differ from the requested "
+                             f"ride time (default {database.MATCH_TOLERANCE})")
+    parser.add_argument("--fanout-limit", type=int, default=database.FANOUT_LIMIT, metavar="K",
+                        help="offer a ride request to the K best-ranked matched drivers "
+                             f"(0: all; default {database.FANOUT_LIMIT})")
+    parser.add_argument("--queue-cap", type=int, default=database.QUEUE_CAP,
+                        help="pending requests a driver's queue holds; drivers with a full queue "
+                             f"are passed over (0: no cap; default {database.QUEUE_CAP})")
+    parser.add_argument("--fanout-widen-after", type=float, default=database.FANOUT_WIDEN_AFTER,
+                        metavar="SECONDS",
+                        help="offer a request nobody accepted within SECONDS to the next K "
+                             f"drivers (0: never; default {database.FANOUT_WIDEN_AFTER:g})")
+    parser.add_argument("--match-in-memory", action="store_true",
+                        help="match ride requests against an in-memory index of driver "
+                             "availability instead of querying the database")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT "
+                             "(pre-fork mode when above 1)")
+    parser.add_argument("--db-workers", type=int, default=DB_WORKERS,
+                        help="worker threads running requests (and their database calls)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="requests allowed to wait for a worker before shedding")
+    parser.add_argument("--max-connections", type=int, default=connections.MAX_CONNECTIONS,
+                        help="refuse new clients beyond this many open connections (0: no limit)")
+    parser.add_argument("--idle-timeout", type=float, default=connections.IDLE_TIMEOUT,
+                        help="close keep-alive connections idle this many seconds "
+                             "(subscribers exempt; 0 disables)")
+    parser.add_argument("--read-timeout", type=float, default=connections.READ_TIMEOUT,
+                        help="seconds a client may take to send a started request (0 disables)")
+    parser.add_argument("--write-timeout", type=float, default=connections.WRITE_TIMEOUT,
+                        help="seconds a client may take to accept a reply (0 disables)")
+    parser.add_argument("--drain-timeout", type=float, default=shutdown.DRAIN_TIMEOUT,
+                        help="seconds in-flight requests get to finish on SIGTERM/SIGINT/SIGHUP")
+    parser.add_argument("--listen-fd", type=int,
+                        help="serve on this inherited listening socket (set by SIGHUP handoff)")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="limit each username and IP address with token buckets "
+                             "per command class (see ratelimit.py)")
+    parser.add_argument("--rate", action="append", default=[], metavar="CLASS=RATE/BURST",
+                        help="requests per second and burst for a rate class, e.g. "
+                             "fanout=0.5/5 (repeatable; RATE 0 lifts the limit; implies --rate-limit)")
+    parser.add_argument("--rate-ip-factor", type=float, default=ratelimit.IP_FACTOR,
+                        help="how many times a user's limit one IP address gets")
+    parser.add_argument("--compress-threshold", type=int, default=compression.COMPRESS_THRESHOLD,
+                        help="compress replies of at least this many bytes for clients "
+                             "that accept it (0 disables)")
+    parser.add_argument("--log-level", choices=list(log.LEVELS), default="info")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="human-readable lines or JSON lines")
+    parser.add_argument("--log-file", help="log to this file, rotated by size (default stdout)")
+    parser.add_argument("--log-max-bytes", type=int, default=log.logger.max_bytes)
+    parser.add_argument("--log-backups", type=int, default=log.logger.backups,
+                        help="rotated log files to keep")
+    parser.add_argument("--log-sample", action="append", default=[], metavar="EVENT=N",
+                        help="write only 1 in N occurrences of EVENT (repeatable)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write per-request traces to FILE in Chrome trace format "
+                             "(worker i of --processes writes FILE.i)")
+    parser.add_argument("--trace-sample", type=int, default=1, metavar="N",
+                        help="trace 1 in N requests")
+    parser.add_argument("--trace-min-ms", type=float, default=0.0,
+                        help="only keep traces of requests slower than this")
+    parser.add_argument("--record", metavar="FILE",
+                        help="capture anonymized requests to FILE for replay.py "
+                             "(worker i of --processes writes FILE.i)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics "
+                             "(worker i of --processes uses PORT+i)")
+    parser.add_argument("--compress-level", type=int, default=compression.COMPRESS_LEVEL,
+                        choices=range(1, 10), metavar="1-9")
+    args = parser.parse_args(argv)
+    sampling = {}
+    for spec in args.log_sample:
+        event, _, rate = spec.partition("=")
+        if not rate.isdigit() or int(rate) < 1:
+            parser.error(f"--log-sample expects EVENT=N, got {spec!r}")
+        sampling[event] = int(rate)
+    if args.record and os.path.exists(args.record if args.processes == 1 else f"{args.record}.0"):
+        parser.error("--record will not overwrite an existing capture.")
+    pragmas = {}
+    for spec in args.db_pragma:
+        name, _, value = spec.partition("=")
+        if not name.isidentifier() or not value or not value.replace("-", "").isalnum():
+            parser.error(f"--db-pragma expects NAME=VALUE, got {spec!r}")
+        pragmas[name] = value
+    rates = dict(ratelimit.DEFAULT_RATES)
+    for spec in args.rate:
+        name, _, limit = spec.partition("=")
+        rate, _, burst = limit.partition("/")
+        try:
+            rates[name] = (float(rate), float(burst or rate))
+        except ValueError:
+            parser.error(f"--rate expects CLASS=RATE/BURST, got {spec!r}")
+        if name not in ratelimit.DEFAULT_RATES:
+            parser.error(f"Unknown rate class {name!r} (one of {', '.join(ratelimit.DEFAULT_RATES)}).")
+    if args.listen_fd is not None and args.processes > 1:
+        parser.error("--listen-fd serves a single process; it cannot be used with --processes.")
+    if args.match_tolerance < 0:
+        parser.error("--match-tolerance cannot be negative.")
+    for flag in ("fanout_limit", "queue_cap", "fanout_widen_after"):
+        if getattr(args, flag) < 0:
+            parser.error(f"--{flag.replace('_', '-')} cannot be negative.")
+    if args.processes > 1 and not prefork.supported():
+        parser.error("--processes needs os.fork and SO_REUSEPORT (Linux/BSD/macOS).")
+
+    log.configure(args.log_level, args.log_format, args.log_file,
+                  args.log_max_bytes, args.log_backups, sampling)
+    compression.COMPRESS_THRESHOLD = args.compress_threshold
+    compression.COMPRESS_LEVEL = args.compress_level
+    connections.MAX_CONNECTIONS = args.max_connections
+    connections.IDLE_TIMEOUT = args.idle_timeout
+    connections.READ_TIMEOUT = args.read_timeout
+    connections.WRITE_TIMEOUT = args.write_timeout
+    shutdown.DRAIN_TIMEOUT = args.drain_timeout
+    if args.rate_limit or args.rate:
+        ratelimit.enable(rates, args.rate_ip_factor)
+    database.DB_FILE = args.db
+    database.PRAGMAS.update(pragmas)
+    database.MATCH_TOLERANCE = args.match_tolerance
+    database.FANOUT_LIMIT = args.fanout_limit
+    database.QUEUE_CAP = args.queue_cap
+    database.FANOUT_WIDEN_AFTER = args.fanout_widen_after
+
+    init_db()
+    # One salt for every --processes worker, so their FILE.i hash a user alike.
+    args.record_salt = os.urandom(16) if args.record else None
+    if args.match_in_memory:
+        matching.enable()  # before forking, so --processes workers share the loaded index
+    if args.processes > 1:
+        serve_prefork(args)
+    else:
+        if args.metrics_port:
+            metrics.serve_http("127.0.0.1", args.metrics_port)
+        if args.trace:
+            tracing.enable(args.trace, args.trace_sample, args.trace_min_ms)
+        serve(args, argv=sys.argv[1:] if argv is None else list(argv))
+
 
-while True:
-    conn, addr = server_socket.accept()
-    client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-    client_thread.start()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Graceful shutdown and listening-socket handoff.
+
+SIGTERM or SIGINT stops a server gracefully: it stops accepting, closes
+idle keep-alive connections, lets requests already being served finish
+(and their connections close after the reply) for up to DRAIN_TIMEOUT
+seconds, cuts off whatever is left, runs the queued database work and
+flushes the log, trace and capture writers before exiting. A ride being
+accepted or completed is therefore never cut off mid-transaction.
+
+SIGHUP hands the server over to a new process without dropping
+connections: the running server starts a copy of itself with the same
+arguments plus --listen-fd, passing it the listening socket, and waits up
+to HANDOFF_TIMEOUT seconds for the successor to report that it is
+serving (it writes to the pipe named by READY_ENV). Both accept from the
+shared socket meanwhile. Once the successor is ready the old server
+drains and exits as on SIGTERM; if it fails to start, the old server
+keeps serving. Handoff is for single-process servers; a --processes
+fleet can be replaced by starting the new one on the same port
+(SO_REUSEPORT) and then stopping the old supervisor.
+"""
+
+import os
+import select
+import subprocess
+import sys
+import time
+
+import log
+
+DRAIN_TIMEOUT = 10.0    # seconds in-flight requests get to finish
+HANDOFF_TIMEOUT = 15.0  # seconds a successor gets to start serving
+READY_ENV = "AUBUS_READY_FD"
+
+# Options not passed on to a successor: its socket comes from --listen-fd,
+# and a capture file cannot be shared (it would refuse to overwrite it).
+_NOT_INHERITED = ("--listen-fd", "--record")
+
+
+def successor_argv(argv, listen_fd: int) -> list:
+    """The server's own arguments for a successor taking over listen_fd."""
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in _NOT_INHERITED:
+            skip = True
+        elif not arg.startswith(tuple(f"{opt}=" for opt in _NOT_INHERITED)):
+            out.append(arg)
+    return [sys.executable, os.path.abspath(sys.argv[0]), *out, "--listen-fd", str(listen_fd)]
+
+
+def hand_off(listen_sock, argv) -> bool:
+    """Start a successor on listen_sock; True once it serves, False if it failed."""
+    fd = listen_sock.fileno()
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ, **{READY_ENV: str(ready_w)})
+    try:
+        successor = subprocess.Popen(successor_argv(argv, fd), pass_fds=(fd, ready_w), env=env)
+    except OSError as e:
+        log.error("server.handoff_failed", error=str(e))
+        os.close(ready_r)
+        os.close(ready_w)
+        return False
+    os.close(ready_w)
+    try:
+        deadline = time.monotonic() + HANDOFF_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or successor.poll() is not None:
+                break
+            readable, _, _ = select.select([ready_r], [], [], min(remaining, 0.5))
+            if readable and os.read(ready_r, 1):
+                log.info("server.handoff", successor=successor.pid)
+                return True
+    finally:
+        os.close(ready_r)
+    code = successor.poll()
+    if code is None:
+        successor.kill()
+        successor.wait()
+    log.error("server.handoff_failed", successor=successor.pid, code=code)
+    return False
+
+
+def notify_ready():
+    """Tell the server that started this one with hand_off() that it is serving."""
+    fd = os.environ.pop(READY_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except (OSError, ValueError):
+        pass
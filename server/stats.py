@@ -0,0 +1,15 @@
+"""Registry of the statistics reported by the stats command.
+
+Subsystems register a zero-argument function returning a JSON-friendly
+dict; collect() gathers a snapshot from all of them.
+"""
+
+_sources = {}
+
+
+def register_source(name: str, snapshot):
+    _sources[name] = snapshot
+
+
+def collect() -> dict:
+    return {name: snapshot() for name, snapshot in _sources.items()}
@@ -0,0 +1,210 @@
+"""Opt-in per-request tracing.
+
+When enabled (server.py --trace FILE) every sampled request gets a request
+id and a tree of timed spans: the command itself, argument parsing, each
+traced database.py function, write lock waits, and every SQL statement and
+commit (through TracedConnection). Finished traces are appended to FILE in
+the Chrome trace event format; open it in chrome://tracing or
+https://ui.perfetto.dev.
+
+Disabled, the cost is one ContextVar lookup per traced call.
+"""
+
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import stats
+
+enabled = False
+SAMPLE_EVERY = 1       # trace 1 in N requests
+MIN_DURATION = 0.0     # seconds; faster requests are not written
+MAX_STATEMENT = 200    # characters of SQL kept per statement span
+
+_current = contextvars.ContextVar("trace", default=None)
+_ids = itertools.count(1)
+_requests = itertools.count()
+_queue = queue.SimpleQueue()
+_counters = {"started": 0, "written": 0, "skipped_fast": 0}
+
+
+class Trace:
+    """Spans recorded while serving one request."""
+
+    __slots__ = ("request_id", "events", "tid")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.events = []
+        self.tid = threading.get_ident()
+
+    def add(self, name: str, category: str, start: float, end: float, args=None):
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": round(start * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(), "tid": self.tid,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+
+def current_request_id():
+    trace = _current.get()
+    return trace.request_id if trace is not None else None
+
+
+@contextmanager
+def request(command: str):
+    """Root span of one request; starts a trace if tracing is on and sampled.
+
+    Inside an already traced request (a batch sub-command) it is a child span.
+    """
+    if not enabled:
+        yield None
+        return
+    parent = _current.get()
+    if parent is not None:
+        with span(command, "request"):
+            yield parent
+        return
+    if next(_requests) % SAMPLE_EVERY:
+        yield None
+        return
+    trace = Trace(f"{os.getpid():x}-{next(_ids):x}")
+    token = _current.set(trace)
+    _counters["started"] += 1
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        end = time.perf_counter()
+        _current.reset(token)
+        trace.add(command, "request", start, end, {"request_id": trace.request_id})
+        if end - start >= MIN_DURATION:
+            _queue.put(trace.events)
+        else:
+            _counters["skipped_fast"] += 1
+
+
+@contextmanager
+def span(name: str, category: str = "app", **args):
+    """Time a block as a child span of the current request, if it is traced."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.perf_counter(), args or None)
+
+
+def add_span(name: str, category: str, start: float, end: float, **args):
+    """Record an already-timed span (e.g. a lock wait) on the current trace."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, category, start, end, args or None)
+
+
+def traced(fn):
+    """Decorator: record each call of fn as a "db" span."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            trace.add(name, "db", start, time.perf_counter())
+    return wrapper
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with span("sql", "sql", statement=sql.strip()[:MAX_STATEMENT]):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with span("sql", "sql", statement=sql.strip()[:MAX_STATEMENT], many=True):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3 connection factory whose statements and commits become spans."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        with span("commit", "sql"):
+            super().commit()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            with span("commit", "sql"):
+                return super().__exit__(exc_type, exc, tb)
+        return super().__exit__(exc_type, exc, tb)
+
+
+def connection_factory():
+    return TracedConnection if enabled else sqlite3.Connection
+
+
+def _write_loop(path: str):
+    # JSON array format: the closing bracket is optional, so traces can be
+    # appended as they finish and the file stays loadable at any point.
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", encoding="utf-8") as out:
+        if new:
+            out.write("[\n")
+        while True:
+            events = _queue.get()
+            if events is None:
+                out.flush()
+                return
+            for event in events:
+                out.write(json.dumps(event) + ",\n")
+            _counters["written"] += 1
+            if _queue.empty():
+                out.flush()
+
+
+_writer = None
+
+
+def enable(path: str, sample_every: int = 1, min_duration_ms: float = 0.0):
+    """Start tracing requests to a Chrome trace file (call once per process)."""
+    global enabled, SAMPLE_EVERY, MIN_DURATION, _writer
+    SAMPLE_EVERY = max(1, sample_every)
+    MIN_DURATION = min_duration_ms / 1000
+    _writer = threading.Thread(target=_write_loop, args=(path,), name="trace-writer", daemon=True)
+    _writer.start()
+    enabled = True
+    atexit.register(close)
+    stats.register_source("tracing", lambda: dict(_counters, file=path))
+
+
+def close(timeout: float = 5.0):
+    """Flush finished traces to the file and stop the writer."""
+    global enabled
+    enabled = False
+    if _writer is not None and _writer.is_alive():
+        _queue.put(None)
+        _writer.join(timeout)
@@ -0,0 +1,137 @@
+"""Fixed-size worker pool with a bounded, prioritised request queue.
+
+Requests are queued by priority (lower number runs first, FIFO within a
+priority). When the queue is full a new request either displaces the most
+recently queued request of a lower priority or is rejected immediately
+with Busy, so an overloaded server answers "busy, retry after N seconds"
+instead of letting latency grow without bound.
+"""
+
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+PRIORITY_CRITICAL = 0  # ride state changes (accept/end)
+PRIORITY_WRITE = 1     # other writes
+PRIORITY_READ = 2      # reads; the default
+PRIORITY_POLL = 3      # high-volume polling such as chat refreshes, and diagnostics
+PRIORITIES = (PRIORITY_CRITICAL, PRIORITY_WRITE, PRIORITY_READ, PRIORITY_POLL)
+
+
+class Busy(Exception):
+    """The pool is saturated; the client should retry after retry_after seconds."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    def __init__(self, workers: int, max_queue: int, name: str = "worker"):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues = {p: collections.deque() for p in PRIORITIES}
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._seq = itertools.count()
+        self._service_time = 0.005  # moving average of seconds per request
+        self.submitted = 0
+        self.completed = 0
+        self.shed = {p: 0 for p in PRIORITIES}
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def retry_after(self) -> float:
+        """Rough time for the current backlog to drain."""
+        seconds = (self._depth + 1) * self._service_time / self.workers
+        return round(min(max(seconds, 0.1), 30.0), 1)
+
+    def submit(self, priority: int, fn, *args) -> Future:
+        """Queue fn(*args); raises Busy if the request is shed on arrival."""
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Worker pool is shut down.")
+            if self._depth >= self.max_queue:
+                victim = self._displaceable(priority)
+                if victim is None:
+                    self.shed[priority] += 1
+                    raise Busy(self.retry_after())
+                _, victim_future, _, _ = self._queues[victim].pop()
+                self._depth -= 1
+                self.shed[victim] += 1
+                if victim_future.set_running_or_notify_cancel():
+                    victim_future.set_exception(Busy(self.retry_after()))
+            self._queues[priority].append((next(self._seq), future, fn, args))
+            self._depth += 1
+            self.submitted += 1
+            self._cond.notify()
+        return future
+
+    def _displaceable(self, priority: int):
+        """Lowest-priority non-empty queue ranked below priority, if any."""
+        for p in reversed(PRIORITIES):
+            if p <= priority:
+                return None
+            if self._queues[p]:
+                return p
+        return None
+
+    def _next(self):
+        with self._cond:
+            while not self._depth and not self._shutdown:
+                self._cond.wait()
+            if not self._depth:
+                return None
+            for p in PRIORITIES:
+                if self._queues[p]:
+                    self._depth -= 1
+                    return self._queues[p].popleft()
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            _, future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                self.completed += 1
+                self._service_time += (elapsed - self._service_time) * 0.05
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting work; queued requests still run before workers exit."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self._depth,
+                "queue_depth_by_priority": {str(p): len(q) for p, q in self._queues.items()},
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "shed": sum(self.shed.values()),
+                "shed_by_priority": {str(p): n for p, n in self.shed.items()},
+                "avg_service_ms": round(self._service_time * 1000, 3),
+            }